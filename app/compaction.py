@@ -0,0 +1,190 @@
+"""
+Background compaction of long conversations.
+
+Once the messages of a conversation take more than a number of tokens, the
+`ConversationCompactor` summarizes its oldest messages in its own event loop,
+off the request path, and hands the summary to the chat, which replaces
+those messages with it when the next turn builds its context. The summary is
+rolling: the next compaction summarizes the previous summary together with
+the messages that followed it, so the conversation is never summarized again
+from the start. The message info of the chat keeps every message.
+"""
+import asyncio
+import logging
+import threading
+from typing import Awaitable, Callable, List
+
+from app.metrics import COMPACTIONS, time_upstream
+from app.workers import BackgroundLoop
+
+logger = logging.getLogger(__name__)
+
+__all__ = [
+    "ConversationCompactor",
+    "summary_prompt",
+]
+
+SUMMARY_INSTRUCTIONS = (
+    "You keep a running summary of a WhatsApp conversation between a user and an assistant. "
+    "Update the current summary with the new messages. Keep the facts, names, preferences, "
+    "requests and anything the assistant promised; leave out greetings and small talk. "
+    "Write the summary in the language of the conversation, in at most {max_words} words."
+)
+
+
+def summary_prompt(previous: str, messages: List[dict], max_words: int = 200) -> List[dict]:
+    """Returns the messages asking the model to update the summary with the new messages"""
+    transcript = "\n".join(f"{msg['role'].upper()}: {msg['content']}" for msg in messages)
+    return [
+        {"role": "system", "content": SUMMARY_INSTRUCTIONS.format(max_words=max_words)},
+        {"role": "user", "content": f"Current summary:\n{previous or '(none)'}\n\nNew messages:\n{transcript}"},
+    ]
+
+
+class ConversationCompactor:
+    """
+    Summarizes the oldest messages of the conversations that grow too long.
+
+    Parameters
+    ----------
+    complete : Callable
+        Coroutine function returning the completion of a list of messages.
+    threshold_tokens : int, optional
+        Tokens of the messages of a conversation (without the system message)
+        above which it's compacted, by default 2000
+    keep_tokens : int, optional
+        Tokens of the newest messages kept as they are, by default half the threshold
+    keep_last : int, optional
+        Number of newest messages that are never compacted, by default 4
+    max_words : int, optional
+        Maximum length of the summary, by default 200
+    max_concurrency : int, optional
+        The number of summaries generated at the same time, by default 2
+    max_pending : int, optional
+        The maximum number of compactions waiting or in process. Conversations
+        aren't compacted while it's reached (they're trimmed instead). By default 100
+    on_start : Callable, optional
+        Coroutine function awaited in the loop of the compactor when it starts.
+    on_stop : Callable, optional
+        Coroutine function awaited in the loop of the compactor when it stops.
+    name : str, optional
+        Name of the compactor used for its thread and its logs, by default "compaction"
+    """
+
+    def __init__(
+        self,
+        complete: Callable[[List[dict]], Awaitable[str]],
+        threshold_tokens: int = 2000,
+        keep_tokens: int = None,
+        keep_last: int = 4,
+        max_words: int = 200,
+        max_concurrency: int = 2,
+        max_pending: int = 100,
+        on_start: Callable[[], Awaitable] = None,
+        on_stop: Callable[[], Awaitable] = None,
+        name: str = "compaction",
+    ):
+        self.complete = complete
+        self.threshold_tokens = threshold_tokens
+        self.keep_tokens = threshold_tokens // 2 if keep_tokens is None else keep_tokens
+        self.keep_last = keep_last
+        self.max_words = max_words
+        self.max_concurrency = max_concurrency
+        self.max_pending = max_pending
+        self.on_start = on_start
+        self.on_stop = on_stop
+        self.name = name
+        self.background = BackgroundLoop(name=name)
+        self._semaphore = None
+        self._pending = 0
+        self._lock = threading.Lock()
+        self._start_lock = threading.Lock()
+        self._started = False
+        self.compacted = 0
+        self.failed = 0
+        self.rejected = 0
+
+    @property
+    def running(self) -> bool:
+        return self.background.running
+
+    def start(self):
+        with self._start_lock:
+            if self._started:
+                return self
+            self.background.start()
+            self.background.submit(self._start()).result()
+            self._started = True
+        logger.info(f"Started conversation compactor '{self.name}'")
+        return self
+
+    async def _start(self):
+        if self.on_start is not None:
+            await self.on_start()
+        self._semaphore = asyncio.Semaphore(self.max_concurrency)
+
+    def maybe_compact(self, chat) -> bool:
+        """
+        Schedules the compaction of the chat if its messages take more than the
+        threshold. Returns immediately, True if a compaction was scheduled.
+        """
+        if chat._compacting or chat._pending_summary is not None:
+            return False
+        if sum(chat.message_tokens[1:]) <= self.threshold_tokens:
+            return False
+        span = chat.compaction_span(self.keep_tokens, keep_last=self.keep_last)
+        # the summary (if any) is the first message of the span
+        previous = chat.summary if chat.summary is not None and span and span[0] is chat.messages[1] else None
+        new_messages = span[1:] if previous is not None else span
+        if len(new_messages) < 2:
+            return False
+        with self._lock:
+            if self._pending >= self.max_pending:
+                self.rejected += 1
+                COMPACTIONS.inc(outcome="rejected")
+                return False
+            self._pending += 1
+        chat._compacting = True
+        self.start()
+        self.background.submit(self._compact(chat, previous, new_messages, span))
+        return True
+
+    async def _compact(self, chat, previous: str, new_messages: List[dict], span: List[dict]):
+        try:
+            async with self._semaphore:
+                with time_upstream("openai_summary"):
+                    summary = await self.complete(summary_prompt(previous, new_messages, self.max_words))
+            chat.set_pending_summary(summary.strip(), span)
+            self.compacted += 1
+            COMPACTIONS.inc(outcome="ok")
+            logger.debug("Summarized %d messages of %s", len(new_messages), chat.sender.phone_number)
+        except Exception as e:
+            self.failed += 1
+            COMPACTIONS.inc(outcome="error")
+            logger.warning(f"Could not summarize the conversation of {chat.sender.phone_number}: {e!r}")
+        finally:
+            chat._compacting = False
+            with self._lock:
+                self._pending -= 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            pending = self._pending
+        return dict(
+            name=self.name,
+            running=self.running,
+            threshold_tokens=self.threshold_tokens,
+            pending=pending,
+            compacted=self.compacted,
+            failed=self.failed,
+            rejected=self.rejected,
+        )
+
+    def stop(self, timeout: float = None):
+        with self._start_lock:
+            if not self._started:
+                return
+            if self.on_stop is not None:
+                self.background.submit(self.on_stop()).result(timeout)
+            self.background.stop(timeout)
+            self._started = False
@@ -1,12 +1,23 @@
+import asyncio
 import logging
 import re
+import threading
+import openai
+from collections import OrderedDict
+from contextlib import AsyncExitStack
+from app.image_jobs import QUEUE_FULL, QUOTA_EXCEEDED, ImageJob, ImageJobService
+from app.metrics import IMAGES, time_upstream
 from app.whatsapp.chat import OpenAIChatManager
 from chat.clients import ChatClient
-from typing import Tuple
+from chat.clients.twilio.twilio_whatsapp import MAX_BODY_LENGTH
+from typing import AsyncIterable, AsyncIterator, Iterable, Iterator, List, Tuple
 
-from chat.handlers.assemblyai.audio_transcription import transcribe_audio, supported_language_codes
-from chat.handlers.openai.completions import language_detection
+from chat.handlers.assemblyai.audio_transcription import atranscribe_audio, aupload_audio, get_session as get_assemblyai_session, supported_language_codes
+from chat.handlers.openai.completions import alanguage_detection
 from chat.handlers.openai import text_to_image as dalle_text_to_image
+from chat.handlers.langid import identify_language
+from chat.handlers.media import afetch_media
+from chat.handlers.transcription_cache import TranscriptionCache
 
 def verify_image_generation(msg: str) -> Tuple[str, bool]:
     """
@@ -33,7 +44,80 @@ def verify_image_generation(msg: str) -> Tuple[str, bool]:
     logging.info(f"Image generation prompt: '{img_generation_prompt}'")
     return new_msg, img_generation_prompt
 
-def verify_and_process_media(message, chat:OpenAIChatManager, check_language:bool=False) -> str:
+_sentence_end = re.compile(r"[.!?…](?:[\"')\]]*)\s+|\n")
+
+class ReplySplitter:
+    """
+    Groups the pieces of a streamed reply into messages that can be sent as soon as they are complete.
+    A message is cut at the end of a paragraph, or at the end of a sentence once it has
+    at least `min_length` characters, and it never exceeds `max_length` characters.
+    Image generation prompts ([img: "..."]) are never split.
+    """
+
+    def __init__(self, min_length: int = 120, max_length: int = MAX_BODY_LENGTH):
+        self.min_length = min_length
+        self.max_length = max_length
+        self.buffer = ""
+
+    def feed(self, delta: str) -> List[str]:
+        """Adds a piece of the reply and returns the messages that are complete"""
+        self.buffer += delta
+        chunks = []
+        while (cut := _find_cut(self.buffer, self.min_length, self.max_length)) is not None:
+            chunk, self.buffer = self.buffer[:cut].strip(), self.buffer[cut:]
+            if chunk:
+                chunks.append(chunk)
+        return chunks
+
+    def flush(self) -> List[str]:
+        """Returns the remaining messages once the reply is complete"""
+        chunks = []
+        while self.buffer.strip():
+            cut = _find_cut(self.buffer, len(self.buffer), self.max_length) or len(self.buffer)
+            chunk, self.buffer = self.buffer[:cut].strip(), self.buffer[cut:]
+            if chunk:
+                chunks.append(chunk)
+        self.buffer = ""
+        return chunks
+
+def split_reply_stream(deltas: Iterable[str], min_length: int = 120, max_length: int = MAX_BODY_LENGTH) -> Iterator[str]:
+    """Splits a streamed reply into messages (see `ReplySplitter`)"""
+    splitter = ReplySplitter(min_length, max_length)
+    for delta in deltas:
+        yield from splitter.feed(delta)
+    yield from splitter.flush()
+
+async def asplit_reply_stream(deltas: AsyncIterable[str], min_length: int = 120, max_length: int = MAX_BODY_LENGTH) -> AsyncIterator[str]:
+    """Splits an async streamed reply into messages (see `ReplySplitter`)"""
+    splitter = ReplySplitter(min_length, max_length)
+    async for delta in deltas:
+        for chunk in splitter.feed(delta):
+            yield chunk
+    for chunk in splitter.flush():
+        yield chunk
+
+def _find_cut(text: str, min_length: int, max_length: int) -> int:
+    """Returns where to cut the text to send the first part of it or None if it should wait for more"""
+    open_tag = text.rfind("[", 0, max_length)
+    limit = max_length
+    if open_tag != -1 and "]" not in text[open_tag:max_length]:
+        limit = open_tag  # don't cut inside an unfinished tag
+    paragraph = text.find("\n\n", 0, limit)
+    if paragraph > 0:
+        return paragraph + 2
+    cut = None
+    for match in _sentence_end.finditer(text, 0, limit):
+        if match.end() >= min_length:
+            return match.end()
+        cut = match.end()
+    if len(text) >= max_length:
+        # the text doesn't fit in one message, cut at the last sentence or word
+        if cut is None:
+            cut = text.rfind(" ", 0, limit) + 1 or limit
+        return cut or max_length
+    return None
+
+async def verify_and_process_media(message, chat:OpenAIChatManager, check_language:bool=False, transcription_options:dict=None, transcription_cache:TranscriptionCache=None) -> str:
     """Processes media messages"""
     if message.media is not None: # if the message contains media
         if message.media.is_audio and chat.voice_transcription:
@@ -41,10 +125,7 @@ def verify_and_process_media(message, chat:OpenAIChatManager, check_language:boo
             chat.logger.info(f"Message contains audio, attempting to transcribe it with language='{chat.transcription_language}'")
             # msg = whisper_transcription(message.media.url, url=True, language=chat.transcription_language)
             try:
-                msg = transcribe_audio(message.media.url, language_code=chat.transcription_language, chat=chat, as_json=True)
-                if msg is None:
-                    return None
-                msg = msg.get("text", None)
+                msg = await transcribe_voice_note(message.media.url, chat, transcription_options, transcription_cache)
             except Exception as e:
                 chat.logger.error(f"Audio transcription failed: with url {message.media.url} and language {chat.transcription_language}")
                 chat.logger.error(f"Error while transcribing audio: {e}")
@@ -62,6 +143,37 @@ def verify_and_process_media(message, chat:OpenAIChatManager, check_language:boo
         msg = message.body
     return msg
 
+async def transcribe_voice_note(media_url:str, chat:OpenAIChatManager, transcription_options:dict=None, cache:TranscriptionCache=None) -> str:
+    """
+    Transcribes the audio of the url with AssemblyAI. If a cache is given, the audio is downloaded
+    once to look up its transcription (e.g. of forwarded voice notes) and, if it isn't cached,
+    the downloaded audio is uploaded for transcription instead of being fetched again from the url.
+    """
+    if cache is None:
+        return await _transcribe_audio_url(media_url, chat, transcription_options)
+    async with AsyncExitStack() as stack:
+        with time_upstream("twilio_media"):
+            media = await stack.enter_async_context(afetch_media(media_url, session=get_assemblyai_session()))
+        key = cache.make_key(media.sha256, chat.transcription_language, "assemblyai")
+        text = cache.get(key, audio_size=media.size)
+        if text is not None:
+            chat.logger.info(f"Found cached transcription of audio {media.sha256[:12]}")
+            return text
+        with time_upstream("assemblyai"):
+            audio_url = await aupload_audio(media.file)
+    text = await _transcribe_audio_url(audio_url, chat, transcription_options)
+    cache.put(key, text)
+    return text
+
+async def _transcribe_audio_url(audio_url:str, chat:OpenAIChatManager, transcription_options:dict=None) -> str:
+    with time_upstream("assemblyai"):
+        transcription = await atranscribe_audio(
+            audio_url, language_code=chat.transcription_language, chat=chat, as_json=True,
+            **(transcription_options or {}))
+    if transcription is None:
+        return None
+    return transcription.get("text", None)
+
 def check_conversation_end(message:str, chat:OpenAIChatManager) -> bool:
     """Checks if the conversation should end"""
     if message.lower().strip() in chat.end_conversation_phrases:
@@ -69,23 +181,86 @@ def check_conversation_end(message:str, chat:OpenAIChatManager) -> bool:
         return True
     return False
 
-async def check_and_send_image_generation(prompt: str, chat:OpenAIChatManager, client:ChatClient):
-    if chat.num_images_generated > chat.max_image_generations:
-        chat.add_message("This user has surpassed their maximum number of images generated. Images will no longer be sent.", role="system")
-        client.send_message("[You have reached the maximum number of images that you can generate.]", chat.sender.phone_number)
-        return False
-    # generate the image and send it to the user
-    chat.logger.info(f"Generating image for prompt: {prompt}")
-    img_url = await dalle_text_to_image(prompt, as_url=True)
+async def check_and_send_image_generation(prompt: str, chat:OpenAIChatManager, client:ChatClient, image_jobs:ImageJobService=None):
+    """
+    Generates the image of the prompt and sends it to the user. If an image job service
+    is given, the image is generated and sent in the background and this returns right away.
+    Returns False if the image is not going to be sent.
+    """
+    if image_jobs is None:
+        if chat.num_images_generated >= chat.max_image_generations:
+            IMAGES.inc(outcome=QUOTA_EXCEEDED)
+            return await _reject_image_generation(chat, client)
+        # generate the image and send it to the user
+        chat.logger.info(f"Generating image for prompt: {prompt}")
+        IMAGES.inc(outcome="generated")
+        with time_upstream("openai_images"):
+            img_url = await dalle_text_to_image(prompt, as_url=True)
+        img_body = prompt if chat.caption_images else None
+        await client.send_message_async(img_body, chat.sender.phone_number, media_url=img_url, media_type='image')
+        chat.num_images_generated += 1
+        return True
+    phone_number = chat.sender.phone_number
     img_body = prompt if chat.caption_images else None
-    await client.send_message_async(img_body, chat.sender.phone_number, media_url=img_url, media_type='image')
-    chat.num_images_generated += 1
+    async def deliver(img_url):
+        await client.send_message_async(img_body, phone_number, media_url=img_url, media_type='image')
+    def on_failure(exception):
+        asyncio.ensure_future(client.send_message_async("[Sorry, the image could not be generated. Please try again later.]", phone_number))
+    status = image_jobs.submit(ImageJob(prompt, phone_number, deliver, on_failure), chat=chat)
+    IMAGES.inc(outcome=status)
+    if status == QUOTA_EXCEEDED:
+        return await _reject_image_generation(chat, client)
+    if status == QUEUE_FULL:
+        chat.logger.warning(f"Image queue is full, not generating image for {phone_number}")
+        await client.send_message_async("[Too many images are being generated right now. Please try again later.]", phone_number)
+        return False
+    chat.logger.info(f"Queued image generation for prompt: {prompt}")
+    return True
+
+async def _reject_image_generation(chat:OpenAIChatManager, client:ChatClient) -> bool:
+    chat.add_message("This user has surpassed their maximum number of images generated. Images will no longer be sent.", role="system")
+    await client.send_message_async("[You have reached the maximum number of images that you can generate.]", chat.sender.phone_number)
+    return False
+
+# languages detected for each sender (most recently used last), shared by the event loops and request threads
+_sender_languages = OrderedDict()
+_sender_languages_lock = threading.Lock()
+MAX_CACHED_LANGUAGES = 10000
+
+async def detect_language(text:str, sender:str=None, min_confidence:float=0.8, logger=None) -> str:
+    """
+    Detects the language of the text with the local identifier and only asks
+    the language model when its confidence is lower than `min_confidence`.
+    Detections are cached for each sender.
+    """
+    logger = logger or logging.getLogger(__name__)
+    if sender is not None:
+        with _sender_languages_lock:
+            if sender in _sender_languages:
+                _sender_languages.move_to_end(sender)
+                return _sender_languages[sender]
+    lang, confidence = identify_language(text)
+    logger.info(f"Identified language {lang} with confidence {confidence:.2f}")
+    if confidence < min_confidence:
+        ld_examples = [('I am a cat', 'english'), ('Ich bin ein Kater', 'german'), ('Soy un gato', 'spanish'), ('', 'english'), ('asiodnajkc', 'english')]
+        try:
+            with time_upstream("openai_language_detection"):
+                lang = await alanguage_detection(text, examples=ld_examples)
+        except openai.error.OpenAIError as e:
+            # keep the guess of the local identifier rather than failing the message
+            logger.warning(f"Language detection failed, using the identified language {lang}: {e!r}")
+    if sender is not None:
+        with _sender_languages_lock:
+            _sender_languages[sender] = lang
+            _sender_languages.move_to_end(sender)
+            while len(_sender_languages) > MAX_CACHED_LANGUAGES:
+                _sender_languages.popitem(last=False)
+    return lang
 
-async def ensure_user_language(chat:OpenAIChatManager, text:str=None):
+async def ensure_user_language(chat:OpenAIChatManager, text:str=None, min_confidence:float=0.8):
     """Ensures the user language is set accordingly in the chat based on the user's messages"""
     chat.logger.info(f"Checking user language for chat")
     lang = None
-    ld_examples = [('I am a cat', 'english'), ('Ich bin ein Kater', 'german'), ('Soy un gato', 'spanish'), ('', 'english'), ('asiodnajkc', 'english')]
     if text is None:
         for msg in chat.messages:
             if msg['role'].lower() == 'user':
@@ -93,7 +268,7 @@ async def ensure_user_language(chat:OpenAIChatManager, text:str=None):
                 break
     if text is None:
         return False
-    lang = language_detection(text, examples=ld_examples)
+    lang = await detect_language(text, chat.sender.phone_number, min_confidence=min_confidence, logger=chat.logger)
     chat.logger.info(f"Detected language: {lang}")
     if lang != chat.language:
         chat.logger.info(f"Changing language from {chat.language} to {lang}")
@@ -0,0 +1,274 @@
+"""
+Background generation and delivery of images.
+
+Image generation takes several seconds, so the webhook only hands the prompt
+to the `ImageJobService` and returns. The service runs a fixed number of
+async workers in its own event loop, which take the jobs from per-sender FIFO
+queues in round-robin so a sender asking for many images can't delay the
+images of everyone else. Identical prompts (after normalization) are only
+generated once while their URL is cached or while they're being generated,
+and the image quota of every chat is checked and charged atomically when the
+job is accepted.
+"""
+import asyncio
+import logging
+import re
+import threading
+import time
+from collections import OrderedDict, deque
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable, Optional
+
+from app.metrics import time_upstream
+from app.whatsapp.sessions import SessionCache
+from app.workers import BackgroundLoop
+
+logger = logging.getLogger(__name__)
+
+__all__ = [
+    "ImageJob",
+    "ImageJobService",
+    "normalize_prompt",
+]
+
+# results of `ImageJobService.submit`
+ACCEPTED = "accepted"
+QUOTA_EXCEEDED = "quota_exceeded"
+QUEUE_FULL = "queue_full"
+
+_spaces = re.compile(r"\s+")
+
+
+def normalize_prompt(prompt: str) -> str:
+    """Normalizes a prompt so that trivially different prompts share the same image"""
+    return _spaces.sub(" ", prompt.strip().strip("\"'.!").lower())
+
+
+@dataclass
+class ImageJob:
+    prompt: str
+    sender: str
+    # coroutine function called with the url of the generated image
+    deliver: Callable[[str], Awaitable]
+    # called (from the loop of the service) if the image couldn't be generated or delivered
+    on_failure: Optional[Callable[[Exception], None]] = None
+    created_at: float = field(default_factory=time.monotonic)
+
+    @property
+    def key(self) -> str:
+        return normalize_prompt(self.prompt)
+
+
+class ImageJobService:
+    """
+    A bounded pool of workers generating and delivering images.
+
+    Parameters
+    ----------
+    generate : Callable
+        Coroutine function returning the url of the image generated for a prompt.
+    max_concurrency : int, optional
+        The number of images generated at the same time, by default 2
+    max_queue_size : int, optional
+        The maximum number of jobs waiting across all the senders. Jobs submitted
+        when the queue is full are rejected. By default 100
+    cache_ttl : float, optional
+        Seconds the url of a generated image is reused for the same prompt,
+        by default 1800 (the urls returned by DALL-E expire after an hour)
+    cache_max_entries : int, optional
+        Maximum number of cached urls, by default 1024
+    on_start : Callable, optional
+        Coroutine function awaited in the loop of the workers when the service starts.
+    on_stop : Callable, optional
+        Coroutine function awaited in the loop of the workers when the service stops.
+    name : str, optional
+        Name of the service used for its thread and its logs, by default "image-jobs"
+    """
+
+    def __init__(
+        self,
+        generate: Callable[[str], Awaitable[str]],
+        max_concurrency: int = 2,
+        max_queue_size: int = 100,
+        cache_ttl: float = 30 * 60,
+        cache_max_entries: int = 1024,
+        on_start: Callable[[], Awaitable] = None,
+        on_stop: Callable[[], Awaitable] = None,
+        name: str = "image-jobs",
+    ):
+        self.generate = generate
+        self.max_concurrency = max_concurrency
+        self.max_queue_size = max_queue_size
+        self.on_start = on_start
+        self.on_stop = on_stop
+        self.name = name
+        self.cache = SessionCache(ttl=cache_ttl, max_entries=cache_max_entries)
+        self.background = BackgroundLoop(name=name)
+        self._queues = OrderedDict()  # sender -> deque of jobs, in round-robin order
+        self._queued = 0
+        self._lock = threading.Lock()
+        self._start_lock = threading.Lock()
+        self._started = False
+        self._available = None  # semaphore counting the queued jobs
+        self._in_flight = {}  # normalized prompt -> future of its url
+        self._workers = []
+        self.generated = 0
+        self.cache_hits = 0
+        self.delivered = 0
+        self.failed = 0
+        self.rejected = 0
+
+    @property
+    def running(self) -> bool:
+        return self.background.running
+
+    def start(self):
+        with self._start_lock:
+            if self._started:
+                return self
+            self.background.start()
+            self.background.submit(self._start_workers()).result()
+            self._started = True
+        logger.info(f"Started image job service '{self.name}' with {self.max_concurrency} workers")
+        return self
+
+    async def _start_workers(self):
+        if self.on_start is not None:
+            await self.on_start()
+        self._available = asyncio.Semaphore(0)
+        self._workers = [asyncio.ensure_future(self._worker(i)) for i in range(self.max_concurrency)]
+
+    def submit(self, job: ImageJob, chat=None, max_images: int = None) -> str:
+        """
+        Enqueues an image job from any thread without waiting for it.
+
+        If a chat is given, its image quota (`num_images_generated` against
+        `max_images`, by default its `max_image_generations`) is checked and charged
+        atomically with the acceptance of the job, and refunded if the image can't
+        be generated.
+        Returns "accepted", "quota_exceeded" or "queue_full".
+        """
+        if not self._started:
+            self.start()
+        with self._lock:
+            if chat is not None:
+                if max_images is None:
+                    max_images = chat.max_image_generations
+                if chat.num_images_generated >= max_images:
+                    return QUOTA_EXCEEDED
+            if self._queued >= self.max_queue_size:
+                self.rejected += 1
+                return QUEUE_FULL
+            if chat is not None:
+                chat.num_images_generated += 1
+                job.on_failure = _refunding(chat, self._lock, job.on_failure)
+            self._queues.setdefault(job.sender, deque()).append(job)
+            self._queued += 1
+        self.background.call_soon(self._available.release)
+        return ACCEPTED
+
+    def _next_job(self) -> ImageJob:
+        """Pops the oldest job of the next sender in round-robin order"""
+        with self._lock:
+            sender, queue = next(iter(self._queues.items()))
+            job = queue.popleft()
+            del self._queues[sender]
+            if queue:
+                # the sender goes to the back of the line
+                self._queues[sender] = queue
+            self._queued -= 1
+        return job
+
+    async def _worker(self, index: int):
+        while True:
+            await self._available.acquire()
+            job = self._next_job()
+            try:
+                url = await self._image_url(job.prompt)
+                with time_upstream("twilio"):
+                    await job.deliver(url)
+                self.delivered += 1
+                logger.info(
+                    f"Delivered image to {job.sender} {time.monotonic() - job.created_at:.2f} seconds after it was requested"
+                )
+            except Exception as e:
+                self.failed += 1
+                logger.exception(f"Worker {index} of '{self.name}' failed generating an image: {e}")
+                if job.on_failure is not None:
+                    try:
+                        job.on_failure(e)
+                    except Exception:
+                        logger.exception(f"Failure callback of an image job of {job.sender} failed")
+
+    async def _image_url(self, prompt: str) -> str:
+        """Returns the url of the image of the prompt, generating it only if it's not cached or being generated"""
+        key = normalize_prompt(prompt)
+        url = self.cache.get(key, touch=False)
+        if url is not None:
+            self.cache_hits += 1
+            return url
+        future = self._in_flight.get(key)
+        if future is not None:
+            self.cache_hits += 1
+            return await asyncio.shield(future)
+        future = asyncio.get_event_loop().create_future()
+        self._in_flight[key] = future
+        try:
+            with time_upstream("openai_images"):
+                url = await self.generate(prompt)
+            if url is None:
+                raise ValueError(f"No image was generated for prompt '{prompt}'")
+            self.generated += 1
+            self.cache.put(key, url)
+            future.set_result(url)
+            return url
+        except Exception as e:
+            future.set_exception(e)
+            # the exception is raised to this job, don't warn if no other job awaits it
+            future.exception()
+            raise
+        finally:
+            del self._in_flight[key]
+
+    def stats(self) -> dict:
+        with self._lock:
+            queued, senders = self._queued, len(self._queues)
+        return dict(
+            name=self.name,
+            running=self.running,
+            workers=self.max_concurrency,
+            queue_depth=queued,
+            queued_senders=senders,
+            max_queue_size=self.max_queue_size,
+            in_flight=len(self._in_flight),
+            generated=self.generated,
+            cache_hits=self.cache_hits,
+            delivered=self.delivered,
+            failed=self.failed,
+            rejected=self.rejected,
+        )
+
+    def stop(self, timeout: float = None):
+        with self._start_lock:
+            if not self._started:
+                return
+            self.background.submit(self._stop_workers()).result(timeout)
+            self.background.stop(timeout)
+            self._started = False
+
+    async def _stop_workers(self):
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        if self.on_stop is not None:
+            await self.on_stop()
+
+
+def _refunding(chat, lock: threading.Lock, on_failure: Callable = None) -> Callable:
+    """Wraps the failure callback of a job to give back the image charged to the chat"""
+    def callback(exception: Exception):
+        with lock:
+            chat.num_images_generated = max(0, chat.num_images_generated - 1)
+        if on_failure is not None:
+            on_failure(exception)
+    return callback
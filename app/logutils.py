@@ -0,0 +1,165 @@
+"""
+Logging that stays off the request path.
+
+`configure_logging` routes every record through a `QueueHandler`, so the
+request threads and event loops only put records in a queue while a
+`QueueListener` thread formats and writes them. The message of a record is
+built on the thread that logs it (so mutable arguments are captured as they
+were when logged), but only if the record passes the level and sampling checks
+(`logger.info(..., extra={"event": "request"})`), and it's cut to a maximum size
+before it's queued. Full conversation transcripts are only logged for the
+senders selected with `TranscriptSelector`.
+"""
+import atexit
+import copy
+import logging
+import logging.handlers
+import queue
+import random
+from typing import Callable, Dict
+
+__all__ = [
+    "configure_logging",
+    "lazy",
+    "parse_sample_rates",
+    "LazyQueueHandler",
+    "SamplingFilter",
+    "TranscriptSelector",
+    "TruncatingFormatter",
+]
+
+DEFAULT_FORMAT = "%(levelname)s:%(name)s:%(message)s"
+
+
+class lazy:
+    """
+    Skips a (costly) call when the record isn't logged (it's below the level or sampled out), e.g.
+    `logger.debug("Conversation:\\n%s", lazy(chat.get_conversation))`.
+    Otherwise it's called on the thread that logs the record.
+    """
+
+    __slots__ = ("func", "args")
+
+    def __init__(self, func: Callable, *args):
+        self.func = func
+        self.args = args
+
+    def __str__(self) -> str:
+        return str(self.func(*self.args))
+
+    __repr__ = __str__
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Keeps only a fraction of the records of each event (given with `extra={"event": ...}`).
+    Records of events without a rate, and warnings and errors, are always kept.
+    """
+
+    def __init__(self, rates: Dict[str, float] = None):
+        super().__init__()
+        self.rates = rates or {}
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.WARNING:
+            return True
+        rate = self.rates.get(getattr(record, "event", None))
+        return rate is None or random.random() < rate
+
+
+def _truncate(message: str, max_chars: int = None) -> str:
+    if max_chars and len(message) > max_chars:
+        return f"{message[:max_chars]}... [{len(message) - max_chars} more characters]"
+    return message
+
+
+class TruncatingFormatter(logging.Formatter):
+    """Formats the records and cuts messages longer than `max_chars`"""
+
+    def __init__(self, fmt: str = DEFAULT_FORMAT, max_chars: int = 4000, **kwargs):
+        super().__init__(fmt, **kwargs)
+        self.max_chars = max_chars
+
+    def formatMessage(self, record: logging.LogRecord) -> str:
+        record.message = _truncate(record.message, self.max_chars)
+        return super().formatMessage(record)
+
+
+class LazyQueueHandler(logging.handlers.QueueHandler):
+    """
+    A queue handler that only merges the arguments into the message of the records
+    (cut to `max_chars`) in the logging thread, leaving the formatting (unlike
+    `QueueHandler`) to the listener.
+    """
+
+    def __init__(self, queue, max_chars: int = None):
+        super().__init__(queue)
+        self.max_chars = max_chars
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record = copy.copy(record)
+        # the arguments (e.g. the messages of a chat) may change or be used by
+        # other threads once the call returns, so they're rendered here
+        record.msg = _truncate(record.getMessage(), self.max_chars)
+        record.args = None
+        if record.exc_info:
+            # tracebacks must be rendered while the frames are alive
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+def parse_sample_rates(value: str = None) -> Dict[str, float]:
+    """Parses sample rates given as "event=rate,event=rate" (e.g. "request=0.1")"""
+    rates = {}
+    for item in (value or "").split(","):
+        if "=" in item:
+            event, rate = item.split("=", 1)
+            rates[event.strip()] = float(rate)
+    return rates
+
+
+class TranscriptSelector:
+    """
+    The senders whose full conversations are logged, given as comma-separated
+    phone numbers (with or without the "whatsapp:" prefix) or "*" for everyone.
+    """
+
+    def __init__(self, senders: str = None):
+        numbers = {number.strip() for number in (senders or "").split(",") if number.strip()}
+        self.everyone = "*" in numbers
+        self.numbers = {number.split(":")[-1] for number in numbers}
+
+    def __contains__(self, phone_number: str) -> bool:
+        return self.everyone or (bool(self.numbers) and phone_number.split(":")[-1] in self.numbers)
+
+
+def configure_logging(
+    level: str = "INFO",
+    max_chars: int = 4000,
+    sample_rates: Dict[str, float] = None,
+    fmt: str = DEFAULT_FORMAT,
+) -> logging.handlers.QueueListener:
+    """
+    Makes the root logger (with the given level) write through a queue to stderr from
+    a background thread. Returns the listener (which is stopped, flushing the queue, at exit).
+    """
+    handler = logging.StreamHandler()
+    handler.setFormatter(TruncatingFormatter(fmt, max_chars=max_chars))
+    records = queue.SimpleQueue()
+    queue_handler = LazyQueueHandler(records, max_chars=max_chars)
+    queue_handler.addFilter(SamplingFilter(sample_rates))
+    root = logging.getLogger()
+    for existing in list(root.handlers):
+        root.removeHandler(existing)
+    root.addHandler(queue_handler)
+    root.setLevel(level)
+    listener = logging.handlers.QueueListener(records, handler, respect_handler_level=True)
+    listener.start()
+    atexit.register(_stop_listener, listener)
+    return listener
+
+
+def _stop_listener(listener: logging.handlers.QueueListener):
+    if listener._thread is not None:
+        listener.stop()
@@ -0,0 +1,384 @@
+"""
+Long-term memory of what every sender said in past conversations.
+
+The user and assistant messages of the conversations (from their message
+info) are embedded in batches in the background and appended to an index
+sharded by phone number. Every shard is a raw float32 file of normalized
+embeddings, one row per snippet, read through a memory map, and a JSON lines
+file with the snippet of every row. Both files are only ever appended to, so
+adding snippets never rewrites the existing data. The rows of every sender
+are kept in memory, so finding the snippets most relevant to a new message
+only reads (and multiplies) the rows of that sender.
+
+Usage
+-----
+>>> memory = MemoryStore("data/memory", embed=atext_embedding)
+>>> memory.remember(chat.sender.phone_number, chat.message_info)
+>>> memory.search(chat.sender.phone_number, embedding, k=3)
+[(0.91, {"role": "user", "content": "My daughter is called Ana", ...}), ...]
+"""
+import asyncio
+import atexit
+import json
+import logging
+import os
+import threading
+import time
+import zlib
+from collections import defaultdict
+from typing import Awaitable, Callable, Dict, List, Sequence, Tuple
+
+import numpy as np
+
+from app.workers import BackgroundLoop
+
+logger = logging.getLogger(__name__)
+
+__all__ = [
+    "MemoryStore",
+    "format_memories",
+]
+
+
+def format_memories(memories: List[Tuple[float, dict]], max_chars: int = 300) -> str:
+    """Returns the snippets as the content of the system message added to the prompt"""
+    lines = [
+        f"- {snippet['role'].upper()} ({snippet.get('timestamp', '')[:10]}): {snippet['content'][:max_chars]}"
+        for _, snippet in memories
+    ]
+    return "Messages of earlier conversations with the user that may be relevant:\n" + "\n".join(lines)
+
+
+class _Shard:
+    """The rows of a shard: an append-only file of vectors and one of snippets"""
+
+    def __init__(self, path: str, dim: int):
+        self.vectors_path = f"{path}.f32"
+        self.snippets_path = f"{path}.jsonl"
+        self.dim = dim
+        self.snippets: List[dict] = []
+        self.rows: Dict[str, List[int]] = defaultdict(list)  # sender -> rows
+        self._map = None
+        self._mapped_rows = 0
+        self.lock = threading.Lock()
+        self._load()
+
+    def _load(self):
+        good_bytes = 0
+        try:
+            with open(self.snippets_path, "rb") as f:
+                for line in f:
+                    try:
+                        snippet = json.loads(line)
+                    except ValueError:
+                        break  # a line cut by a crash, it and the rest are dropped
+                    if not line.endswith(b"\n"):
+                        break
+                    self.rows[snippet["sender"]].append(len(self.snippets))
+                    self.snippets.append(snippet)
+                    good_bytes += len(line)
+        except FileNotFoundError:
+            pass
+        vector_bytes = os.path.getsize(self.vectors_path) if os.path.exists(self.vectors_path) else 0
+        num_rows = min(len(self.snippets), vector_bytes // (4 * self.dim))
+        if num_rows < len(self.snippets):
+            # vectors are written before their snippets, so this is only a corrupt file
+            for snippet in self.snippets[num_rows:]:
+                self.rows[snippet["sender"]].pop()
+            del self.snippets[num_rows:]
+            good_bytes = sum(len(json.dumps(s)) + 1 for s in self.snippets)
+        # drop what a crash left half-written so the next appends stay aligned
+        if os.path.exists(self.snippets_path) and os.path.getsize(self.snippets_path) != good_bytes:
+            os.truncate(self.snippets_path, good_bytes)
+        if vector_bytes != num_rows * 4 * self.dim:
+            os.truncate(self.vectors_path, num_rows * 4 * self.dim)
+
+    def append(self, vectors: np.ndarray, snippets: List[dict]):
+        with open(self.vectors_path, "ab") as f:
+            f.write(np.ascontiguousarray(vectors, dtype=np.float32).tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+        with open(self.snippets_path, "a", encoding="utf-8") as f:
+            for snippet in snippets:
+                f.write(json.dumps(snippet) + "\n")
+        with self.lock:
+            for snippet in snippets:
+                self.rows[snippet["sender"]].append(len(self.snippets))
+                self.snippets.append(snippet)
+
+    def vectors(self, rows: np.ndarray) -> np.ndarray:
+        """Returns the vectors of the rows (remapping the file if it grew)"""
+        needed = int(rows.max()) + 1
+        if needed > self._mapped_rows:
+            num_rows = len(self.snippets)
+            self._map = np.memmap(self.vectors_path, dtype=np.float32, mode="r", shape=(num_rows, self.dim))
+            self._mapped_rows = num_rows
+        return self._map[rows]
+
+
+class MemoryStore:
+    """
+    A per-sender index of the snippets of past conversations.
+
+    Parameters
+    ----------
+    directory : str
+        Directory of the files of the index.
+    embed : Callable
+        Coroutine function returning the embeddings of a list of texts.
+    num_shards : int, optional
+        Number of shards the senders are split in, by default 16
+    batch_size : int, optional
+        Maximum number of snippets embedded in a request, by default 64
+    flush_interval : float, optional
+        Seconds the snippets wait to be embedded with others, by default 2
+    min_chars : int, optional
+        Messages shorter than this (e.g. "ok thanks") aren't remembered, by default 20
+    max_chars : int, optional
+        Messages are cut to this length before being embedded, by default 1000
+    max_pending : int, optional
+        Maximum number of snippets waiting to be embedded; the oldest ones are
+        dropped after it, by default 10000
+    on_start : Callable, optional
+        Coroutine function awaited in the loop of the store when it starts.
+    on_stop : Callable, optional
+        Coroutine function awaited in the loop of the store when it stops.
+    name : str, optional
+        Name of the store used for its thread and its logs, by default "memory"
+    """
+
+    def __init__(
+        self,
+        directory: str,
+        embed: Callable[[List[str]], Awaitable[List[Sequence[float]]]],
+        num_shards: int = 16,
+        batch_size: int = 64,
+        flush_interval: float = 2.0,
+        min_chars: int = 20,
+        max_chars: int = 1000,
+        max_pending: int = 10000,
+        on_start: Callable[[], Awaitable] = None,
+        on_stop: Callable[[], Awaitable] = None,
+        name: str = "memory",
+    ):
+        self.directory = directory
+        self.embed = embed
+        self.num_shards = num_shards
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.min_chars = min_chars
+        self.max_chars = max_chars
+        self.max_pending = max_pending
+        self.on_start = on_start
+        self.on_stop = on_stop
+        self.name = name
+        os.makedirs(directory, exist_ok=True)
+        index = self._read_index()
+        self.dim = index.get("dim")
+        if index.get("num_shards", num_shards) != num_shards:
+            # the senders would be looked up in other shards
+            logger.warning(f"The memory in {directory} has {index['num_shards']} shards, using them")
+            self.num_shards = index["num_shards"]
+        self._shards: Dict[int, _Shard] = {}
+        if self.dim is not None:
+            for i in range(self.num_shards):
+                self._shards[i] = _Shard(self._shard_path(i), self.dim)
+            logger.info(f"Loaded {len(self)} snippets of the memory in {directory}")
+        self._pending: List[dict] = []
+        self._lock = threading.Lock()
+        self._start_lock = threading.Lock()
+        self._started = False
+        self._wakeup = None
+        self._task = None
+        self.background = BackgroundLoop(name=name)
+        self.embedded = 0
+        self.dropped = 0
+        self.failed_batches = 0
+        self.searches = 0
+        self.recalled = 0
+        self.search_seconds = 0.0
+
+    def _read_index(self) -> dict:
+        try:
+            with open(os.path.join(self.directory, "index.json"), "r") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+
+    def _shard_path(self, index: int) -> str:
+        return os.path.join(self.directory, f"shard-{index:03d}")
+
+    def _shard(self, sender: str) -> _Shard:
+        index = zlib.crc32(sender.encode("utf-8")) % self.num_shards
+        shard = self._shards.get(index)
+        if shard is None:
+            with self._lock:
+                shard = self._shards.get(index)
+                if shard is None:
+                    shard = _Shard(self._shard_path(index), self.dim)
+                    self._shards[index] = shard
+        return shard
+
+    def __len__(self) -> int:
+        return sum(len(shard.snippets) for shard in list(self._shards.values()))
+
+    def remember(self, sender: str, entries: List[dict]) -> int:
+        """
+        Queues the user and assistant messages of the entries (of the message info
+        of a chat) to be embedded and added to the memory of the sender. Returns
+        the number of snippets queued.
+        """
+        snippets = [
+            dict(sender=sender, role=entry["role"], content=entry["content"][:self.max_chars],
+                 timestamp=entry.get("timestamp", ""))
+            for entry in entries
+            if entry.get("role") in ("user", "assistant") and not entry.get("flagged")
+            and isinstance(entry.get("content"), str) and len(entry["content"].strip()) >= self.min_chars
+        ]
+        if not snippets:
+            return 0
+        with self._lock:
+            self._pending.extend(snippets)
+            if len(self._pending) > self.max_pending:
+                self.dropped += len(self._pending) - self.max_pending
+                del self._pending[:len(self._pending) - self.max_pending]
+            full = len(self._pending) >= self.batch_size
+        self.start()
+        if full:
+            self.background.call_soon(self._wakeup.set)
+        return len(snippets)
+
+    def search(
+        self, sender: str, vector: Sequence[float], k: int = 3, min_similarity: float = 0.0, exclude: set = None,
+    ) -> List[Tuple[float, dict]]:
+        """
+        Returns the (similarity, snippet) of the `k` snippets of the sender most similar
+        to the vector, skipping repeated snippets and those whose content is in `exclude`
+        (e.g. the messages already in the prompt).
+        """
+        start = time.perf_counter()
+        results = self._search(sender, vector, k, min_similarity, exclude)
+        with self._lock:
+            self.searches += 1
+            self.recalled += len(results)
+            self.search_seconds += time.perf_counter() - start
+        return results
+
+    def _search(self, sender, vector, k, min_similarity, exclude) -> List[Tuple[float, dict]]:
+        if self.dim is None:
+            return []
+        shard = self._shard(sender)
+        with shard.lock:
+            rows = np.array(shard.rows.get(sender, ()), dtype=np.int64)
+            if rows.size == 0:
+                return []
+            vectors = shard.vectors(rows)
+        query = np.asarray(vector, dtype=np.float32)
+        query = query / (np.linalg.norm(query) or 1.0)
+        scores = vectors @ query
+        # more than needed in case some of them are excluded or repeated
+        exclude = set(exclude or ())
+        n = min(rows.size, 4 * k + len(exclude))
+        top = np.argpartition(-scores, n - 1)[:n]
+        top = top[np.argsort(-scores[top])]
+        results = []
+        for i in top:
+            if scores[i] < min_similarity:
+                break
+            snippet = shard.snippets[rows[i]]
+            if snippet["content"] in exclude:
+                continue
+            exclude.add(snippet["content"])
+            results.append((float(scores[i]), snippet))
+            if len(results) == k:
+                break
+        return results
+
+    def start(self):
+        with self._start_lock:
+            if self._started:
+                return self
+            self.background.start()
+            self.background.submit(self._start()).result()
+            self._started = True
+            # the snippets still waiting are embedded before exiting
+            atexit.register(self.stop, 10)
+        logger.info(f"Started memory store '{self.name}' in {self.directory}")
+        return self
+
+    async def _start(self):
+        if self.on_start is not None:
+            await self.on_start()
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.ensure_future(self._run())
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+
+    async def flush(self):
+        """Embeds the pending snippets (in batches) and appends them to the index"""
+        while True:
+            with self._lock:
+                batch = self._pending[:self.batch_size]
+                del self._pending[:self.batch_size]
+            if not batch:
+                return
+            try:
+                vectors = await self.embed([snippet["content"] for snippet in batch])
+            except Exception as e:
+                self.failed_batches += 1
+                logger.warning(f"Could not embed {len(batch)} snippets, retrying later: {e!r}")
+                with self._lock:
+                    self._pending[:0] = batch
+                return
+            vectors = np.asarray(vectors, dtype=np.float32)
+            vectors /= np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+            if self.dim is None:
+                self.dim = vectors.shape[1]
+                with open(os.path.join(self.directory, "index.json"), "w") as f:
+                    json.dump({"dim": self.dim, "num_shards": self.num_shards}, f)
+            by_shard = defaultdict(list)
+            for i, snippet in enumerate(batch):
+                by_shard[self._shard(snippet["sender"])].append(i)
+            for shard, indices in by_shard.items():
+                await asyncio.get_event_loop().run_in_executor(
+                    None, shard.append, vectors[indices], [batch[i] for i in indices])
+            self.embedded += len(batch)
+
+    def stats(self) -> dict:
+        with self._lock:
+            pending = len(self._pending)
+        return dict(
+            name=self.name,
+            running=self.background.running,
+            snippets=len(self),
+            senders=sum(len(shard.rows) for shard in list(self._shards.values())),
+            pending=pending,
+            embedded=self.embedded,
+            dropped=self.dropped,
+            failed_batches=self.failed_batches,
+            searches=self.searches,
+            recalled=self.recalled,
+            mean_search_ms=round(1000 * self.search_seconds / self.searches, 3) if self.searches else 0.0,
+        )
+
+    def stop(self, timeout: float = None):
+        with self._start_lock:
+            if not self._started:
+                return
+            self.background.submit(self._stop()).result(timeout)
+            self.background.stop(timeout)
+            self._started = False
+
+    async def _stop(self):
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+        await self.flush()
+        if self.on_stop is not None:
+            await self.on_stop()
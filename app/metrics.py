@@ -0,0 +1,222 @@
+"""
+Metrics of the app in the Prometheus text format.
+
+Recording a value only updates a few numbers under a lock; the text is
+built when `/metrics` is scraped, and gauges (and counters) given a callback
+are only evaluated then, so the metrics cost nothing while nobody reads them.
+
+Usage
+-----
+>>> with STAGE_SECONDS.time(stage="completion"):
+...     reply = await chatgpt_completion(context)
+>>> TOKENS.inc(120, kind="prompt")
+"""
+import math
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterable, List, Tuple
+
+__all__ = [
+    "Counter",
+    "Gauge",
+    "Histogram",
+    "Registry",
+    "REGISTRY",
+    "STAGE_SECONDS",
+    "UPSTREAM_SECONDS",
+    "TOKENS",
+    "MESSAGES",
+    "IMAGES",
+    "ROUTES",
+    "COMPACTIONS",
+    "MODERATIONS",
+    "time_upstream",
+]
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60)
+
+
+def _label_key(labelnames: Tuple[str, ...], labels: Dict[str, str]) -> Tuple[str, ...]:
+    return tuple(str(labels.get(name, "")) for name in labelnames)
+
+
+def _format_labels(labelnames: Iterable[str], values: Iterable[str], extra: str = "") -> str:
+    pairs = [
+        '{}="{}"'.format(name, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for name, value in zip(labelnames, values)
+    ]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name: str, help: str = "", labelnames: Tuple[str, ...] = (), callback: Callable = None):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        # called on scrape, returns a value or a dict of {label values: value}
+        self.callback = callback
+        self._values: Dict[Tuple[str, ...], float] = {}
+        self._lock = threading.Lock()
+
+    def _samples(self) -> List[Tuple[str, str, float]]:
+        if self.callback is not None:
+            values = self.callback()
+            if not isinstance(values, dict):
+                values = {(): values}
+            values = {key if isinstance(key, tuple) else (key,): value for key, value in values.items()}
+        else:
+            with self._lock:
+                values = dict(self._values)
+        return [
+            (self.name, _format_labels(self.labelnames, key), value)
+            for key, value in values.items()
+            if value is not None
+        ]
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        lines += [f"{name}{labels} {_format_value(value)}" for name, labels, value in self._samples()]
+        return "\n".join(lines)
+
+
+class Counter(_Metric):
+    """A value that only goes up, e.g. the number of tokens used"""
+
+    kind = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        key = _label_key(self.labelnames, labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    """A value that goes up and down, e.g. the number of active sessions"""
+
+    kind = "gauge"
+
+    def set(self, value: float, **labels):
+        key = _label_key(self.labelnames, labels)
+        with self._lock:
+            self._values[key] = value
+
+
+class Histogram(_Metric):
+    """The distribution of a value (e.g. a latency) in cumulative buckets"""
+
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str = "", labelnames: Tuple[str, ...] = (), buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._series: Dict[Tuple[str, ...], list] = {}  # labels -> [bucket counts..., sum, count]
+
+    def observe(self, value: float, **labels):
+        key = _label_key(self.labelnames, labels)
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [0] * (len(self.buckets) + 3)
+            series[index] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        """Observes the seconds taken by the block (also when it raises)"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def _samples(self) -> List[Tuple[str, str, float]]:
+        with self._lock:
+            series = {key: list(values) for key, values in self._series.items()}
+        samples = []
+        for key, values in series.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), values):
+                cumulative += count
+                le = f'le="{_format_value(bound)}"'
+                samples.append((f"{self.name}_bucket", _format_labels(self.labelnames, key, le), cumulative))
+            labels = _format_labels(self.labelnames, key)
+            samples.append((f"{self.name}_sum", labels, values[-2]))
+            samples.append((f"{self.name}_count", labels, values[-1]))
+        return samples
+
+
+class Registry:
+    """The metrics exposed together"""
+
+    def __init__(self):
+        self._metrics: Dict[str, _Metric] = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric: _Metric) -> _Metric:
+        with self._lock:
+            self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, help: str = "", labelnames: Tuple[str, ...] = (), callback: Callable = None) -> Counter:
+        return self.register(Counter(name, help, labelnames, callback))
+
+    def gauge(self, name: str, help: str = "", labelnames: Tuple[str, ...] = (), callback: Callable = None) -> Gauge:
+        return self.register(Gauge(name, help, labelnames, callback))
+
+    def histogram(self, name: str, help: str = "", labelnames: Tuple[str, ...] = (), buckets: Tuple[float, ...] = DEFAULT_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, help, labelnames, buckets))
+
+    def render(self) -> str:
+        """Returns the metrics in the Prometheus text exposition format"""
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return "\n".join(metric.render() for metric in metrics) + "\n"
+
+
+REGISTRY = Registry()
+
+STAGE_SECONDS = REGISTRY.histogram(
+    "whatsapp_stage_seconds", "Seconds taken by each stage of the processing of a message", ("stage",))
+UPSTREAM_SECONDS = REGISTRY.histogram(
+    "whatsapp_upstream_seconds", "Seconds taken by the requests to each upstream API", ("api", "status"))
+TOKENS = REGISTRY.counter(
+    "whatsapp_tokens_total", "Tokens sent to and received from the language model", ("kind",))
+MESSAGES = REGISTRY.counter(
+    "whatsapp_messages_total", "Messages processed by type and outcome", ("type", "outcome"))
+IMAGES = REGISTRY.counter(
+    "whatsapp_image_requests_total", "Image generations requested by outcome", ("outcome",))
+ROUTES = REGISTRY.counter(
+    "whatsapp_model_routes_total", "Turns routed to each model and the reason", ("model", "reason"))
+MODERATIONS = REGISTRY.counter(
+    "whatsapp_moderations_total", "Moderated user messages and replies by outcome", ("target", "outcome"))
+COMPACTIONS = REGISTRY.counter(
+    "whatsapp_compactions_total", "Conversation compactions by outcome", ("outcome",))
+
+
+@contextmanager
+def time_upstream(api: str):
+    """Observes the seconds taken by a request to the upstream API, labelled with its outcome"""
+    start = time.perf_counter()
+    status = "error"
+    try:
+        yield
+        status = "ok"
+    finally:
+        UPSTREAM_SECONDS.observe(time.perf_counter() - start, api=api, status=status)
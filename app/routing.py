@@ -0,0 +1,161 @@
+"""
+Routing of each turn of a conversation to a model.
+
+`ModelRouter.route` picks the model and `max_tokens` of a turn from the size
+of the prompt, the latency and error rate observed for each model (see
+`chat.handlers.openai.resilience.health`), the time left to reply and the
+number of messages waiting. The primary model is used unless it's failing,
+too slow for the time left or the bot is saturated, in which case the turn
+goes to the faster fallback model. The decision is recorded with the reply.
+"""
+from dataclasses import asdict, dataclass, field
+from typing import List, Optional
+
+from chat.handlers.openai.resilience import health
+from chat.handlers.openai.tokens import context_window
+
+__all__ = [
+    "ModelRouter",
+    "RoutingDecision",
+]
+
+
+@dataclass
+class RoutingDecision:
+    """The model and `max_tokens` of a turn and why they were chosen"""
+
+    model: str
+    max_tokens: int
+    reason: str
+    prompt_tokens: int = 0
+    queue_depth: int = 0
+    time_left: Optional[float] = None
+    latency_p95: Optional[float] = None
+    error_rate: float = 0.0
+    # models to try (in order) if the request to `model` fails
+    fallbacks: List[str] = field(default_factory=list)
+
+    def fall_back(self, reason: str) -> bool:
+        """Moves the turn to the next fallback model, returns False if there's none"""
+        if not self.fallbacks:
+            return False
+        self.model = self.fallbacks.pop(0)
+        self.reason = reason
+        return True
+
+    def to_dict(self) -> dict:
+        info = asdict(self)
+        info.pop("fallbacks")
+        return info
+
+
+class ModelRouter:
+    """
+    Chooses the model and `max_tokens` of every turn.
+
+    Parameters
+    ----------
+    fallback_model : str, optional
+        The faster model used when the primary one can't be, by default None (no fallback)
+    max_tokens : int, optional
+        Maximum tokens of a reply, by default 1000
+    short_message_tokens : int, optional
+        Messages with up to this many tokens (e.g. "ok thanks") get short replies, by default 0
+        (disabled: a short message can still ask for a long answer, e.g. "write me a poem")
+    short_max_tokens : int, optional
+        Maximum tokens of the replies to short messages and of all replies while
+        saturated, by default 300
+    saturation_depth : int, optional
+        Messages waiting (or in process) from which the bot is saturated and
+        turns go to the fallback model, by default 50
+    max_error_rate : float, optional
+        Error rate of the primary model above which turns go to the fallback, by default 0.5
+    min_time_left : float, optional
+        Seconds left to reply below which turns go to the fallback when the p95
+        latency of the primary model is unknown, by default 5
+    """
+
+    def __init__(
+        self,
+        fallback_model: str = None,
+        max_tokens: int = 1000,
+        short_message_tokens: int = 0,
+        short_max_tokens: int = 300,
+        saturation_depth: int = 50,
+        max_error_rate: float = 0.5,
+        min_time_left: float = 5.0,
+    ):
+        self.fallback_model = fallback_model or None
+        self.max_tokens = max_tokens
+        self.short_message_tokens = short_message_tokens
+        self.short_max_tokens = short_max_tokens
+        self.saturation_depth = saturation_depth
+        self.max_error_rate = max_error_rate
+        self.min_time_left = min_time_left
+
+    def route(
+        self,
+        primary: str,
+        prompt_tokens: int,
+        message_tokens: int = None,
+        queue_depth: int = 0,
+        time_left: float = None,
+    ) -> RoutingDecision:
+        """
+        Routes a turn.
+
+        Parameters
+        ----------
+        primary : str
+            The model of the conversation.
+        prompt_tokens : int
+            Tokens of the messages sent to the model.
+        message_tokens : int, optional
+            Tokens of the new message of the user.
+        queue_depth : int, optional
+            Messages waiting or being processed.
+        time_left : float, optional
+            Seconds left to reply (see `resilience.time_left`).
+        """
+        max_tokens = self.max_tokens
+        if self.short_message_tokens and message_tokens is not None and message_tokens <= self.short_message_tokens:
+            max_tokens = min(max_tokens, self.short_max_tokens)
+        saturated = queue_depth >= self.saturation_depth
+        if saturated:
+            max_tokens = min(max_tokens, self.short_max_tokens)
+
+        primary_health = health(primary)
+        model, reason = primary, "primary"
+        fallback = self.fallback_model if self.fallback_model != primary else None
+        if fallback is not None and self._fits(fallback, prompt_tokens):
+            latency = primary_health["latency_p95"]
+            if not primary_health["available"]:
+                model, reason = fallback, "circuit_open"
+            elif primary_health["error_rate"] > self.max_error_rate:
+                model, reason = fallback, "error_rate"
+            elif time_left is not None and time_left < (latency if latency is not None else self.min_time_left):
+                model, reason = fallback, "latency_budget"
+            elif saturated:
+                model, reason = fallback, "saturated"
+        elif saturated:
+            reason = "saturated"
+        if reason == "primary" and max_tokens < self.max_tokens:
+            reason = "short_message"
+
+        # the reply can't take more than what the prompt leaves of the context window
+        max_tokens = max(1, min(max_tokens, context_window(model) - prompt_tokens))
+        return RoutingDecision(
+            model=model,
+            max_tokens=max_tokens,
+            reason=reason,
+            prompt_tokens=prompt_tokens,
+            queue_depth=queue_depth,
+            time_left=None if time_left is None else round(time_left, 3),
+            latency_p95=primary_health["latency_p95"],
+            error_rate=round(primary_health["error_rate"], 3),
+            fallbacks=[fallback] if fallback is not None and model == primary and self._fits(fallback, prompt_tokens) else [],
+        )
+
+    def _fits(self, model: str, prompt_tokens: int) -> bool:
+        """Whether the prompt leaves room for a reply in the context window of the model"""
+        return prompt_tokens + min(self.max_tokens, self.short_max_tokens) <= context_window(model)
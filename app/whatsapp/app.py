@@ -1,43 +1,79 @@
-import os, logging
+import asyncio, os, logging, threading, time
+import openai
+from dataclasses import fields
 from datetime import datetime
 from dotenv import find_dotenv, load_dotenv
 from flask import Flask, request, jsonify
 from chat.clients.twilio import TwilioWhatsAppClient, TwilioWhatsAppMessage
 from chat.handlers.openai import (
-    chat_completion as chatgpt_completion,
+    achat_completion as chatgpt_completion,
     # text_completion as chatgpt_completion,
     voice_transcription as whisper_transcription,
+    open_session as open_openai_session,
+    close_session as close_openai_session,
+    text_to_image as dalle_text_to_image,
+    ModerationBatcher,
+    atext_embedding,
 )
 from app.handlers import (
     check_and_send_image_generation,
+    asplit_reply_stream,
     ensure_user_language,
     verify_image_generation,
     verify_and_process_media,
     check_conversation_end,
 )
-from app.whatsapp.chat import Sender, OpenAIChatManager
+from app.whatsapp.chat import Sender, OpenAIChatManager, session_store
+from app.whatsapp.contactbook import ContactBook
+from app.whatsapp.contacts import ContactAllowlist
+from app.whatsapp.templates import StartTemplate
+from chat.handlers.transcription_cache import TranscriptionCache
+from chat.handlers.semantic_cache import SemanticCache
+from chat.handlers.assemblyai import (
+    notify_transcription_status,
+    open_session as open_assemblyai_session,
+    close_session as close_assemblyai_session,
+    WEBHOOK_AUTH_HEADER,
+)
+from chat.handlers.openai.tokens import count_message_tokens, preload_encodings
+from chat.handlers.openai.resilience import deadline, time_left, stats as openai_call_stats
+from app.workers import BackgroundLoop, WorkerPool, run_blocking
+from app.image_jobs import ImageJobService
+from app.compaction import ConversationCompactor
+from app.memory import MemoryStore, format_memories
+from app.routing import ModelRouter, RoutingDecision
+from app.metrics import CONTENT_TYPE, MESSAGES, MODERATIONS, REGISTRY, ROUTES, STAGE_SECONDS, TOKENS, time_upstream
+from app.logutils import TranscriptSelector, configure_logging, lazy, parse_sample_rates
 
 # from chat.handlers.image import image_captioning
 
 # Load environment variables and configurations for the app
 load_dotenv(find_dotenv())
-logging.basicConfig()
+configure_logging(
+    level=os.environ.get("LOG_ROOT_LEVEL", "INFO").upper(),
+    max_chars=int(os.environ.get("LOG_MAX_CHARS", 4000)),
+    # e.g. "request=0.1" to only log one of every ten incoming requests
+    sample_rates=parse_sample_rates(os.environ.get("LOG_SAMPLE_RATES")),
+)
 logger = logging.getLogger("WP-APP")
-logger.setLevel(logging.DEBUG)
+logger.setLevel(os.environ.get("LOG_LEVEL", "DEBUG").upper())
+# full conversations are only logged for these senders (comma-separated numbers or "*")
+log_transcripts = TranscriptSelector(os.environ.get("LOG_TRANSCRIPTS"))
 
 # chat agent configuration
-start_template = os.environ.get("CHAT_START_TEMPLATE")
-if os.path.exists(start_template):
-    with open(start_template, "r") as f:
-        start_template = f.read()
+start_template = StartTemplate(
+    os.environ.get("CHAT_START_TEMPLATE"),
+    agent_name=os.environ.get("AGENT_NAME"),
+)
 
 chat_options = dict(
     model=os.environ.get("CHAT_MODEL", "gpt-3.5-turbo"),
     agent_name=os.environ.get("AGENT_NAME"),
-    start_system_message=start_template,
     goodbye_message="Goodbye! I'll be here if you need me.",
     voice_transcription=True,
     allow_images=True,
+    conversation_expire_seconds=int(os.environ.get("CONVERSATION_EXPIRES_MINS", 180)) * 60,
+    context_token_budget=int(os.environ["CONTEXT_TOKEN_BUDGET"]) if os.environ.get("CONTEXT_TOKEN_BUDGET") else None,
 )
 model_options = dict(
     model=os.environ.get("CHAT_MODEL", "gpt-3.5-turbo"),
@@ -49,11 +85,120 @@ model_options = dict(
     n=1,
 )
 
+# seconds to reply to a message (Twilio waits 15 seconds for the webhook), the calls
+# to OpenAI are cut when they pass, and the reply sent when the model can't answer
+reply_budget = float(os.environ.get("REPLY_BUDGET_SECONDS", 14))
+fallback_reply = os.environ.get("FALLBACK_REPLY") or "Sorry, I can't answer right now. Please try again in a few minutes."
+
+# choice of the model and max_tokens of every turn (the model of the chat is the primary one)
+router = ModelRouter(
+    fallback_model=os.environ.get("ROUTER_FALLBACK_MODEL"),
+    max_tokens=model_options["max_tokens"],
+    short_message_tokens=int(os.environ.get("ROUTER_SHORT_MESSAGE_TOKENS", 0)),
+    short_max_tokens=int(os.environ.get("ROUTER_SHORT_MAX_TOKENS", 300)),
+    saturation_depth=int(os.environ.get("ROUTER_SATURATION_DEPTH", 50)),
+    max_error_rate=float(os.environ.get("ROUTER_MAX_ERROR_RATE", 0.5)),
+    min_time_left=float(os.environ.get("ROUTER_MIN_TIME_LEFT", 5)),
+)
+
+# summarization of the oldest messages of long conversations in the background
+compaction_options = dict(
+    threshold_tokens=int(os.environ.get("COMPACTION_THRESHOLD_TOKENS", 2000)),
+    keep_tokens=int(os.environ["COMPACTION_KEEP_TOKENS"]) if os.environ.get("COMPACTION_KEEP_TOKENS") else None,
+    max_words=int(os.environ.get("COMPACTION_SUMMARY_WORDS", 200)),
+    max_concurrency=int(os.environ.get("COMPACTION_MAX_CONCURRENCY", 2)),
+)
+compaction_model = os.environ.get("COMPACTION_MODEL") or model_options["model"]
+
+# the tokenizer is loaded (downloaded the first time) at startup instead of by the first message,
+# token counts are estimated from the length of the messages if it can't be
+preload_encodings(model_options["model"])
+
+# moderation of the messages of the users and/or the replies ("message,reply"), in batches
+moderation_targets = {t.strip() for t in os.environ.get("MODERATION", "").split(",") if t.strip()}
+moderator = ModerationBatcher(
+    max_batch_size=int(os.environ.get("MODERATION_BATCH_SIZE", 32)),
+    max_delay=float(os.environ.get("MODERATION_BATCH_DELAY_MS", 10)) / 1000,
+) if moderation_targets else None
+moderation_reply = os.environ.get("MODERATION_REPLY") or "Sorry, I can't help with that."
+
+# answers to the first (context-free) questions of the conversations reused for similar questions
+semantic_cache = SemanticCache(
+    threshold=float(os.environ.get("SEMANTIC_CACHE_THRESHOLD", 0.95)),
+    max_entries=int(os.environ.get("SEMANTIC_CACHE_MAX_ENTRIES", 5000)),
+    ttl=float(os.environ.get("SEMANTIC_CACHE_TTL_HOURS", 24)) * 60 * 60,
+    path=os.environ.get("SEMANTIC_CACHE_PATH") or None,
+) if os.environ.get("SEMANTIC_CACHE", "false").lower() in ("1", "true", "yes") else None
+semantic_cache_max_chars = int(os.environ.get("SEMANTIC_CACHE_MAX_CHARS", 300))
+embedding_model = os.environ.get("EMBEDDING_MODEL", "text-embedding-ada-002")
+
+# long-term memory: the messages of every sender are indexed and the most relevant ones
+# of past conversations are added to the prompt of each turn
+memory_options = dict(
+    directory=os.environ.get("MEMORY_PATH", "data/memory"),
+    num_shards=int(os.environ.get("MEMORY_SHARDS", 16)),
+    batch_size=int(os.environ.get("MEMORY_BATCH_SIZE", 64)),
+    flush_interval=float(os.environ.get("MEMORY_FLUSH_SECONDS", 2)),
+    min_chars=int(os.environ.get("MEMORY_MIN_CHARS", 20)),
+)
+memory_top_k = int(os.environ.get("MEMORY_TOP_K", 3))
+memory_min_similarity = float(os.environ.get("MEMORY_MIN_SIMILARITY", 0.8))
+
+# audio transcription with AssemblyAI
+transcription_options = dict(
+    timeout=float(os.environ.get("TRANSCRIPTION_TIMEOUT", 30)),
+    # if set, AssemblyAI calls the /assemblyai/webhook route of this url instead of being polled
+    webhook_url=os.environ.get("ASSEMBLYAI_WEBHOOK_URL"),
+    webhook_secret=os.environ.get("ASSEMBLYAI_WEBHOOK_SECRET"),
+)
+transcription_cache = TranscriptionCache(
+    max_memory_items=int(os.environ.get("TRANSCRIPTION_CACHE_ITEMS", 1024)),
+    directory=os.environ.get("TRANSCRIPTION_CACHE_DIR") or None,
+    max_disk_bytes=int(os.environ.get("TRANSCRIPTION_CACHE_MAX_BYTES", 100 * 1024 * 1024)),
+) if os.environ.get("TRANSCRIPTION_CACHE", "true").lower() in ("1", "true", "yes") else None
+
+# below this confidence of the local language identifier, the language model detects the language
+language_min_confidence = float(os.environ.get("LANGUAGE_MIN_CONFIDENCE", 0.8))
+
+# send the replies in pieces as they are generated
+stream_replies = os.environ.get("STREAM_REPLIES", "false").lower() in ("1", "true", "yes")
+
+# background processing of the incoming messages
+background_processing = os.environ.get("BACKGROUND_PROCESSING", "false").lower() in ("1", "true", "yes")
+worker_options = dict(
+    # messages processed at the same time (those of a sender are always processed in order)
+    num_workers=int(os.environ.get("NUM_WORKERS", 64)),
+    max_queue_size=int(os.environ.get("MAX_QUEUE_SIZE", 1000)),
+)
+
+# image generation in the background
+image_options = dict(
+    max_concurrency=int(os.environ.get("IMAGE_MAX_CONCURRENCY", 2)),
+    max_queue_size=int(os.environ.get("IMAGE_MAX_QUEUE_SIZE", 100)),
+    cache_ttl=int(os.environ.get("IMAGE_CACHE_TTL_MINS", 30)) * 60,
+)
+
+# if set, only the contacts in this file can use the chatbot
+allowlist = ContactAllowlist(
+    os.environ.get("CONTACTS_JSON") or None,
+    check_interval=float(os.environ.get("CONTACTS_CHECK_INTERVAL", 1)),
+)
+
+# if set, the name and last message date of every sender are saved in this contact book
+contactbook = ContactBook(
+    os.environ["CONTACTBOOK_PATH"],
+    flush_interval=float(os.environ.get("CONTACTBOOK_FLUSH_INTERVAL", 1)),
+) if os.environ.get("CONTACTBOOK_PATH") else None
+
 # create the chat client
 chat_client = TwilioWhatsAppClient(
     account_sid=os.environ.get("TWILIO_ACCOUNT_SID"),
     auth_token=os.environ.get("TWILIO_AUTH_TOKEN"),
     from_number=os.environ.get("TWILLIO_WHATSAPP_NUMBER", "+14155238886"),
+    async_sender_kwargs=dict(
+        max_concurrency=int(os.environ.get("TWILIO_MAX_CONCURRENCY", 20)),
+        max_per_destination=int(os.environ.get("TWILIO_MAX_PER_DESTINATION", 1)),
+    ),
 )
 
 # instance the app
@@ -62,60 +207,461 @@ app = Flask(__name__)
 
 @app.route("/whatsapp/reply", methods=["POST"])
 async def reply_to_whatsapp_message():
-    logger.info(f"Obtained request: {dict(request.values)}")
-    # create the chat manager
+    logger.info(
+        "Obtained message %s from %s", request.values.get("MessageSid"), request.values.get("From"),
+        extra={"event": "request"},
+    )
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Request values: %s", request.values.to_dict(), extra={"event": "request_values"})
+    if not request.values.get("From") or not request.values.get("To"):
+        return jsonify({"status": "error", "message": "missing sender or recipient"}), 400
+    contact = None
+    if allowlist.enabled:
+        contact = allowlist.lookup(request.values.get("From"))
+        if contact is None:
+            # acknowledged and dropped: Twilio reports anything but a 2xx as a failed webhook (error 11200)
+            logger.warning(f"Dropping message from {request.values.get('From')}, it's not in the contacts allowlist")
+            return "", 200
+    # create the sender and parse the message
     sender = Sender(
         phone_number=request.values.get("From"),
         name=request.values.get("ProfileName", request.values.get("From")),
     )
-    chat = OpenAIChatManager.get_or_create(sender, logger=logger, **chat_options)
-    chat.start_system_message = chat_options.get("start_system_message").format(
-        user=sender.name, today=datetime.now().strftime("%Y-%m-%d")
-    )
-    chat.messages[0] = chat.make_message(chat.start_system_message, role="system")
-    # parse and process the message
     new_message = chat_client.parse_request_values(request.values)
-    msg = verify_and_process_media(new_message, chat)
+    if contactbook is not None:
+        contactbook.update(sender.phone_number, request.values.get("ProfileName"))
+    if background_processing:
+        # acknowledge the webhook right away and reply from the worker pool
+        if not get_worker_pool().submit((sender, new_message, contact), key=sender.phone_number):
+            logger.warning(f"Worker queue is full, rejecting message from {sender.phone_number}")
+            return jsonify({"status": "busy"}), 503
+        return jsonify({"status": "queued"})
+    # processed in the long-lived loop of the requests, Flask runs every request in a new one
+    await asyncio.wrap_future(get_request_loop().submit(process_message(sender, new_message, contact)))
+    return jsonify({"status": "ok"})
+
+
+async def process_message(sender: Sender, new_message: TwilioWhatsAppMessage, contact: dict = None):
+    """Runs the handler chain that replies to a new message from the sender"""
+    media = new_message.media
+    message_type = "text" if media is None else "audio" if media.is_audio else "media"
+    global _in_flight
+    outcome = "error"
+    with _in_flight_lock:
+        _in_flight += 1
+    try:
+        with STAGE_SECONDS.time(stage="total"), deadline(reply_budget):
+            await _process_message(sender, new_message, contact)
+        outcome = "ok"
+    finally:
+        with _in_flight_lock:
+            _in_flight -= 1
+        MESSAGES.inc(type=message_type, outcome=outcome)
+
+
+# messages being processed (in the request threads or the workers)
+_in_flight = 0
+_in_flight_lock = threading.Lock()
+
+def current_load() -> int:
+    """Returns the number of messages being processed or waiting in the queue"""
+    return _in_flight + (_worker_pool.queue_depth if _worker_pool is not None else 0)
+
+
+async def _process_message(sender: Sender, new_message: TwilioWhatsAppMessage, contact: dict = None):
+    # create the chat manager
+    with STAGE_SECONDS.time(stage="session"):
+        chat = OpenAIChatManager.get_or_create(sender, logger=logger, **chat_options)
+    # apply the limits of the contact (e.g. its own max_image_generations)
+    for option, value in contact_chat_options(contact).items():
+        setattr(chat, option, value)
+    # the system message only changes with the name of the sender and the day
+    system_message = start_template.render_today(sender.name)
+    if chat.start_system_message != system_message:
+        chat.start_system_message = system_message
+        chat.set_system_message(system_message)
+    # process the message
+    with STAGE_SECONDS.time(stage="media"):
+        msg = await verify_and_process_media(
+            new_message, chat,
+            transcription_options=transcription_options,
+            transcription_cache=transcription_cache,
+        )
     # check if the conversation should end
-    if message_empty_or_goodbye(msg, chat):
-        return jsonify({"status": "ok"})
+    if await message_empty_or_goodbye(msg, chat):
+        return
+    if "message" in moderation_targets and await is_flagged(msg, target="message"):
+        # the flagged message is only kept in the message info
+        chat.message_info.append(
+            {**chat.make_message(msg, role="user"), "timestamp": datetime.now().isoformat(), "flagged": True})
+        await chat_client.send_message_async(moderation_reply, chat.sender.phone_number)
+        chat.save()
+        return
     # if this is the first message, ensure the language is set
     logger.info("Chat has %d messages", len(chat.messages))
     if len(chat.messages) == 1:
-        await ensure_user_language(chat, text=msg)
+        with STAGE_SECONDS.time(stage="language"):
+            await ensure_user_language(chat, text=msg, min_confidence=language_min_confidence)
     # generate the reply
     chat.add_message(msg, role="user")
-    reply = chatgpt_completion(chat.messages, **model_options).strip()
-    logger.info(f"Generated reply of length {len(reply)}")
-    # check if the reply is requesting an image generation
-    reply, img_prompt = verify_image_generation(reply)
-    # send the reply
-    chat_client.send_message(
-        reply,
-        chat.sender.phone_number,
-        on_failure="Sorry, I didn't understand that. Please try again.",
+    # the embedding of the message is shared by the semantic cache and the memory
+    use_cache = semantic_cache is not None and is_context_free(chat, msg)
+    message_vector, memories = None, None
+    if use_cache or memory is not None:
+        with STAGE_SECONDS.time(stage="embedding"):
+            message_vector = await embed_message(msg)
+    if memory is not None and message_vector is not None:
+        with STAGE_SECONDS.time(stage="memory"):
+            memories = await recall_memories(chat, message_vector)
+    memory_tokens = count_message_tokens(memories, chat.model) if memories else 0
+    context = chat.get_context_messages(reserve=router.max_tokens + memory_tokens)
+    if memories:
+        # only sent with this turn, it isn't part of the conversation
+        context.insert(1, memories)
+    TOKENS.inc(chat.context_tokens + memory_tokens, kind="prompt")
+    decision = router.route(
+        chat.model,
+        prompt_tokens=chat.context_tokens + memory_tokens,
+        message_tokens=chat.message_tokens[-1],
+        queue_depth=current_load(),
+        time_left=time_left(),
+    )
+    question_vector, cached = message_vector if use_cache else None, None
+    if question_vector is not None:
+        with STAGE_SECONDS.time(stage="semantic_cache"):
+            cached = semantic_cache.get(question_vector, scope=f"{chat.model}:{chat.language}")
+    completion_start = time.monotonic()
+    if stream_replies and cached is None:
+        # send the reply in pieces while it is being generated
+        with STAGE_SECONDS.time(stage="completion_stream"):
+            reply = (await send_streamed_reply(context, chat, decision)).strip()
+        reply, img_prompt = verify_image_generation(reply)
+    else:
+        if cached is not None:
+            reply, similarity = cached
+            decision.reason = "semantic_cache"
+            logger.info(f"Reusing the cached reply of a question with similarity {similarity:.3f}")
+        else:
+            with STAGE_SECONDS.time(stage="completion"), time_upstream("openai_chat"):
+                reply = (await request_completion(context, decision)).strip()
+            logger.info(f"Generated reply of length {len(reply)}")
+        # check if the reply is requesting an image generation
+        reply, img_prompt = verify_image_generation(reply)
+        if "reply" in moderation_targets and reply != fallback_reply and await is_flagged(reply, target="reply"):
+            reply, img_prompt = moderation_reply, None
+        # send the reply
+        with STAGE_SECONDS.time(stage="send"), time_upstream("twilio"):
+            await chat_client.send_message_async(
+                reply,
+                chat.sender.phone_number,
+                on_failure="Sorry, I didn't understand that. Please try again.",
+            )
+    ROUTES.inc(model=decision.model, reason=decision.reason)
+    logger.info(
+        "Routed turn to %s (%s) with max_tokens=%d", decision.model, decision.reason, decision.max_tokens,
+        extra={"event": "routing"},
     )
+    if reply in (fallback_reply, moderation_reply):
+        # the model didn't answer (or its answer was flagged), the message of the user is answered with the next one
+        chat.message_info[-1]["routing"] = dict(
+            decision.to_dict(), reason="fallback_reply" if reply == fallback_reply else "flagged_reply")
+        remember_turn(chat)
+        with STAGE_SECONDS.time(stage="save"):
+            chat.save()
+        return
     # add the reply to the chat
     chat.add_message(reply, role="assistant")
+    chat.message_info[-1]["routing"] = decision.to_dict()
+    if memories:
+        chat.message_info[-1]["memory_tokens"] = memory_tokens
+    if (
+        question_vector is not None and cached is None and not img_prompt
+        and not memories and sender.name not in reply
+    ):
+        # the reply of the question only depends on it (and the language), unless it names
+        # the user or comes from what the user said in other conversations
+        await run_blocking(
+            semantic_cache.put, question_vector, msg, reply,
+            scope=f"{chat.model}:{chat.language}", seconds=time.monotonic() - completion_start,
+        )
+    TOKENS.inc(chat.message_tokens[-1], kind="completion")
     # if the reply was requesting an image generation, send the image
     if img_prompt:
         chat.add_message(f"[img:\"{img_prompt}\"]", role="system")
-        await check_and_send_image_generation(img_prompt, chat, client=chat_client)
+        with STAGE_SECONDS.time(stage="image"):
+            await check_and_send_image_generation(img_prompt, chat, client=chat_client, image_jobs=image_jobs)
+    remember_turn(chat)
     # save the chat
-    chat.save()
+    with STAGE_SECONDS.time(stage="save"):
+        chat.save()
+    if compactor is not None:
+        # summarized in the background, the summary is used from the next turn
+        compactor.maybe_compact(chat)
+    if sender.phone_number in log_transcripts:
+        logger.debug(
+            "--------------\nConversation:\n%s\n----------------", lazy(chat.get_conversation),
+            extra={"event": "transcript"},
+        )
+
+
+_chat_fields = {f.name for f in fields(OpenAIChatManager) if f.init}
+# options of the chat that can't be set per contact
+_private_chat_fields = {
+    "sender", "messages", "message_info", "message_tokens", "logger", "num_images_generated", "summary",
+    "memory_indexed",
+}
+
+def contact_chat_options(contact: dict = None) -> dict:
+    """Returns the options of the chat set in the contact of the allowlist"""
+    if not contact:
+        return {}
+    return {
+        option: value for option, value in contact.items()
+        if option in _chat_fields and option not in _private_chat_fields
+    }
+
+
+async def request_completion(context: list, decision: RoutingDecision, **kwargs):
+    """
+    Requests the reply to the model of the decision, moving to its fallback
+    models when the request fails, and to the fallback reply after the last one.
+    """
+    while True:
+        options = dict(model_options, model=decision.model, max_tokens=decision.max_tokens)
+        try:
+            return await chatgpt_completion(
+                context, fallback=None if decision.fallbacks else fallback_reply, **options, **kwargs)
+        except openai.error.OpenAIError as e:
+            failed = decision.model
+            if not decision.fall_back("request_failed"):
+                raise
+            logger.warning(f"Completion with {failed} failed, falling back to {decision.model}: {e!r}")
+
+
+def is_context_free(chat: OpenAIChatManager, msg: str) -> bool:
+    """Whether the reply to the message only depends on it: it's short and the first of the conversation"""
+    return len(chat.messages) <= 3 and chat.summary is None and len(msg) <= semantic_cache_max_chars
+
+
+async def embed_message(msg: str):
+    """Returns the embedding of the message, or None if it can't be embedded (the cache and memory are skipped)"""
+    try:
+        with time_upstream("openai_embeddings"):
+            return await atext_embedding(msg, model=embedding_model)
+    except Exception as e:
+        logger.warning(f"Could not embed the message, skipping the semantic cache and memory: {e!r}")
+        return None
+
+
+async def embed_snippets(texts: list) -> list:
+    with time_upstream("openai_embeddings"):
+        return await atext_embedding(texts, model=embedding_model)
+
+
+async def recall_memories(chat: OpenAIChatManager, vector) -> dict:
+    """Returns the system message with what the sender said in past conversations relevant to the message, if any"""
+    memories = await run_blocking(
+        memory.search, chat.sender.phone_number, vector, k=memory_top_k, min_similarity=memory_min_similarity,
+        # what is still in the conversation
+        exclude={m["content"] for m in chat.messages},
+    )
+    if not memories:
+        return None
+    return chat.make_message(format_memories(memories), role="system")
+
+
+def remember_turn(chat: OpenAIChatManager):
+    """Hands the new messages of the chat to the memory, which embeds them in the background"""
+    if memory is None:
+        return
+    memory.remember(chat.sender.phone_number, chat.message_info[chat.memory_indexed:])
+    chat.memory_indexed = len(chat.message_info)
+
+
+async def is_flagged(text: str, target: str) -> bool:
+    """Moderates the text (batched with the other conversations), letting it through if moderation fails"""
+    try:
+        with time_upstream("openai_moderation"):
+            result = await moderator.moderate(text)
+    except Exception as e:
+        logger.warning(f"Could not moderate the {target}, letting it through: {e!r}")
+        MODERATIONS.inc(target=target, outcome="error")
+        return False
+    flagged = bool(result.get("flagged"))
+    MODERATIONS.inc(target=target, outcome="flagged" if flagged else "ok")
+    if flagged:
+        logger.warning(f"The {target} was flagged by moderation")
+    return flagged
+
+
+async def send_streamed_reply(context: list, chat: OpenAIChatManager, decision: RoutingDecision) -> str:
+    """
+    Streams the reply of the model and sends it to the sender in messages
+    that are sent as soon as each of them is complete. Returns the full reply.
+    """
+    start = time.monotonic()
+    pieces = []
+    async def deltas():
+        async for delta in await request_completion(context, decision, stream=True):
+            pieces.append(delta)
+            yield delta
+    num_messages = 0
+    async for chunk in asplit_reply_stream(deltas()):
+        chunk, _ = verify_image_generation(chunk)
+        if not chunk.strip():
+            continue
+        if "reply" in moderation_targets and chunk != fallback_reply and await is_flagged(chunk, target="reply"):
+            # the rest of the reply isn't sent
+            await chat_client.send_message_async(moderation_reply, chat.sender.phone_number)
+            return moderation_reply
+        with time_upstream("twilio"):
+            await chat_client.send_message_async(
+                chunk.strip(),
+                chat.sender.phone_number,
+                on_failure="Sorry, I didn't understand that. Please try again.",
+            )
+        if num_messages == 0:
+            STAGE_SECONDS.observe(time.monotonic() - start, stage="first_message")
+            logger.info(f"Time to first message: {time.monotonic() - start:.2f} seconds")
+        num_messages += 1
+    reply = "".join(pieces)
     logger.info(
-        f"--------------\nConversation:\n{chat.get_conversation()}\n----------------"
+        f"Streamed reply of length {len(reply)} in {num_messages} messages "
+        f"in {time.monotonic() - start:.2f} seconds"
     )
-    return jsonify({"status": "ok"})
+    return reply
+
+
+async def open_sessions():
+    """Opens the connection pools shared by the workers"""
+    await open_openai_session()
+    await open_assemblyai_session()
+    await chat_client.async_sender.open()
+
+async def close_sessions():
+    await close_openai_session()
+    await close_assemblyai_session()
+    await chat_client.async_sender.close()
+
 
-def message_empty_or_goodbye(msg, chat):
+_request_loop = None
+_request_loop_lock = threading.Lock()
+
+def get_request_loop() -> BackgroundLoop:
+    """
+    Returns the loop processing the messages when they aren't processed in the background,
+    starting it (with its connection pools) if needed
+    """
+    global _request_loop
+    with _request_loop_lock:
+        if _request_loop is None or not _request_loop.running:
+            _request_loop = BackgroundLoop(name="whatsapp-requests").start()
+            _request_loop.submit(open_sessions()).result()
+    return _request_loop
+
+
+_worker_pool = None
+_worker_pool_lock = threading.Lock()
+
+def get_worker_pool() -> WorkerPool:
+    """Returns the pool of workers processing the messages, starting it if needed"""
+    global _worker_pool
+    with _worker_pool_lock:
+        if _worker_pool is None:
+            _worker_pool = WorkerPool(
+                lambda item: process_message(*item),
+                on_start=open_sessions,
+                on_stop=close_sessions,
+                name="whatsapp-workers",
+                **worker_options,
+            )
+        if not _worker_pool.running:
+            _worker_pool.start()
+    return _worker_pool
+
+image_jobs = ImageJobService(
+    lambda prompt: dalle_text_to_image(prompt, as_url=True),
+    on_start=open_sessions,
+    on_stop=close_sessions,
+    **image_options,
+)
+
+compactor = ConversationCompactor(
+    lambda messages: chatgpt_completion(
+        messages, model=compaction_model, temperature=0.2, max_tokens=compaction_options["max_words"] * 2),
+    on_start=open_sessions,
+    on_stop=close_sessions,
+    **compaction_options,
+) if os.environ.get("COMPACTION", "true").lower() in ("1", "true", "yes") else None
+
+memory = MemoryStore(
+    embed=embed_snippets,
+    on_start=open_sessions,
+    on_stop=close_sessions,
+    **memory_options,
+) if os.environ.get("MEMORY", "false").lower() in ("1", "true", "yes") else None
+
+# gauges (and the counters of other components) are only read when /metrics is scraped
+REGISTRY.gauge(
+    "whatsapp_active_sessions", "Conversations kept in memory",
+    callback=lambda: len(session_store.cache))
+REGISTRY.gauge(
+    "whatsapp_session_bytes", "Approximate memory held by the conversations",
+    callback=lambda: session_store.cache.stats()["bytes"])
+REGISTRY.gauge(
+    "whatsapp_queue_depth", "Items waiting in each queue", ("queue",),
+    callback=lambda: {
+        "messages": _worker_pool.stats()["queue_depth"] if _worker_pool is not None else 0,
+        "images": image_jobs.stats()["queue_depth"],
+    })
+REGISTRY.counter(
+    "whatsapp_images_total", "Images generated and reused from the cache", ("source",),
+    callback=lambda: {"generated": image_jobs.generated, "cache": image_jobs.cache_hits})
+REGISTRY.counter(
+    "whatsapp_openai_calls_total", "Retries, hedges and deadline misses of the calls to OpenAI", ("event",),
+    callback=lambda: {
+        event: count for event, count in openai_call_stats().items() if event != "circuits"
+    })
+REGISTRY.gauge(
+    "whatsapp_openai_circuit_open", "Whether the circuit of each model is open (1) or half open (0.5)", ("model",),
+    callback=lambda: {
+        model: {"closed": 0, "half_open": 0.5, "open": 1}[circuit["state"]]
+        for model, circuit in openai_call_stats()["circuits"].items()
+    })
+REGISTRY.counter(
+    "whatsapp_moderation_batches_total", "Requests to the Moderation API and the texts they moderated", ("kind",),
+    callback=lambda: {} if moderator is None else {"batches": moderator.batches, "items": moderator.items})
+REGISTRY.counter(
+    "whatsapp_semantic_cache_total", "Lookups of the semantic cache of replies", ("result",),
+    callback=lambda: {} if semantic_cache is None else {
+        "hit": semantic_cache.hits, "miss": semantic_cache.misses,
+    })
+REGISTRY.counter(
+    "whatsapp_semantic_cache_seconds_saved_total", "Seconds of generation saved by the replies reused from the semantic cache",
+    callback=lambda: None if semantic_cache is None else semantic_cache.seconds_saved)
+REGISTRY.gauge(
+    "whatsapp_semantic_cache_entries", "Replies in the semantic cache",
+    callback=lambda: None if semantic_cache is None else len(semantic_cache))
+REGISTRY.gauge(
+    "whatsapp_memory_snippets", "Snippets of past conversations in the long-term memory",
+    callback=lambda: None if memory is None else len(memory))
+REGISTRY.counter(
+    "whatsapp_memory_snippets_total", "Snippets embedded into the memory and recalled into prompts", ("event",),
+    callback=lambda: {} if memory is None else {"embedded": memory.embedded, "recalled": memory.recalled})
+REGISTRY.counter(
+    "whatsapp_transcription_cache_total", "Lookups of the transcription cache", ("result",),
+    callback=lambda: {} if transcription_cache is None else {
+        "hit": transcription_cache.hits, "miss": transcription_cache.misses,
+    })
+
+async def message_empty_or_goodbye(msg, chat):
     if check_message_empty(msg, chat):
         reply = "Sorry, I didn't understand that. Please try again."
-        chat_client.send_message(reply, chat.sender.phone_number)
+        await chat_client.send_message_async(reply, chat.sender.phone_number)
         # chat.add_message(reply, role="assistant")
         return True
     if check_conversation_end(msg, chat):
-        chat_client.send_message(
+        await chat_client.send_message_async(
             chat.goodbye_message.format(user=chat.sender.name),
             chat.sender.phone_number,
         )
@@ -129,7 +675,72 @@ def check_message_empty(msg, chat):
     return False
 
 
+@app.route("/whatsapp/transcriptions", methods=["GET"])
+def transcription_cache_stats():
+    if transcription_cache is None:
+        return jsonify({"enabled": False})
+    return jsonify(transcription_cache.stats())
+
+
+@app.route("/assemblyai/webhook", methods=["POST"])
+def transcription_webhook():
+    secret = transcription_options.get("webhook_secret")
+    if secret and request.headers.get(WEBHOOK_AUTH_HEADER) != secret:
+        return jsonify({"status": "unauthorized"}), 401
+    data = request.get_json(silent=True) or {}
+    if not data.get("transcript_id"):
+        return jsonify({"status": "error", "message": "missing transcript_id"}), 400
+    notify_transcription_status(data["transcript_id"], data.get("status", "completed"))
+    return jsonify({"status": "ok"})
+
+
+@app.route("/metrics", methods=["GET"])
+def metrics():
+    return REGISTRY.render(), 200, {"Content-Type": CONTENT_TYPE}
+
+
 @app.route("/whatsapp/status", methods=["POST"])
 def process_whatsapp_status():
-    logger.info(f"Obtained request: {dict(request.values)}")
+    logger.debug(
+        "Message %s is %s", request.values.get("MessageSid"), request.values.get("MessageStatus"),
+        extra={"event": "status"},
+    )
     return jsonify({"status": "ok"})
+
+
+@app.route("/whatsapp/workers", methods=["GET"])
+def worker_pool_stats():
+    if _worker_pool is None:
+        return jsonify({"running": False, "queue_depth": 0})
+    return jsonify(_worker_pool.stats())
+
+
+@app.route("/whatsapp/images", methods=["GET"])
+def image_jobs_stats():
+    return jsonify(image_jobs.stats())
+
+
+@app.route("/whatsapp/semantic-cache", methods=["GET"])
+def semantic_cache_stats():
+    if semantic_cache is None:
+        return jsonify({"enabled": False})
+    return jsonify(semantic_cache.stats())
+
+
+@app.route("/whatsapp/memory", methods=["GET"])
+def memory_stats():
+    if memory is None:
+        return jsonify({"enabled": False})
+    return jsonify(memory.stats())
+
+
+@app.route("/whatsapp/compaction", methods=["GET"])
+def compaction_stats():
+    if compactor is None:
+        return jsonify({"enabled": False})
+    return jsonify(compactor.stats())
+
+
+@app.route("/whatsapp/sessions", methods=["GET"])
+def session_store_stats():
+    return jsonify(session_store.stats())
@@ -1,10 +1,13 @@
 from dataclasses import dataclass, field
 from datetime import datetime
 import logging
+import os
+import sys
 from typing import Union, Callable
 # from apscheduler.schedulers.background import BackgroundScheduler
 
-managers = {}
+from chat.handlers.openai.tokens import count_message_tokens, context_window
+from .sessions import SessionConflictError, make_session_store
 
 
 @dataclass
@@ -26,6 +29,29 @@ class OpenAIChatManager:
     caption_images: bool = True
     goodbye_message: str = "Goodbye {user}! I'll be here if you need me."
     logger: logging.Logger = None
+    context_token_budget: int = None # tokens of the context window of the model by default
+    message_tokens: list = field(default_factory=list, repr=False)
+    # the messages sent to the model are messages[0] + messages[_context_start:]
+    _context_start: int = field(default=1, init=False, repr=False)
+    _context_tokens: int = field(default=0, init=False, repr=False)
+    # whether the options of `get_or_create` were applied (they aren't persisted)
+    _configured: bool = field(default=False, init=False, repr=False)
+    # rolling summary of the compacted (oldest) messages, which is messages[1] when set
+    summary: str = None
+    # (summary, summarized messages) computed in the background, applied on the next turn
+    _pending_summary: tuple = field(default=None, init=False, repr=False)
+    _compacting: bool = field(default=False, init=False, repr=False)
+    # entries of the message info already handed to the long-term memory of the sender
+    memory_indexed: int = field(default=0, repr=False)
+    # messages, message info entries and images of the state last read from or saved to the store,
+    # what comes after them is replayed on the stored state if another process saved it meanwhile
+    _saved_messages: int = field(default=0, init=False, repr=False)
+    _saved_info: int = field(default=0, init=False, repr=False)
+    _saved_images: int = field(default=0, init=False, repr=False)
+
+    SUMMARY_PREFIX = "Summary of the earlier conversation: "
+    # times a conversation is saved again after another process saved it first
+    SAVE_ATTEMPTS = 3
     
     end_conversation_phrases = [
         "bye",
@@ -49,14 +75,98 @@ class OpenAIChatManager:
 
     @classmethod
     def get_or_create(cls, sender: "Sender", model: str = "gpt-3.5-turbo", **kwargs):
-        if sender.phone_number not in managers:
-            managers[sender.phone_number] = cls(sender, model)
-        for k, v in kwargs.items():
-            setattr(managers[sender.phone_number], k, v)
-        return managers[sender.phone_number]
+        chat = session_store.get(sender.phone_number)
+        if chat is None:
+            chat = cls(sender, model)
+            try:
+                session_store.save(sender.phone_number, chat)
+                chat._mark_saved()
+            except SessionConflictError:
+                # created at the same time by another process
+                chat = session_store.get(sender.phone_number)
+        if not chat._configured:
+            # only new chats (or chats loaded from the store) need the options
+            for k, v in kwargs.items():
+                setattr(chat, k, v)
+            chat._configured = True
+        return chat
+
+    def save(self) -> bool:
+        """
+        Saves the conversation. If another process (e.g. another worker handling a message
+        of the same sender) saved it since it was read, the messages of this turn are
+        added to the saved conversation and it's saved again.
+        Returns False if it couldn't be saved.
+        """
+        try:
+            session_store.save(
+                self.sender.phone_number, self, merge=self._merge_stored, attempts=self.SAVE_ATTEMPTS)
+        except SessionConflictError as e:
+            self.logger.error(f"Could not save the conversation after {self.SAVE_ATTEMPTS} attempts: {e}")
+            return False
+        self._mark_saved()
+        return True
+
+    def _mark_saved(self):
+        self._saved_messages = len(self.messages)
+        self._saved_info = len(self.message_info)
+        self._saved_images = self.num_images_generated
+
+    def _merge_stored(self, state: dict = None):
+        """Replaces the conversation with the stored one followed by what this one added since it was read"""
+        if state is None:
+            # deleted (e.g. restarted) by another process, this one is saved as a new conversation
+            self._mark_saved()
+            return
+        new_messages = self.messages[self._saved_messages:]
+        new_tokens = self.message_tokens[self._saved_messages:]
+        new_info = self.message_info[self._saved_info:]
+        new_images = max(0, self.num_images_generated - self._saved_images)
+        new_indexed = max(0, self.memory_indexed - self._saved_info)
+        stored = type(self).from_dict(state)
+        self.logger.warning(
+            f"The conversation was saved by another process, adding {len(new_messages)} messages to the saved one")
+        self.messages = stored.messages + new_messages
+        self.message_tokens = stored.message_tokens + new_tokens
+        self.message_info = stored.message_info + new_info
+        self.num_images_generated = stored.num_images_generated + new_images
+        self.summary = stored.summary
+        self.memory_indexed = min(stored.memory_indexed + new_indexed, len(self.message_info))
+        self._reset_token_counts()
+        self._saved_messages = len(stored.messages)
+        self._saved_info = len(stored.message_info)
+        self._saved_images = stored.num_images_generated
+
+    def to_dict(self) -> dict:
+        """Returns the state of the conversation to be persisted"""
+        return dict(
+            sender=dict(phone_number=self.sender.phone_number, name=self.sender.name),
+            model=self.model,
+            messages=self.messages,
+            message_info=self.message_info,
+            num_images_generated=self.num_images_generated,
+            language=self.language,
+            transcription_language=self.transcription_language,
+            message_tokens=self.message_tokens,
+            summary=self.summary,
+            memory_indexed=self.memory_indexed,
+        )
 
-    def save(self):
-        managers[self.sender.phone_number] = self
+    @classmethod
+    def from_dict(cls, state: dict) -> "OpenAIChatManager":
+        """Creates a chat manager from a state returned by `to_dict`"""
+        chat = cls(Sender(**state["sender"]), state.get("model", "gpt-3.5-turbo"))
+        chat.messages = state["messages"]
+        chat.message_info = state["message_info"]
+        chat.message_tokens = state.get("message_tokens") or []
+        chat._reset_token_counts(recount=len(chat.message_tokens) != len(chat.messages))
+        chat.num_images_generated = state.get("num_images_generated", 0)
+        chat.language = state.get("language", chat.language)
+        chat.transcription_language = state.get("transcription_language")
+        chat.summary = state.get("summary")
+        chat.memory_indexed = state.get("memory_indexed", 0)
+        chat._mark_saved()
+        return chat
 
     def get_messages_from(self, role: str):
         return [msg for msg in self.messages if msg["role"] == role]
@@ -64,9 +174,96 @@ class OpenAIChatManager:
     def add_message(self, message: str, role: str = "user"):
         msg = self.make_message(message, role)
         self.messages.append(msg)
+        num_tokens = count_message_tokens(msg, self.model)
+        self.message_tokens.append(num_tokens)
+        if len(self.messages) > 1:
+            self._context_tokens += num_tokens
         msg_info = {**msg, "timestamp": datetime.now().isoformat()}
         self.message_info.append(msg_info)
 
+    def set_system_message(self, message: str):
+        """Replaces the (pinned) system message at the start of the conversation"""
+        self.messages[0] = self.make_message(message, role="system")
+        self.message_tokens[0] = count_message_tokens(self.messages[0], self.model)
+
+    def get_context_messages(self, budget: int = None, reserve: int = 0) -> list:
+        """
+        Returns the messages to send to the model: the system message followed by
+        the newest messages of the conversation that fit in the token budget.
+
+        Parameters
+        ----------
+        budget : int, optional
+            Maximum number of tokens of the messages. By default the `context_token_budget`
+            of the chat or the context window of its model.
+        reserve : int, optional
+            Tokens of the budget to reserve for the reply (e.g. the `max_tokens` of the request)
+        """
+        if self._pending_summary is not None:
+            self._apply_pending_summary()
+        if budget is None:
+            budget = self.context_token_budget or context_window(self.model)
+        available = budget - reserve - self.message_tokens[0]
+        # drop the oldest messages that don't fit anymore (always keep the last one)
+        while self._context_tokens > available and self._context_start < len(self.messages) - 1:
+            self._context_tokens -= self.message_tokens[self._context_start]
+            self._context_start += 1
+        # take back older messages if the budget grew
+        while (
+            self._context_start > 1
+            and self._context_tokens + self.message_tokens[self._context_start - 1] <= available
+        ):
+            self._context_start -= 1
+            self._context_tokens += self.message_tokens[self._context_start]
+        return self.messages[:1] + self.messages[self._context_start:]
+
+    @property
+    def context_tokens(self) -> int:
+        """Tokens of the messages returned by the last call to `get_context_messages`"""
+        return self.message_tokens[0] + self._context_tokens
+
+    def compaction_span(self, keep_tokens: int, keep_last: int = 4) -> list:
+        """
+        Returns the oldest messages (after the system message, starting with the
+        summary if there's one) to compact so that the rest take up to `keep_tokens`.
+        The last `keep_last` messages are never compacted.
+        """
+        end = 1
+        rest = sum(self.message_tokens[1:])
+        while rest > keep_tokens and end < len(self.messages) - keep_last:
+            rest -= self.message_tokens[end]
+            end += 1
+        return self.messages[1:end]
+
+    def set_pending_summary(self, summary: str, span: list):
+        """Sets the summary of the span to replace it on the next turn (can be called from any thread)"""
+        self._pending_summary = (summary, span)
+
+    def _apply_pending_summary(self):
+        summary, span = self._pending_summary
+        self._pending_summary = None
+        # the conversation may have been restarted (or compacted) meanwhile. The messages are compared
+        # by value, they're other objects if the conversation was reloaded (e.g. after a save conflict)
+        if len(self.messages) <= len(span) or any(
+            (a["role"], a["content"]) != (b["role"], b["content"]) for a, b in zip(self.messages[1:], span)
+        ):
+            return
+        msg = self.make_message(self.SUMMARY_PREFIX + summary, role="system")
+        self.messages[1:1 + len(span)] = [msg]
+        self.message_tokens[1:1 + len(span)] = [count_message_tokens(msg, self.model)]
+        # the span was saved before it was summarized
+        self._saved_messages = max(1, self._saved_messages - len(span) + 1)
+        self.summary = summary
+        self._reset_token_counts()
+        # the compacted messages stay in the message info
+        self.message_info.append({**msg, "timestamp": datetime.now().isoformat(), "compacted_messages": len(span)})
+
+    def _reset_token_counts(self, recount: bool = False):
+        if recount:
+            self.message_tokens = [count_message_tokens(msg, self.model) for msg in self.messages]
+        self._context_start = 1
+        self._context_tokens = sum(self.message_tokens[1:])
+
     def make_message(self, message: str, role: str = "user"):
         msg = {
             "role": role,
@@ -75,26 +272,37 @@ class OpenAIChatManager:
         return msg
 
     def start_or_restart_timer(self, callback: callable = None):
-        if callback is None:
-            callback = self.restart_conversation
-        # if self.scheduler.running:
-        #     self.restart_scheduler()
-        # else:
-        #     self.start_scheduler(callback)
+        """
+        Restarts the idle timer of the conversation. Expired conversations are
+        restarted by the session store (see `_on_session_expired`)
+        """
+        session_store.touch(self.sender.phone_number)
+
+    def memory_size(self) -> int:
+        """Returns the approximate memory held by the conversation in bytes"""
+        return sys.getsizeof(self) + sum(
+            sys.getsizeof(msg["content"]) + 64
+            for msg in self.messages + self.message_info
+            if msg["content"] is not None
+        )
 
     def restart_conversation(self):
         """Restarts conversation"""
         self.messages = []
+        self.message_tokens = []
+        self._reset_token_counts()
         self.num_images_generated = 0
+        self.summary = None
+        self._pending_summary = None
         sys_msg = (
             self.start_system_message()
             if callable(self.start_system_message)
             else self.start_system_message
         )
-        sys_msg = sys_msg.format(sender=self.sender)
         self.add_message(sys_msg, role="system")
         # self.scheduler.pause()
-        del managers[self.sender.phone_number]
+        session_store.delete(self.sender.phone_number)
+        self._mark_saved()
 
     def get_conversation(self):
         msg_template = "{role}: {content}"
@@ -113,6 +321,8 @@ class OpenAIChatManager:
 
     def __delitem__(self, index):
         del self.messages[index]
+        del self.message_tokens[index]
+        self._reset_token_counts()
 
 
 @dataclass
@@ -124,3 +334,27 @@ class Sender:
     max_messages: int = 50
     voice_transcription: bool = True
     transcription_language: str = "en-US"
+
+
+def _on_session_expired(phone_number: str, chat: OpenAIChatManager):
+    chat.logger.info(f"Conversation with {phone_number} expired after {chat.conversation_expire_seconds} idle seconds")
+    chat.restart_conversation()
+
+
+def _env_int(name: str, factor: int = 1) -> int:
+    value = os.environ.get(name)
+    return int(value) * factor if value else None
+
+
+# where the conversations are kept, e.g. "memory://", "sqlite:///data/sessions.db" or "redis://localhost:6379/0"
+session_store = make_session_store(
+    os.environ.get("SESSION_STORE"),
+    session_class=OpenAIChatManager,
+    ttl=lambda chat: chat.conversation_expire_seconds,
+    session_ttl=_env_int("CONVERSATION_EXPIRES_MINS", factor=60),
+    max_entries=_env_int("SESSION_MAX_ENTRIES"),
+    max_bytes=_env_int("SESSION_MAX_BYTES"),
+    size_of=OpenAIChatManager.memory_size,
+    on_expire=_on_session_expired,
+    expiry_interval=float(os.environ.get("SESSION_EXPIRY_INTERVAL", 60)),
+)
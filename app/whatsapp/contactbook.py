@@ -0,0 +1,151 @@
+"""
+Contact book of the senders of the messages.
+
+The contacts are kept in an in-memory dict and persisted as a JSON snapshot
+(in the same format as the old `contactbook.json`) plus an append-only journal
+of the changes made after it. Updates only touch the dict; a background thread
+appends them to the journal in batches every `flush_interval` seconds (several
+updates of the same contact are coalesced into one line) and, when the journal
+has grown larger than the book itself, writes a new snapshot and truncates the
+journal. A crash loses at most the updates of the last flush interval.
+"""
+import atexit
+import json
+import logging
+import os
+import threading
+from datetime import datetime
+from typing import Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+__all__ = [
+    "ContactBook",
+]
+
+
+class ContactBook:
+    """
+    A contact book with batched, append-only writes.
+
+    Parameters
+    ----------
+    path : str
+        Path of the JSON snapshot. The journal is kept next to it with the ".journal" suffix.
+    flush_interval : float, optional
+        Seconds between the flushes of the pending updates to the journal, by default 1
+    min_compaction_entries : int, optional
+        The journal is never compacted while it has fewer entries than this, by default 1000
+    """
+
+    def __init__(self, path: str, flush_interval: float = 1.0, min_compaction_entries: int = 1000):
+        self.path = path
+        self.journal_path = path + ".journal"
+        self.flush_interval = flush_interval
+        self.min_compaction_entries = min_compaction_entries
+        self.flushes = 0
+        self.compactions = 0
+        self._contacts: Dict[str, dict] = {}
+        self._pending: Dict[str, dict] = {}
+        self._journal_entries = 0
+        self._lock = threading.Lock()  # guards the contacts and the pending updates
+        self._io_lock = threading.Lock()  # serializes the writes to the files
+        self._closed = threading.Event()
+        self._load()
+        self._thread = threading.Thread(target=self._run, name="contactbook-writer", daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def _load(self):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        if os.path.exists(self.path):
+            with open(self.path, "r") as f:
+                self._contacts = json.load(f)
+        corrupt = False
+        if os.path.exists(self.journal_path):
+            with open(self.journal_path, "r") as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # a line cut by a crash while it was being written
+                        logger.warning(f"Skipping corrupt line of the contact book journal {self.journal_path}")
+                        corrupt = True
+                        continue
+                    self._contacts[entry.pop("phone_number")] = entry
+                    self._journal_entries += 1
+        logger.info(f"Loaded {len(self._contacts)} contacts from {self.path}")
+        if corrupt:
+            # don't append after the cut line
+            self.compact()
+
+    def get(self, phone_number: str) -> Optional[dict]:
+        with self._lock:
+            return self._contacts.get(phone_number)
+
+    def __len__(self) -> int:
+        return len(self._contacts)
+
+    def update(self, phone_number: str, name: str = None):
+        """Records the (last seen) name of the phone number. It is written on the next flush."""
+        contact = {
+            "name": name,
+            "last_updated": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        }
+        with self._lock:
+            self._contacts[phone_number] = contact
+            self._pending[phone_number] = contact
+
+    def flush(self):
+        """Appends the pending updates to the journal and syncs it to disk"""
+        with self._io_lock:
+            with self._lock:
+                pending, self._pending = self._pending, {}
+            if not pending:
+                return
+            lines = "".join(
+                json.dumps(dict(phone_number=phone_number, **contact)) + "\n"
+                for phone_number, contact in pending.items()
+            )
+            with open(self.journal_path, "a") as f:
+                f.write(lines)
+                f.flush()
+                os.fsync(f.fileno())
+            self._journal_entries += len(pending)
+            self.flushes += 1
+        if self._journal_entries > max(self.min_compaction_entries, len(self._contacts)):
+            self.compact()
+
+    def compact(self):
+        """Writes a snapshot of the whole contact book and truncates the journal"""
+        with self._io_lock:
+            with self._lock:
+                contacts = dict(self._contacts)
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, "w") as f:
+                json.dump(contacts, f)
+                f.flush()
+                os.fsync(f.fileno())
+            # a crash between the two steps only leaves journal entries already in the snapshot
+            os.replace(tmp_path, self.path)
+            open(self.journal_path, "w").close()
+            self._journal_entries = 0
+            self.compactions += 1
+        logger.info(f"Compacted the contact book {self.path} with {len(contacts)} contacts")
+
+    def _run(self):
+        while not self._closed.wait(self.flush_interval):
+            try:
+                self.flush()
+            except Exception as e:
+                logger.exception(f"Could not flush the contact book {self.path}: {e}")
+
+    def close(self):
+        """Stops the writer thread and flushes the pending updates"""
+        if self._closed.is_set():
+            return
+        self._closed.set()
+        self._thread.join()
+        self.flush()
@@ -0,0 +1,114 @@
+"""
+Allowlist of the contacts that can use the chatbot.
+
+The contacts file (a JSON list of contacts with at least a "phone_number")
+is loaded once into a dict indexed by the normalized phone number, so looking
+a number up takes constant time no matter how many contacts there are. The
+file is only read again when its modification time (or size) changes, and its
+metadata is checked at most once every `check_interval` seconds.
+"""
+import json
+import logging
+import os
+import re
+import threading
+import time
+from typing import Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+__all__ = [
+    "ContactAllowlist",
+    "normalize_phone_number",
+]
+
+WHATSAPP_PREFIX = "whatsapp:"
+
+_separators = re.compile(r"[\s\-().]")
+
+
+def normalize_phone_number(phone_number: str) -> str:
+    """Removes the "whatsapp:" prefix and the separators of a phone number"""
+    phone_number = str(phone_number).strip()
+    if phone_number.lower().startswith(WHATSAPP_PREFIX):
+        phone_number = phone_number[len(WHATSAPP_PREFIX):]
+    return _separators.sub("", phone_number)
+
+
+class ContactAllowlist:
+    """
+    Contacts allowed to use the chatbot, reloaded when their file changes.
+
+    Parameters
+    ----------
+    path : str, optional
+        Path to the JSON file with the list of contacts. If None, every number is allowed.
+    check_interval : float, optional
+        Minimum seconds between two checks of the modification time of the file, by default 1
+    """
+
+    def __init__(self, path: str = None, check_interval: float = 1.0):
+        self.path = path
+        self.check_interval = check_interval
+        self.reloads = 0
+        self._contacts: Dict[str, dict] = {}
+        self._signature = None  # (mtime, size) of the loaded file
+        self._next_check = 0.0
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.path)
+
+    def lookup(self, phone_number: str) -> Optional[dict]:
+        """Returns the contact of the phone number (with or without the "whatsapp:" prefix) or None"""
+        self._maybe_reload()
+        return self._contacts.get(normalize_phone_number(phone_number))
+
+    def is_allowed(self, phone_number: str) -> bool:
+        return not self.enabled or self.lookup(phone_number) is not None
+
+    def __contains__(self, phone_number: str) -> bool:
+        return self.is_allowed(phone_number)
+
+    def __len__(self) -> int:
+        self._maybe_reload()
+        return len(self._contacts)
+
+    def _maybe_reload(self):
+        if not self.enabled:
+            return
+        now = time.monotonic()
+        if now < self._next_check:
+            return
+        with self._lock:
+            if now < self._next_check:
+                return
+            self._next_check = now + self.check_interval
+            try:
+                stat = os.stat(self.path)
+            except OSError as e:
+                logger.warning(f"Could not check the contacts file {self.path}: {e}")
+                return
+            signature = (stat.st_mtime_ns, stat.st_size)
+            if signature == self._signature:
+                return
+            try:
+                self._contacts = self._load()
+            except (OSError, ValueError) as e:
+                # keep the contacts loaded before, the file may be being written
+                logger.error(f"Could not load the contacts file {self.path}: {e}")
+                return
+            self._signature = signature
+            self.reloads += 1
+            logger.info(f"Loaded {len(self._contacts)} contacts from {self.path}")
+
+    def _load(self) -> Dict[str, dict]:
+        with open(self.path, "r") as f:
+            contacts = json.load(f)
+        # the dict is built aside and swapped in at once so lookups never see it half built
+        return {
+            normalize_phone_number(contact["phone_number"]): contact
+            for contact in contacts
+            if contact.get("phone_number")
+        }
@@ -0,0 +1,668 @@
+"""
+Storage of the chat sessions (conversations) of every sender.
+
+Sessions can be kept in memory (the default, lost on restart and private
+to the process) or persisted in SQLite or Redis so they survive restarts
+and can be shared by several workers and containers. Persistent stores
+keep a read-through cache of the live chat objects so that the hot path
+doesn't go to the backend on every webhook.
+
+Every persisted session has a version that is bumped on each save. A cached
+session is only served after checking that the stored version didn't change
+(e.g. because another process saved a newer turn), and saving is a
+compare-and-swap on the version: a save based on an older version than the
+stored one raises `SessionConflictError` instead of overwriting the newer one.
+
+Sessions kept in memory live in a bounded `SessionCache` that expires idle
+sessions and evicts the least recently used ones when it grows too large.
+
+Expired sessions are handed to `on_expire` (e.g. to restart the conversation)
+whatever the store. They're found when they're read and, if an `expiry_interval`
+is given, by a background thread that purges them every `expiry_interval` seconds
+(otherwise the sessions nobody writes to again are only expired when they're read).
+"""
+import atexit
+import heapq
+import json
+import logging
+import sqlite3
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from typing import Callable, Optional, Tuple, Union
+from urllib.parse import urlparse
+
+logger = logging.getLogger(__name__)
+
+# compress serialized sessions larger than this many bytes
+COMPRESSION_THRESHOLD = 1024
+
+# attribute of the loaded sessions with the version they were read (or last saved) with
+_VERSION_ATTR = "_session_version"
+
+_ROLE_CODES = {"system": "s", "user": "u", "assistant": "a"}
+_CODE_ROLES = {v: k for k, v in _ROLE_CODES.items()}
+
+
+def _encode_message(message: dict, *fields: str) -> list:
+    """
+    Returns the message as a list of its role code and the given fields,
+    followed by a dict of any other keys it has (e.g. the routing of a message)
+    """
+    encoded = [_ROLE_CODES.get(message["role"], message["role"])] + [message.get(f) for f in fields]
+    extra = {k: v for k, v in message.items() if k != "role" and k not in fields}
+    if extra:
+        encoded.append(extra)
+    return encoded
+
+
+def _decode_message(encoded: list, *fields: str) -> dict:
+    """Returns the message of a list encoded with `_encode_message` (with or without the extra keys)"""
+    message = {"role": _CODE_ROLES.get(encoded[0], encoded[0])}
+    message.update(zip(fields, encoded[1:]))
+    if len(encoded) > len(fields) + 1:
+        message.update(encoded[-1])
+    return message
+
+
+def encode_session(state: dict) -> bytes:
+    """Serializes the state of a session into compact bytes"""
+    state = dict(state)
+    state["messages"] = [_encode_message(m, "content") for m in state.get("messages", [])]
+    state["message_info"] = [_encode_message(m, "content", "timestamp") for m in state.get("message_info", [])]
+    data = json.dumps(state, separators=(",", ":"), ensure_ascii=False).encode("utf-8")
+    if len(data) > COMPRESSION_THRESHOLD:
+        return b"z" + zlib.compress(data)
+    return b"j" + data
+
+
+def decode_session(data: bytes) -> dict:
+    """Deserializes the state of a session encoded with `encode_session`"""
+    if isinstance(data, str):
+        data = data.encode("utf-8")
+    if data[:1] == b"z":
+        data = zlib.decompress(data[1:])
+    else:
+        data = data[1:]
+    state = json.loads(data.decode("utf-8"))
+    state["messages"] = [_decode_message(m, "content") for m in state.get("messages", [])]
+    state["message_info"] = [_decode_message(m, "content", "timestamp") for m in state.get("message_info", [])]
+    return state
+
+
+class SessionConflictError(RuntimeError):
+    """The session was saved by someone else since it was read"""
+
+
+class SessionCache:
+    """
+    A bounded map of live sessions with idle expiration and LRU eviction.
+
+    Expiration deadlines are kept in a single heap (with at most one entry
+    per session) that is only inspected when the cache is accessed, so no
+    timer or job is needed per conversation.
+
+    Parameters
+    ----------
+    ttl : Callable or float, optional
+        Seconds a session can be idle before it expires, or a function returning
+        them for a given session. By default sessions never expire.
+    max_entries : int, optional
+        Maximum number of sessions kept, by default unbounded.
+    max_bytes : int, optional
+        Maximum (approximate) memory held by the sessions, by default unbounded.
+    size_of : Callable, optional
+        Function returning the approximate size in bytes of a session.
+    on_expire : Callable, optional
+        Called with the key and the session when a session expires.
+    """
+
+    def __init__(
+        self,
+        ttl: Union[Callable, float] = None,
+        max_entries: int = None,
+        max_bytes: int = None,
+        size_of: Callable = None,
+        on_expire: Callable = None,
+    ):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.size_of = size_of or (lambda session: 0)
+        self.on_expire = on_expire
+        self.evictions = dict(expired=0, entries=0, bytes=0)
+        self._entries = OrderedDict()  # key -> [session, size, ttl, deadline]
+        self._heap = []  # (deadline, key)
+        self._bytes = 0
+        self._lock = threading.RLock()
+
+    def _ttl_of(self, session) -> Optional[float]:
+        if callable(self.ttl):
+            return self.ttl(session)
+        return self.ttl
+
+    def get(self, key: str, touch: bool = True):
+        """Returns the session of the key (or None) and marks it as recently used"""
+        expired = self.expire()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and touch:
+                self._entries.move_to_end(key)
+                if entry[2] is not None:
+                    entry[3] = time.monotonic() + entry[2]
+        self._notify_expired(expired)
+        return entry[0] if entry is not None else None
+
+    def put(self, key: str, session: object):
+        """Adds or updates a session, evicting the least recently used ones if needed"""
+        size = self.size_of(session)
+        ttl = self._ttl_of(session)
+        deadline = time.monotonic() + ttl if ttl is not None else None
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= old[1]
+            self._entries[key] = [session, size, ttl, deadline]
+            self._bytes += size
+            if deadline is not None and (old is None or old[3] is None):
+                heapq.heappush(self._heap, (deadline, key))
+            self._evict_over_capacity()
+        self._notify_expired(self.expire())
+
+    def pop(self, key: str):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                return None
+            self._bytes -= entry[1]
+            return entry[0]
+
+    def touch(self, key: str):
+        """Restarts the idle timer of the session"""
+        self.get(key, touch=True)
+
+    def _evict_over_capacity(self):
+        while self._entries and (
+            (self.max_entries is not None and len(self._entries) > self.max_entries)
+            or (self.max_bytes is not None and self._bytes > self.max_bytes)
+        ):
+            reason = "entries" if self.max_entries is not None and len(self._entries) > self.max_entries else "bytes"
+            _, (_, size, _, _) = self._entries.popitem(last=False)
+            self._bytes -= size
+            self.evictions[reason] += 1
+
+    def expire(self, now: float = None) -> list:
+        """Removes the sessions whose idle time is over and returns them"""
+        now = time.monotonic() if now is None else now
+        expired = []
+        with self._lock:
+            while self._heap and self._heap[0][0] <= now:
+                _, key = heapq.heappop(self._heap)
+                entry = self._entries.get(key)
+                if entry is None or entry[3] is None:
+                    continue  # evicted or removed
+                if entry[3] > now:
+                    # the session was used since, reschedule it
+                    heapq.heappush(self._heap, (entry[3], key))
+                    continue
+                del self._entries[key]
+                self._bytes -= entry[1]
+                self.evictions["expired"] += 1
+                expired.append((key, entry[0]))
+            if len(self._heap) > 2 * len(self._entries) + 64:
+                # rebuild the heap without the entries of removed sessions
+                self._heap = [(e[3], k) for k, e in self._entries.items() if e[3] is not None]
+                heapq.heapify(self._heap)
+        return expired
+
+    def _notify_expired(self, expired: list):
+        if self.on_expire is None:
+            return
+        for key, session in expired:
+            try:
+                self.on_expire(key, session)
+            except Exception as e:
+                logger.error(f"Error expiring session {key}: {e}")
+
+    def stats(self) -> dict:
+        with self._lock:
+            return dict(
+                entries=len(self._entries),
+                bytes=self._bytes,
+                max_entries=self.max_entries,
+                max_bytes=self.max_bytes,
+                evictions=dict(self.evictions),
+            )
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class SessionStore:
+    """
+    Base class of the session stores.
+
+    Subclasses implement `_read`, `_version`, `_write` and `_remove` on the
+    serialized sessions. Loaded sessions are cached in the process for
+    `cache_seconds` so that consecutive messages of a conversation only check
+    the version of the session in the backend instead of reading it again.
+
+    Parameters
+    ----------
+    session_class : type
+        The class of the sessions, it must implement `to_dict` and `from_dict`.
+    cache_seconds : float, optional
+        Seconds a loaded session is served from the local cache before it is
+        read again from the backend, by default 60
+    session_ttl : float, optional
+        Seconds after the last update when a stored session expires,
+        by default sessions never expire.
+    max_entries : int, optional
+        Maximum number of sessions kept in the local cache.
+    max_bytes : int, optional
+        Maximum approximate memory held by the sessions in the local cache.
+    size_of : Callable, optional
+        Function returning the approximate size in bytes of a session.
+    on_expire : Callable, optional
+        Called with the key and the session when a session expires.
+    expiry_interval : float, optional
+        Seconds between the purges of the expired sessions in a background thread,
+        by default they're only expired when they're read.
+    """
+
+    def __init__(
+        self,
+        session_class: type = None,
+        cache_seconds: float = 60,
+        session_ttl: float = None,
+        max_entries: int = None,
+        max_bytes: int = None,
+        size_of: Callable = None,
+        on_expire: Callable = None,
+        expiry_interval: float = None,
+    ):
+        self.session_class = session_class
+        self.cache_seconds = cache_seconds
+        self.session_ttl = session_ttl
+        self.on_expire = on_expire
+        self.cache = SessionCache(
+            ttl=cache_seconds, max_entries=max_entries, max_bytes=max_bytes, size_of=size_of
+        )
+        self._start_expiry(expiry_interval)
+
+    def get(self, key: str) -> Optional[object]:
+        """Returns the session of the given key or None if there isn't any"""
+        session = self.cache.get(key, touch=False)
+        if session is not None:
+            if getattr(session, _VERSION_ATTR, 0) == self._version(key):
+                return session
+            # saved by another process since it was cached
+            self.cache.pop(key)
+        stored = self._read(key)
+        if stored is None:
+            return None
+        data, version = stored
+        session = self.session_class.from_dict(decode_session(data))
+        setattr(session, _VERSION_ATTR, version)
+        self.cache.put(key, session)
+        return session
+
+    def save(self, key: str, session: object, merge: Callable = None, attempts: int = 3):
+        """
+        Saves the session in the store (write-through). Raises `SessionConflictError`
+        if the stored session was saved by someone else since this one was read.
+
+        If `merge` is given, it's called on a conflict with the state of the stored
+        session (None if it was deleted) to apply the changes of this session on top
+        of it, and the session is saved again, up to `attempts` times in total.
+        """
+        for attempt in range(attempts if merge is not None else 1):
+            expected = getattr(session, _VERSION_ATTR, 0)
+            version = self._write(key, encode_session(session.to_dict()), expected)
+            if version is not None:
+                setattr(session, _VERSION_ATTR, version)
+                self.cache.put(key, session)
+                return
+            self.cache.pop(key)
+            if merge is None or attempt == attempts - 1:
+                break
+            stored = self._read(key)
+            if stored is None:
+                merge(None)
+                setattr(session, _VERSION_ATTR, self._version(key))
+            else:
+                data, stored_version = stored
+                merge(decode_session(data))
+                setattr(session, _VERSION_ATTR, stored_version)
+        raise SessionConflictError(f"The session {key} was updated by another process since it was read")
+
+    def delete(self, key: str):
+        """Deletes the session of the given key from the store"""
+        session = self.cache.pop(key)
+        if session is not None:
+            # saved again as a new session
+            setattr(session, _VERSION_ATTR, 0)
+        self._remove(key)
+
+    def touch(self, key: str):
+        """Restarts the idle timer of the session"""
+        session = self.get(key)
+        if session is not None:
+            self.save(key, session)
+
+    def purge_expired(self) -> int:
+        """Expires the sessions whose time is over and returns how many were expired"""
+        return 0
+
+    def close(self):
+        """Stops the background expiry"""
+        self._closed.set()
+
+    def _start_expiry(self, interval: float = None):
+        self._closed = threading.Event()
+        if not interval:
+            return
+        thread = threading.Thread(target=self._run_expiry, args=(interval,), name="session-expiry", daemon=True)
+        thread.start()
+        atexit.register(self.close)
+
+    def _run_expiry(self, interval: float):
+        while not self._closed.wait(interval):
+            try:
+                self.purge_expired()
+            except Exception as e:
+                logger.error(f"Error purging the expired sessions: {e!r}")
+
+    def _is_expired(self, updated_at: float) -> bool:
+        return self.session_ttl is not None and time.time() - updated_at > self.session_ttl
+
+    def _expired(self, key: str, data: bytes):
+        """Hands a session removed from the backend because it expired to `on_expire`"""
+        self.cache.pop(key)
+        if self.on_expire is None:
+            return
+        try:
+            self.on_expire(key, self.session_class.from_dict(decode_session(data)))
+        except Exception as e:
+            logger.error(f"Error expiring session {key}: {e!r}")
+
+    def stats(self) -> dict:
+        return dict(store=type(self).__name__, cache=self.cache.stats())
+
+    def __contains__(self, key: str) -> bool:
+        return self.get(key) is not None
+
+    def _read(self, key: str) -> Optional[Tuple[bytes, int]]:
+        """Returns the serialized session and its version, or None"""
+        raise NotImplementedError
+
+    def _version(self, key: str) -> int:
+        """Returns the version of the stored session, 0 if there's none"""
+        raise NotImplementedError
+
+    def _write(self, key: str, data: bytes, expected: int) -> Optional[int]:
+        """Stores the session if its stored version is `expected`, returns the new version or None"""
+        raise NotImplementedError
+
+    def _remove(self, key: str):
+        raise NotImplementedError
+
+
+class InMemorySessionStore(SessionStore):
+    """
+    Keeps the live sessions in a bounded cache of the process.
+    Sessions expire when they have been idle for their own ttl (given by `ttl`)
+    and `on_expire` is called with them.
+    """
+
+    def __init__(
+        self,
+        session_class: type = None,
+        ttl: Union[Callable, float] = None,
+        max_entries: int = None,
+        max_bytes: int = None,
+        size_of: Callable = None,
+        on_expire: Callable = None,
+        expiry_interval: float = None,
+        **kwargs,
+    ):
+        self.session_class = session_class
+        self.cache = SessionCache(
+            ttl=ttl, max_entries=max_entries, max_bytes=max_bytes,
+            size_of=size_of, on_expire=on_expire,
+        )
+        self._start_expiry(expiry_interval)
+
+    def get(self, key: str) -> Optional[object]:
+        return self.cache.get(key)
+
+    def save(self, key: str, session: object, merge: Callable = None, attempts: int = 3):
+        # a single process owns the sessions, they can't conflict
+        self.cache.put(key, session)
+
+    def delete(self, key: str):
+        self.cache.pop(key)
+
+    def touch(self, key: str):
+        self.cache.touch(key)
+
+    def purge_expired(self) -> int:
+        expired = self.cache.expire()
+        self.cache._notify_expired(expired)
+        return len(expired)
+
+    def __len__(self):
+        return len(self.cache)
+
+
+class SQLiteSessionStore(SessionStore):
+    """
+    Persists the sessions in a SQLite database in WAL mode,
+    which lets several processes read while one of them writes.
+    """
+
+    def __init__(self, path: str, session_class: type = None, **kwargs):
+        self.path = path
+        self._local = threading.local()
+        conn = self._connection()
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS sessions "
+            "(key TEXT PRIMARY KEY, data BLOB NOT NULL, updated_at REAL NOT NULL, version INTEGER NOT NULL DEFAULT 0)"
+        )
+        columns = {row[1] for row in conn.execute("PRAGMA table_info(sessions)")}
+        if "version" not in columns:
+            # databases created before sessions had versions
+            conn.execute("ALTER TABLE sessions ADD COLUMN version INTEGER NOT NULL DEFAULT 0")
+        super().__init__(session_class, **kwargs)
+
+    def _connection(self) -> sqlite3.Connection:
+        # sqlite connections can't be shared between threads
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def _read(self, key: str) -> Optional[Tuple[bytes, int]]:
+        row = self._connection().execute(
+            "SELECT data, updated_at, version FROM sessions WHERE key = ?", (key,)
+        ).fetchone()
+        if row is None:
+            return None
+        if self._is_expired(row[1]):
+            self._expire_row(key, row[0], row[1])
+            return None
+        return row[0], row[2]
+
+    def _expire_row(self, key: str, data: bytes, updated_at: float) -> bool:
+        # unless it was saved again since it was read
+        cursor = self._connection().execute(
+            "DELETE FROM sessions WHERE key = ? AND updated_at = ?", (key, updated_at)
+        )
+        if not cursor.rowcount:
+            return False
+        self._expired(key, data)
+        return True
+
+    def _version(self, key: str) -> int:
+        row = self._connection().execute("SELECT version FROM sessions WHERE key = ?", (key,)).fetchone()
+        return row[0] if row is not None else 0
+
+    def _write(self, key: str, data: bytes, expected: int) -> Optional[int]:
+        # a new row, or an update of the row if nobody saved it since it was read
+        cursor = self._connection().execute(
+            "INSERT INTO sessions (key, data, updated_at, version) VALUES (?, ?, ?, ?) "
+            "ON CONFLICT(key) DO UPDATE SET data = excluded.data, updated_at = excluded.updated_at, "
+            "version = excluded.version WHERE sessions.version = ?",
+            (key, data, time.time(), expected + 1, expected),
+        )
+        return expected + 1 if cursor.rowcount else None
+
+    def _remove(self, key: str):
+        self._connection().execute("DELETE FROM sessions WHERE key = ?", (key,))
+
+    def purge_expired(self) -> int:
+        """Deletes the expired sessions from the database and returns how many were deleted"""
+        if self.session_ttl is None:
+            return 0
+        rows = self._connection().execute(
+            "SELECT key, data, updated_at FROM sessions WHERE updated_at < ?", (time.time() - self.session_ttl,)
+        ).fetchall()
+        return sum(self._expire_row(key, data, updated_at) for key, data, updated_at in rows)
+
+    def __len__(self):
+        return self._connection().execute("SELECT COUNT(*) FROM sessions").fetchone()[0]
+
+
+class RedisSessionStore(SessionStore):
+    """
+    Persists the sessions in a Redis server (or anything that speaks its protocol).
+
+    The update time of every session is kept in a sorted set to find the expired
+    ones. Their keys also expire in Redis after twice the ttl of the sessions,
+    in case no process purges them.
+
+    Parameters
+    ----------
+    url : str, optional
+        The url of the server, e.g. "redis://localhost:6379/0"
+    client : object, optional
+        An already created redis client (e.g. a `fakeredis.FakeRedis` for a local
+        stand-in). Used instead of connecting to `url`.
+    prefix : str, optional
+        Prefix of the keys of the sessions, by default "chat:session:"
+    """
+
+    def __init__(
+        self,
+        url: str = None,
+        client: object = None,
+        prefix: str = "chat:session:",
+        session_class: type = None,
+        **kwargs,
+    ):
+        if client is None:
+            try:
+                import redis
+            except ImportError as e:
+                raise ImportError("The `redis` package is required to store sessions in Redis") from e
+            client = redis.Redis.from_url(url)
+        self.client = client
+        self.prefix = prefix
+        # sorted set of the keys of the sessions by their update time
+        self.updated_key = prefix + "updated_at"
+        super().__init__(session_class, **kwargs)
+
+    def _read(self, key: str) -> Optional[Tuple[bytes, int]]:
+        data, version = self.client.mget(self.prefix + key, self.prefix + key + ":version")
+        if data is None:
+            return None
+        updated_at = self.client.zscore(self.updated_key, key)
+        if updated_at is not None and self._is_expired(updated_at):
+            self._expire_key(key, updated_at)
+            return None
+        return data, int(version or 0)
+
+    def _expire_key(self, key: str, updated_at: float) -> bool:
+        from redis.exceptions import WatchError
+
+        version_key = self.prefix + key + ":version"
+        with self.client.pipeline() as pipe:
+            try:
+                # unless it's saved again meanwhile
+                pipe.watch(version_key)
+                if pipe.zscore(self.updated_key, key) != updated_at:
+                    return False
+                data = pipe.get(self.prefix + key)
+                pipe.multi()
+                pipe.delete(self.prefix + key, version_key)
+                pipe.zrem(self.updated_key, key)
+                pipe.execute()
+            except WatchError:
+                return False
+        if data is None:
+            # its keys already expired in redis
+            return False
+        self._expired(key, data)
+        return True
+
+    def purge_expired(self) -> int:
+        """Deletes the expired sessions and returns how many were deleted"""
+        if self.session_ttl is None:
+            return 0
+        expired = self.client.zrangebyscore(self.updated_key, "-inf", time.time() - self.session_ttl, withscores=True)
+        return sum(
+            self._expire_key(key.decode() if isinstance(key, bytes) else key, updated_at)
+            for key, updated_at in expired
+        )
+
+    def _version(self, key: str) -> int:
+        return int(self.client.get(self.prefix + key + ":version") or 0)
+
+    def _write(self, key: str, data: bytes, expected: int) -> Optional[int]:
+        from redis.exceptions import WatchError
+
+        version_key = self.prefix + key + ":version"
+        ex = int(2 * self.session_ttl) if self.session_ttl is not None else None
+        with self.client.pipeline() as pipe:
+            try:
+                # the transaction fails if the version changes between the check and the write
+                pipe.watch(version_key)
+                if int(pipe.get(version_key) or 0) != expected:
+                    return None
+                pipe.multi()
+                pipe.set(self.prefix + key, data, ex=ex)
+                pipe.set(version_key, expected + 1, ex=ex)
+                pipe.zadd(self.updated_key, {key: time.time()})
+                pipe.execute()
+            except WatchError:
+                return None
+        return expected + 1
+
+    def _remove(self, key: str):
+        self.client.delete(self.prefix + key, self.prefix + key + ":version")
+        self.client.zrem(self.updated_key, key)
+
+
+def make_session_store(uri: str = None, session_class: type = None, **kwargs) -> SessionStore:
+    """
+    Creates the session store given by the uri:
+    "memory://" (default), "sqlite:///path/to/sessions.db" or "redis://host:port/db"
+    """
+    if not uri or uri.startswith("memory:"):
+        kwargs.pop("cache_seconds", None)
+        kwargs.pop("session_ttl", None)
+        return InMemorySessionStore(session_class, **kwargs)
+    kwargs.pop("ttl", None)
+    scheme = urlparse(uri).scheme
+    if scheme == "sqlite":
+        return SQLiteSessionStore(uri[len("sqlite:///"):], session_class, **kwargs)
+    if scheme in ("redis", "rediss", "unix"):
+        return RedisSessionStore(uri, session_class=session_class, **kwargs)
+    raise ValueError(f"Unsupported session store: {uri}")
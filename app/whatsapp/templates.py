@@ -0,0 +1,77 @@
+"""
+Rendering of the start template (the system message of the conversations).
+
+The template is parsed once into its literal text and its fields, and the
+rendered messages are cached per (user, day), so rendering the system message
+of a known sender on the same day is a dictionary lookup.
+"""
+import os
+from datetime import date
+from functools import lru_cache
+from string import Formatter
+from typing import List, Tuple
+
+__all__ = [
+    "StartTemplate",
+]
+
+
+class StartTemplate:
+    """
+    A compiled `str.format` template with the fields `{user}` (also `{CHATTER}`),
+    `{today}` and `{agent_name}` (also `{AGENT_NAME}`). Any other field is left
+    as it is in the rendered text.
+
+    Parameters
+    ----------
+    template : str
+        The template or the path to a file with it.
+    agent_name : str, optional
+        The name of the agent, by default "Assistant"
+    cache_size : int, optional
+        Maximum number of rendered messages cached, by default 4096
+    """
+
+    def __init__(self, template: str, agent_name: str = None, cache_size: int = 4096):
+        if template and os.path.exists(template):
+            with open(template, "r") as f:
+                template = f.read()
+        self.template = template or ""
+        self.agent_name = agent_name or "Assistant"
+        self._parts = self._compile(self.template)
+        self.render = lru_cache(maxsize=cache_size)(self._render)
+
+    @staticmethod
+    def _compile(template: str) -> List[Tuple[str, str, str]]:
+        """Splits the template into (literal, field, original text of the field) parts"""
+        parts = []
+        for literal, field, spec, conversion in Formatter().parse(template):
+            # escaped braces are unescaped by the parser, keep them as literal text
+            original = None
+            if field is not None:
+                original = "{" + field + (f"!{conversion}" if conversion else "") + (f":{spec}" if spec else "") + "}"
+            parts.append((literal, field, original))
+        return parts
+
+    def _render(self, user: str, today: str = None) -> str:
+        values = {
+            "user": user,
+            "CHATTER": user,
+            "today": today,
+            "agent_name": self.agent_name,
+            "AGENT_NAME": self.agent_name,
+        }
+        pieces = []
+        for literal, field, original in self._parts:
+            pieces.append(literal)
+            if field is not None:
+                value = values.get(field)
+                pieces.append(original if value is None else str(value))
+        return "".join(pieces)
+
+    def render_today(self, user: str) -> str:
+        """Renders the template for the user and the current day"""
+        return self.render(user, date.today().strftime("%Y-%m-%d"))
+
+    def cache_info(self):
+        return self.render.cache_info()
@@ -0,0 +1,257 @@
+"""
+Background processing of incoming messages.
+
+The webhook routes only parse and enqueue the incoming messages while
+a pool of async workers, running in their own event loop in a background
+thread, executes the (slow) handler chain for each of them. Every sender
+has its own queue so that every conversation is processed in order, while
+the messages of different senders never wait for each other.
+"""
+import asyncio
+import logging
+import threading
+import time
+from collections import deque
+from functools import partial
+from typing import Any, Awaitable, Callable, Deque, Dict, Set
+
+logger = logging.getLogger(__name__)
+
+
+async def run_blocking(func: Callable, *args, **kwargs):
+    """Runs a blocking function in the default executor without blocking the event loop"""
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(None, partial(func, *args, **kwargs))
+
+
+class BackgroundLoop:
+    """An asyncio event loop running forever in a daemon thread"""
+
+    def __init__(self, name: str = "background-loop"):
+        self.name = name
+        self.loop = None
+        self._thread = None
+        self._started = threading.Event()
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        if self.running:
+            return self
+        self._started.clear()
+        self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+        self._thread.start()
+        self._started.wait()
+        return self
+
+    def _run(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.loop.call_soon(self._started.set)
+        try:
+            self.loop.run_forever()
+        finally:
+            self.loop.close()
+
+    def submit(self, coro: Awaitable):
+        """Schedules a coroutine in the loop from any thread and returns a concurrent future"""
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def call_soon(self, callback: Callable, *args):
+        self.loop.call_soon_threadsafe(callback, *args)
+
+    def stop(self, timeout: float = None):
+        if not self.running:
+            return
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join(timeout)
+
+
+class WorkerPool:
+    """
+    A pool of async workers consuming a queue of items per key.
+
+    Items submitted with the same key (e.g. the phone number of the sender)
+    are processed strictly in order, one at a time, while items with different
+    keys are processed concurrently, up to `num_workers` items at the same time.
+    A slow item only holds its own slot: the items of other keys keep being
+    processed in the others.
+
+    Parameters
+    ----------
+    handler : Callable
+        The coroutine function called with each submitted item.
+    num_workers : int, optional
+        The maximum number of items processed at the same time, by default 4
+    max_queue_size : int, optional
+        The maximum number of items waiting to be processed across all the keys.
+        Items submitted when the pool is full are rejected. By default 1000
+    key : Callable, optional
+        Function returning the ordering key of an item when no key is given
+        on submission. Items without a key aren't ordered.
+    on_start : Callable, optional
+        Coroutine function awaited in the loop of the workers when the pool starts,
+        e.g. to open the connection pools shared by the workers.
+    on_stop : Callable, optional
+        Coroutine function awaited in the loop of the workers when the pool stops.
+    name : str, optional
+        Name of the pool used for its thread and its logs, by default "workers"
+    """
+
+    def __init__(
+        self,
+        handler: Callable[[Any], Awaitable],
+        num_workers: int = 4,
+        max_queue_size: int = 1000,
+        key: Callable[[Any], str] = None,
+        on_start: Callable[[], Awaitable] = None,
+        on_stop: Callable[[], Awaitable] = None,
+        name: str = "workers",
+    ):
+        self.handler = handler
+        self.on_start = on_start
+        self.on_stop = on_stop
+        self.num_workers = num_workers
+        self.max_queue_size = max_queue_size
+        self.key = key
+        self.name = name
+        self.background = BackgroundLoop(name=name)
+        # items waiting for each key with items waiting or in process (only used in the loop)
+        self._pending: Dict[Any, Deque] = {}
+        self._tasks: Set[asyncio.Task] = set()
+        self._semaphore = None
+        self._lock = threading.Lock()
+        self._queued = 0
+        self._busy = 0
+        self._busy_time = 0.0
+        self._started_at = None
+        self.processed = 0
+        self.failed = 0
+        self.rejected = 0
+
+    @property
+    def loop(self):
+        return self.background.loop
+
+    @property
+    def running(self) -> bool:
+        return self.background.running
+
+    @property
+    def queue_depth(self) -> int:
+        """Items waiting to be processed"""
+        return self._queued
+
+    def start(self):
+        if self.running:
+            return self
+        self.background.start()
+        self.background.submit(self._start_workers()).result()
+        self._started_at = time.monotonic()
+        logger.info(f"Started worker pool '{self.name}' with {self.num_workers} workers")
+        return self
+
+    async def _start_workers(self):
+        if self.on_start is not None:
+            await self.on_start()
+        self._semaphore = asyncio.Semaphore(self.num_workers)
+
+    def submit(self, item: Any, key: str = None) -> bool:
+        """
+        Enqueues an item to be processed by the workers from any thread.
+        Returns False if the item was rejected because the pool is full.
+        """
+        if key is None and self.key is not None:
+            key = self.key(item)
+        with self._lock:
+            if self._queued >= self.max_queue_size:
+                self.rejected += 1
+                return False
+            self._queued += 1
+        self.background.call_soon(self._enqueue, item, key)
+        return True
+
+    def _enqueue(self, item: Any, key: str = None):
+        if key is None:
+            self._spawn(self._drain(None, deque([item])))
+            return
+        pending = self._pending.get(key)
+        if pending is not None:
+            # processed by the task already draining the key
+            pending.append(item)
+            return
+        self._pending[key] = deque([item])
+        self._spawn(self._drain(key, self._pending[key]))
+
+    def _spawn(self, coro: Awaitable):
+        task = asyncio.ensure_future(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _drain(self, key: Any, pending: Deque):
+        try:
+            while pending:
+                item = pending.popleft()
+                async with self._semaphore:
+                    await self._process(item)
+        finally:
+            if key is not None:
+                # nothing can be added between the last check and this (same loop, no await)
+                del self._pending[key]
+
+    async def _process(self, item: Any):
+        with self._lock:
+            self._queued -= 1
+            self._busy += 1
+        start = time.monotonic()
+        try:
+            await self.handler(item)
+            self.processed += 1
+        except Exception as e:
+            self.failed += 1
+            logger.exception(f"Worker of '{self.name}' failed processing an item: {e}")
+        finally:
+            with self._lock:
+                self._busy -= 1
+                self._busy_time += time.monotonic() - start
+
+    def stats(self) -> dict:
+        """Returns the current queue depth and worker utilisation of the pool"""
+        with self._lock:
+            queued, busy, busy_time = self._queued, self._busy, self._busy_time
+        # read from another thread, the sizes are a snapshot
+        pending = list(self._pending.values())
+        uptime = time.monotonic() - self._started_at if self._started_at else 0.0
+        return dict(
+            name=self.name,
+            running=self.running,
+            workers=self.num_workers,
+            busy_workers=busy,
+            queue_depth=queued,
+            active_keys=len(pending),
+            max_key_queue_depth=max((len(p) for p in pending), default=0),
+            max_queue_size=self.max_queue_size,
+            utilisation=busy_time / (uptime * self.num_workers) if uptime else 0.0,
+            processed=self.processed,
+            failed=self.failed,
+            rejected=self.rejected,
+        )
+
+    def stop(self, timeout: float = None):
+        if not self.running:
+            return
+        self.background.submit(self._stop_workers()).result(timeout)
+        self.background.stop(timeout)
+
+    async def _stop_workers(self):
+        tasks = list(self._tasks)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._pending.clear()
+        with self._lock:
+            self._queued = 0
+        if self.on_stop is not None:
+            await self.on_stop()
@@ -0,0 +1,319 @@
+"""
+Local stand-ins of the APIs used by the bot, for benchmarks that need no accounts.
+
+Every stand-in answers after a delay drawn from a `Latency` distribution:
+
+- OpenAI: chat completions (also streamed), completions, moderations, image
+  generations, embeddings and audio transcriptions under /v1
+- Twilio: the Messages API, which records every message it receives
+- AssemblyAI: uploads, and transcripts that complete after their latency, polled or
+  notified through their webhook
+- Media: deterministic audio and image files served at /media/{name}
+"""
+import asyncio
+import hashlib
+import itertools
+import json
+import random
+import time
+from dataclasses import dataclass
+
+import aiohttp
+from aiohttp import web
+
+__all__ = [
+    "Latency",
+    "make_openai_app",
+    "make_twilio_app",
+    "make_assemblyai_app",
+    "make_media_app",
+    "start_server",
+]
+
+REPLIES = [
+    "Sure! Here is a short answer to your question, I hope it helps.",
+    "That's a great question. There are a few things to keep in mind: first, take your time; "
+    "second, ask for help when you need it; and third, enjoy the process.",
+    "Of course, coming right up! [img:\"a cat wearing a hat\"]",
+    "I'm glad to hear that! Let me know if there's anything else I can do for you today.",
+]
+
+
+@dataclass
+class Latency:
+    """
+    A distribution of delays given as "fixed:0.2", "uniform:0.1,0.3" or
+    "lognormal:0.8,0.5" (median in seconds and sigma).
+    """
+
+    kind: str = "fixed"
+    a: float = 0.0
+    b: float = 0.0
+
+    @classmethod
+    def parse(cls, spec) -> "Latency":
+        if isinstance(spec, Latency):
+            return spec
+        if isinstance(spec, (int, float)):
+            return cls("fixed", float(spec))
+        kind, _, params = str(spec).partition(":")
+        if not params:
+            return cls("fixed", float(kind))
+        values = [float(v) for v in params.split(",")]
+        return cls(kind, *values)
+
+    def sample(self) -> float:
+        if self.kind == "fixed":
+            return self.a
+        if self.kind == "uniform":
+            return random.uniform(self.a, self.b)
+        if self.kind == "lognormal":
+            return random.lognormvariate(0, self.b) * self.a
+        raise ValueError(f"Unknown latency distribution '{self.kind}'")
+
+    async def wait(self):
+        await asyncio.sleep(max(0.0, self.sample()))
+
+
+def _completion_id() -> str:
+    return "chatcmpl-" + hashlib.md5(str(time.time_ns()).encode()).hexdigest()[:24]
+
+
+def make_openai_app(
+    latency="fixed:0.5", token_latency="fixed:0.01", images_latency="fixed:3", media_base: str = None,
+) -> web.Application:
+    """
+    Creates a stand-in of OpenAI's API. Streamed chat completions send the
+    first token after `latency` and every next one after `token_latency`.
+    The urls of the generated images point to `media_base` (see `make_media_app`).
+    """
+    latency, token_latency, images_latency = map(Latency.parse, (latency, token_latency, images_latency))
+    app = web.Application()
+    image_ids = itertools.count(1)
+
+    async def chat_completions(request):
+        data = await request.json()
+        reply = random.choice(REPLIES)
+        prompt_tokens = sum(len(m.get("content") or "") // 4 for m in data.get("messages", []))
+        await latency.wait()
+        if not data.get("stream"):
+            return web.json_response({
+                "id": _completion_id(),
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": data.get("model"),
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": reply}, "finish_reason": "stop"}],
+                "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": len(reply) // 4,
+                          "total_tokens": prompt_tokens + len(reply) // 4},
+            })
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+        completion_id = _completion_id()
+        for i, word in enumerate(reply.split(" ")):
+            if i > 0:
+                await token_latency.wait()
+            chunk = {
+                "id": completion_id,
+                "object": "chat.completion.chunk",
+                "created": int(time.time()),
+                "model": data.get("model"),
+                "choices": [{"index": 0, "delta": {"content": word if i == 0 else " " + word}, "finish_reason": None}],
+            }
+            await response.write(f"data: {json.dumps(chunk)}\n\n".encode())
+        await response.write(b"data: [DONE]\n\n")
+        await response.write_eof()
+        return response
+
+    async def completions(request):
+        data = await request.json()
+        await latency.wait()
+        return web.json_response({
+            "id": _completion_id(),
+            "object": "text_completion",
+            "model": data.get("model"),
+            "choices": [{"index": 0, "text": " english", "finish_reason": "stop"}],
+        })
+
+    async def moderations(request):
+        data = await request.json()
+        inputs = data.get("input")
+        inputs = [inputs] if isinstance(inputs, str) else inputs
+        await latency.wait()
+        categories = ["hate", "hate/threatening", "self-harm", "sexual", "sexual/minors", "violence", "violence/graphic"]
+        return web.json_response({
+            "id": "modr-" + _completion_id()[9:],
+            "model": "text-moderation-latest",
+            "results": [
+                {
+                    "flagged": False,
+                    "categories": {c: False for c in categories},
+                    "category_scores": {c: random.random() * 1e-3 for c in categories},
+                }
+                for _ in inputs
+            ],
+        })
+
+    async def image_generations(request):
+        data = await request.json()
+        await images_latency.wait()
+        base = media_base or f"{request.scheme}://{request.host}"
+        return web.json_response({
+            "created": int(time.time()),
+            "data": [{"url": f"{base}/media/image-{next(image_ids)}.png"} for _ in range(data.get("n", 1))],
+        })
+
+    async def embeddings(request):
+        data = await request.json()
+        inputs = data.get("input")
+        inputs = [inputs] if isinstance(inputs, str) else inputs
+        await latency.wait()
+        results = []
+        for i, text in enumerate(inputs):
+            # the same text always gets the same (unit length) embedding
+            rng = random.Random(hashlib.sha256(str(text).encode()).digest())
+            vector = [rng.gauss(0, 1) for _ in range(1536)]
+            norm = sum(v * v for v in vector) ** 0.5
+            results.append({"object": "embedding", "index": i, "embedding": [v / norm for v in vector]})
+        return web.json_response({
+            "object": "list",
+            "model": data.get("model"),
+            "data": results,
+            "usage": {"prompt_tokens": sum(len(str(t)) // 4 for t in inputs), "total_tokens": sum(len(str(t)) // 4 for t in inputs)},
+        })
+
+    async def audio_transcriptions(request):
+        await request.read()
+        await latency.wait()
+        return web.json_response({"text": "This is a transcribed voice note."})
+
+    app.router.add_post("/v1/chat/completions", chat_completions)
+    app.router.add_post("/v1/completions", completions)
+    app.router.add_post("/v1/moderations", moderations)
+    app.router.add_post("/v1/images/generations", image_generations)
+    app.router.add_post("/v1/embeddings", embeddings)
+    app.router.add_post("/v1/audio/transcriptions", audio_transcriptions)
+    app.router.add_post("/v1/audio/translations", audio_transcriptions)
+    return app
+
+
+def make_twilio_app(latency="fixed:0.2") -> web.Application:
+    """
+    Creates a stand-in of Twilio's Messages API. The messages it receives are
+    recorded as (time, to, body, media url) in `app["messages"]`.
+    """
+    latency = Latency.parse(latency)
+    app = web.Application()
+    sids = itertools.count(1)
+    messages = []
+    app["messages"] = messages
+
+    async def create_message(request):
+        form = await request.post()
+        await latency.wait()
+        messages.append((time.monotonic(), form.get("To"), form.get("Body"), form.get("MediaUrl")))
+        return web.json_response(
+            {
+                "sid": f"SM{next(sids):032d}",
+                "account_sid": request.match_info["account_sid"],
+                "from": form.get("From"),
+                "to": form.get("To"),
+                "body": form.get("Body"),
+                "status": "queued",
+            },
+            status=201,
+        )
+
+    app.router.add_post("/2010-04-01/Accounts/{account_sid}/Messages.json", create_message)
+    return app
+
+
+def make_assemblyai_app(latency="fixed:2") -> web.Application:
+    """
+    Creates a stand-in of AssemblyAI's upload and transcripts API. A transcript is
+    "processing" until its latency passes and then "completed"; if it was
+    created with a webhook url, the webhook is called at that moment.
+    """
+    latency = Latency.parse(latency)
+    app = web.Application()
+    transcripts = {}
+    ids = itertools.count(1)
+    tasks = set()
+
+    async def notify(transcript_id, url, headers):
+        await asyncio.sleep(transcripts[transcript_id]["ready_at"] - time.monotonic())
+        async with aiohttp.ClientSession() as session:
+            async with session.post(url, json={"transcript_id": transcript_id, "status": "completed"}, headers=headers):
+                pass
+
+    async def create_transcript(request):
+        data = await request.json()
+        transcript_id = f"tr{next(ids):08d}"
+        transcripts[transcript_id] = dict(data, id=transcript_id, ready_at=time.monotonic() + max(0.0, latency.sample()))
+        if data.get("webhook_url"):
+            headers = {}
+            if data.get("webhook_auth_header_name"):
+                headers[data["webhook_auth_header_name"]] = data.get("webhook_auth_header_value", "")
+            task = asyncio.ensure_future(notify(transcript_id, data["webhook_url"], headers))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+        return web.json_response({"id": transcript_id, "status": "queued"})
+
+    async def upload(request):
+        # the content isn't kept, only its size
+        size = 0
+        async for chunk in request.content.iter_any():
+            size += len(chunk)
+        app["uploaded_bytes"] += size
+        return web.json_response({"upload_url": f"{request.url.origin()}/uploads/{next(ids):08d}"})
+
+    async def get_transcript(request):
+        transcript = transcripts.get(request.match_info["transcript_id"])
+        if transcript is None:
+            return web.json_response({"error": "not found"}, status=404)
+        if time.monotonic() < transcript["ready_at"]:
+            return web.json_response({"id": transcript["id"], "status": "processing"})
+        return web.json_response({
+            "id": transcript["id"],
+            "status": "completed",
+            "text": "Hello, this is a voice note asking how the weather will be tomorrow.",
+            "language_code": transcript.get("language_code", "en"),
+            "audio_url": transcript.get("audio_url"),
+        })
+
+    app["uploaded_bytes"] = 0
+    app.router.add_post("/v2/upload", upload)
+    app.router.add_post("/v2/transcript", create_transcript)
+    app.router.add_get("/v2/transcript/{transcript_id}", get_transcript)
+    return app
+
+
+def make_media_app(latency="fixed:0.05", size: int = 32 * 1024) -> web.Application:
+    """
+    Creates a server of media files. The content of /media/{name} only depends
+    on its name (and the `size` query parameter), so the same url is the same file.
+    """
+    latency = Latency.parse(latency)
+    app = web.Application()
+    content_types = {"ogg": "audio/ogg", "mp3": "audio/mpeg", "jpg": "image/jpeg", "png": "image/png"}
+
+    async def get_media(request):
+        name = request.match_info["name"]
+        num_bytes = int(request.query.get("size", size))
+        await latency.wait()
+        seed = hashlib.sha256(name.encode()).digest()
+        body = (seed * (num_bytes // len(seed) + 1))[:num_bytes]
+        content_type = content_types.get(name.rsplit(".", 1)[-1], "application/octet-stream")
+        return web.Response(body=body, content_type=content_type)
+
+    app.router.add_get("/media/{name}", get_media)
+    return app
+
+
+async def start_server(app: web.Application, port: int = 0):
+    """Starts the app in the running loop and returns its runner and base url"""
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", port)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    return runner, f"http://127.0.0.1:{port}"
@@ -0,0 +1,348 @@
+"""
+Load test of the WhatsApp webhook against local stand-ins of OpenAI, Twilio and AssemblyAI
+
+The bot is served (with its real handler chain) on a local port with every API
+pointed to the stand-ins of `benchmarks.fakes`. Twilio webhook requests of text,
+voice note and image messages are sent at a target rate (with Poisson arrivals)
+and the latencies, throughput and error rates are reported. A report can be
+saved as a baseline and later runs compared against it.
+
+Usage
+-----
+python -m benchmarks.load --rate 20 --duration 30 --save-baseline benchmarks/baselines/default.json
+python -m benchmarks.load --rate 20 --duration 30 --compare benchmarks/baselines/default.json
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import re
+import threading
+import time
+from typing import Dict, List
+
+import aiohttp
+
+from app.workers import BackgroundLoop
+from benchmarks.fakes import (
+    make_assemblyai_app,
+    make_media_app,
+    make_openai_app,
+    make_twilio_app,
+    start_server,
+)
+
+# metrics compared against the baseline, and whether higher is better
+COMPARED_METRICS = {
+    "throughput": True,
+    "replies_per_second": True,
+    "error_rate": False,
+    "latency_p50": False,
+    "latency_p95": False,
+    "latency_p99": False,
+}
+
+
+def parse_mix(value: str) -> Dict[str, float]:
+    """Parses the mix of message types given as "text=0.8,audio=0.15,image=0.05" """
+    mix = {}
+    for item in value.split(","):
+        kind, _, weight = item.partition("=")
+        mix[kind.strip()] = float(weight)
+    unknown = set(mix) - {"text", "audio", "image"}
+    if unknown:
+        raise ValueError(f"Unknown message types {unknown}")
+    return mix
+
+
+TEXTS = [
+    "Hi! How are you doing today?",
+    "Can you help me write an email to my landlord about a broken heater?",
+    "What's the capital of Australia?",
+    "Send me a picture of a cat wearing a hat please",
+    "Thanks, that was really useful",
+    "Hola, ¿me puedes recomendar un libro para el verano?",
+    "Explain what a black hole is in two sentences",
+]
+
+
+def make_payload(kind: str, sender: str, index: int, media_base: str, audio_variety: int) -> dict:
+    """Returns the form of a Twilio webhook request for a message of the given kind"""
+    sid = f"SM{index:032d}"
+    payload = {
+        "SmsMessageSid": sid,
+        "MessageSid": sid,
+        "SmsSid": sid,
+        "AccountSid": "ACbenchmark",
+        "From": sender,
+        "To": "whatsapp:+14155238886",
+        "WaId": sender.split("+")[-1],
+        "ProfileName": f"User {sender[-4:]}",
+        "SmsStatus": "received",
+        "NumSegments": "1",
+        "ReferralNumMedia": "0",
+        "ApiVersion": "2010-04-01",
+        "Body": "",
+        "NumMedia": "0",
+    }
+    if kind == "text":
+        payload["Body"] = random.choice(TEXTS)
+    elif kind == "audio":
+        # a limited number of different voice notes, as if some were forwarded
+        payload.update(
+            NumMedia="1",
+            MediaContentType0="audio/ogg",
+            MediaUrl0=f"{media_base}/media/voice-{random.randrange(audio_variety)}.ogg",
+        )
+    else:
+        payload.update(
+            NumMedia="1",
+            MediaContentType0="image/jpeg",
+            MediaUrl0=f"{media_base}/media/photo-{index}.jpg",
+        )
+    return payload
+
+
+def percentile(values: List[float], q: float) -> float:
+    """Returns the q-th (0-100) percentile of the values (nearest rank)"""
+    if not values:
+        return 0.0
+    values = sorted(values)
+    rank = max(0, min(len(values) - 1, int(round(q / 100 * len(values) + 0.5)) - 1))
+    return values[rank]
+
+
+def parse_stage_means(metrics_text: str) -> Dict[str, float]:
+    """Returns the mean seconds of each stage from the text of /metrics"""
+    sums, counts = {}, {}
+    for line in metrics_text.splitlines():
+        match = re.match(r'whatsapp_stage_seconds_(sum|count)\{stage="([^"]+)"\} (\S+)', line)
+        if match:
+            kind, stage, value = match.groups()
+            (sums if kind == "sum" else counts)[stage] = float(value)
+    return {stage: sums[stage] / counts[stage] for stage in sums if counts.get(stage)}
+
+
+async def start_fakes(args) -> dict:
+    """Starts the stand-ins in the running loop and returns their urls"""
+    media_runner, media_url = await start_server(make_media_app(args.media_latency))
+    openai_runner, openai_url = await start_server(make_openai_app(
+        args.openai_latency, args.token_latency, args.images_latency, media_base=media_url))
+    twilio_app = make_twilio_app(args.twilio_latency)
+    twilio_runner, twilio_url = await start_server(twilio_app)
+    assemblyai_runner, assemblyai_url = await start_server(make_assemblyai_app(args.assemblyai_latency))
+    return dict(
+        media=media_url, openai=openai_url, twilio=twilio_url, assemblyai=assemblyai_url,
+        twilio_messages=twilio_app["messages"],
+        runners=[media_runner, openai_runner, twilio_runner, assemblyai_runner],
+    )
+
+
+def serve_bot(fakes: dict, args):
+    """Configures the bot to use the stand-ins and serves it in a thread. Returns the server."""
+    os.environ.update(
+        CHAT_START_TEMPLATE=os.environ.get("CHAT_START_TEMPLATE", "data/start_template.txt"),
+        TWILIO_ACCOUNT_SID="ACbenchmark",
+        TWILIO_AUTH_TOKEN="benchmark",
+        TWILIO_API_BASE=fakes["twilio"],
+        ASSEMBLYAI_API_BASE=fakes["assemblyai"],
+        ASSEMBLYAI_API_KEY="benchmark",
+        OPENAI_API_KEY="sk-benchmark",
+        OPENAI_API_BASE=fakes["openai"] + "/v1",
+        BACKGROUND_PROCESSING=str(args.background).lower(),
+        STREAM_REPLIES=str(args.stream).lower(),
+        LOG_LEVEL=os.environ.get("LOG_LEVEL", "WARNING"),
+        LOG_ROOT_LEVEL=os.environ.get("LOG_ROOT_LEVEL", "WARNING"),
+    )
+    import openai
+    from werkzeug.serving import make_server
+
+    openai.api_key = os.environ["OPENAI_API_KEY"]
+    openai.api_base = os.environ["OPENAI_API_BASE"]
+    # imported here since the app is configured from the environment when imported
+    from app.whatsapp.app import app
+
+    # don't log every request
+    logging.getLogger("werkzeug").setLevel(logging.WARNING)
+    server = make_server("127.0.0.1", args.port, app, threaded=True)
+    threading.Thread(target=server.serve_forever, name="bot-server", daemon=True).start()
+    return server
+
+
+async def generate_load(url: str, media_base: str, args) -> List[dict]:
+    """Sends webhook requests with Poisson arrivals at the target rate and returns their results"""
+    mix = parse_mix(args.mix)
+    kinds, weights = list(mix), list(mix.values())
+    senders = [f"whatsapp:+1555{i:07d}" for i in range(args.senders)]
+    results = []
+    connector = aiohttp.TCPConnector(limit=args.max_connections)
+    timeout = aiohttp.ClientTimeout(total=args.timeout)
+
+    async def send(session, index):
+        kind = random.choices(kinds, weights)[0]
+        payload = make_payload(kind, random.choice(senders), index, media_base, args.audio_variety)
+        start = time.perf_counter()
+        status = None
+        try:
+            async with session.post(url, data=payload) as response:
+                await response.read()
+                status = response.status
+        except Exception as e:
+            status = type(e).__name__
+        results.append(dict(kind=kind, status=status, latency=time.perf_counter() - start))
+
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+        tasks = []
+        start = time.perf_counter()
+        next_at = 0.0
+        index = 0
+        while next_at < args.duration:
+            delay = start + next_at - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            tasks.append(asyncio.ensure_future(send(session, index)))
+            index += 1
+            next_at += random.expovariate(args.rate)
+        await asyncio.gather(*tasks)
+    return results
+
+
+async def wait_until_idle(base_url: str, timeout: float):
+    """Waits until the background workers of the bot have processed every queued message"""
+    deadline = time.monotonic() + timeout
+    async with aiohttp.ClientSession() as session:
+        while time.monotonic() < deadline:
+            async with session.get(f"{base_url}/whatsapp/workers") as response:
+                stats = await response.json()
+            if stats.get("queue_depth", 0) == 0 and stats.get("busy_workers", 0) == 0:
+                return
+            await asyncio.sleep(0.2)
+
+
+async def fetch_metrics(base_url: str) -> str:
+    async with aiohttp.ClientSession() as session:
+        async with session.get(f"{base_url}/metrics") as response:
+            return await response.text()
+
+
+def summarize(results: List[dict], elapsed: float, replies: int, stage_means: dict, args) -> dict:
+    ok = [r for r in results if isinstance(r["status"], int) and r["status"] < 400]
+    latencies = [r["latency"] for r in ok]
+    summary = dict(
+        config=dict(
+            rate=args.rate, duration=args.duration, senders=args.senders, mix=args.mix,
+            background=args.background, stream=args.stream,
+            openai_latency=args.openai_latency, twilio_latency=args.twilio_latency,
+            assemblyai_latency=args.assemblyai_latency,
+        ),
+        requests=len(results),
+        errors=len(results) - len(ok),
+        error_rate=(len(results) - len(ok)) / len(results) if results else 0.0,
+        throughput=len(ok) / elapsed if elapsed else 0.0,
+        replies=replies,
+        replies_per_second=replies / elapsed if elapsed else 0.0,
+        latency_p50=percentile(latencies, 50),
+        latency_p95=percentile(latencies, 95),
+        latency_p99=percentile(latencies, 99),
+        latency_by_kind={
+            kind: dict(
+                requests=len(kind_latencies),
+                p50=percentile(kind_latencies, 50),
+                p95=percentile(kind_latencies, 95),
+                p99=percentile(kind_latencies, 99),
+            )
+            for kind in sorted({r["kind"] for r in ok})
+            for kind_latencies in [[r["latency"] for r in ok if r["kind"] == kind]]
+        },
+        status_codes={
+            str(status): sum(1 for r in results if r["status"] == status)
+            for status in {r["status"] for r in results}
+        },
+        stage_mean_seconds=stage_means,
+    )
+    return summary
+
+
+def print_report(summary: dict, baseline: dict = None):
+    print(f"requests: {summary['requests']}  errors: {summary['errors']} ({summary['error_rate']:.2%})  "
+          f"status codes: {summary['status_codes']}")
+    print(f"throughput: {summary['throughput']:.1f} req/s  replies: {summary['replies']} "
+          f"({summary['replies_per_second']:.1f}/s)")
+    print(f"webhook latency: p50 {summary['latency_p50'] * 1000:.0f}ms  p95 {summary['latency_p95'] * 1000:.0f}ms  "
+          f"p99 {summary['latency_p99'] * 1000:.0f}ms")
+    for kind, stats in summary["latency_by_kind"].items():
+        print(f"  {kind:>6}: {stats['requests']:>5} requests  p50 {stats['p50'] * 1000:.0f}ms  "
+              f"p95 {stats['p95'] * 1000:.0f}ms  p99 {stats['p99'] * 1000:.0f}ms")
+    if summary["stage_mean_seconds"]:
+        print("mean seconds per stage: " + "  ".join(
+            f"{stage} {seconds:.3f}" for stage, seconds in summary["stage_mean_seconds"].items()))
+    if baseline is None:
+        return
+    if baseline.get("config") != summary["config"]:
+        print(f"\nThe baseline was run with a different configuration: {baseline.get('config')}")
+    print(f"\n{'metric':>20} {'baseline':>10} {'current':>10} {'change':>8}")
+    for metric, higher_is_better in COMPARED_METRICS.items():
+        before, after = baseline.get(metric, 0.0), summary[metric]
+        change = (after - before) / before if before else 0.0
+        better = (change > 0) == higher_is_better if change else None
+        mark = "" if better is None else (" better" if better else " worse")
+        print(f"{metric:>20} {before:>10.3f} {after:>10.3f} {change:>+8.1%}{mark}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--rate", type=float, default=10, help="webhook requests per second")
+    parser.add_argument("--duration", type=float, default=20, help="seconds sending requests")
+    parser.add_argument("--senders", type=int, default=200, help="number of different senders")
+    parser.add_argument("--mix", default="text=0.8,audio=0.15,image=0.05", help="proportion of each message type")
+    parser.add_argument("--audio-variety", type=int, default=50, help="number of different voice notes")
+    parser.add_argument("--background", action="store_true", help="process the messages in the background workers")
+    parser.add_argument("--stream", action="store_true", help="stream the replies")
+    parser.add_argument("--openai-latency", default="lognormal:0.8,0.4", help="e.g. fixed:0.5, uniform:0.2,1 or lognormal:0.8,0.4")
+    parser.add_argument("--token-latency", default="fixed:0.01")
+    parser.add_argument("--images-latency", default="lognormal:4,0.3")
+    parser.add_argument("--twilio-latency", default="lognormal:0.15,0.3")
+    parser.add_argument("--assemblyai-latency", default="lognormal:2,0.3")
+    parser.add_argument("--media-latency", default="fixed:0.05")
+    parser.add_argument("--port", type=int, default=0, help="port of the bot, by default a free one")
+    parser.add_argument("--max-connections", type=int, default=1000)
+    parser.add_argument("--timeout", type=float, default=60, help="timeout of each request in seconds")
+    parser.add_argument("--save-baseline", help="path where the report is saved as JSON")
+    parser.add_argument("--compare", help="path of a saved report to compare against")
+    args = parser.parse_args()
+
+    fakes_loop = BackgroundLoop(name="fakes").start()
+    fakes = fakes_loop.submit(start_fakes(args)).result()
+    server = serve_bot(fakes, args)
+    base_url = f"http://127.0.0.1:{server.server_port}"
+    print(f"Sending {args.rate:g} requests/s for {args.duration:g}s to {base_url}/whatsapp/reply")
+
+    start = time.perf_counter()
+    results = asyncio.run(generate_load(f"{base_url}/whatsapp/reply", fakes["media"], args))
+    if args.background:
+        asyncio.run(wait_until_idle(base_url, args.timeout))
+    elapsed = time.perf_counter() - start
+    stage_means = parse_stage_means(asyncio.run(fetch_metrics(base_url)))
+    summary = summarize(results, elapsed, len(fakes["twilio_messages"]), stage_means, args)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare, "r") as f:
+            baseline = json.load(f)
+    print_report(summary, baseline)
+    if args.save_baseline:
+        os.makedirs(os.path.dirname(args.save_baseline) or ".", exist_ok=True)
+        with open(args.save_baseline, "w") as f:
+            json.dump(summary, f, indent=2)
+        print(f"Saved the report to {args.save_baseline}")
+
+    server.shutdown()
+    for runner in fakes["runners"]:
+        fakes_loop.submit(runner.cleanup()).result()
+    fakes_loop.stop()
+
+
+if __name__ == "__main__":
+    main()
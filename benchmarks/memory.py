@@ -0,0 +1,85 @@
+"""
+Benchmark of the searches of the long-term memory (`app.memory.MemoryStore`)
+
+An index of random normalized vectors is built in a temporary directory (or
+the given one) with the snippets spread evenly over the senders, and the
+latency of `MemoryStore.search` is measured for random senders and queries,
+after a warm-up that maps every shard. Building the default index writes
+about 600 MB.
+
+Usage
+-----
+python -m benchmarks.memory --snippets 100000 --senders 1000 --dim 1536
+python -m benchmarks.memory --snippets 10000 --senders 100 --searches 2000 --directory /tmp/memory
+"""
+import argparse
+import json
+import tempfile
+import time
+
+import numpy as np
+
+from app.memory import MemoryStore
+
+
+def build(directory: str, snippets: int, senders: int, dim: int, num_shards: int, seed: int) -> MemoryStore:
+    """Returns a store with `snippets` random snippets of `senders` senders"""
+    rng = np.random.default_rng(seed)
+
+    async def embed(texts):
+        return rng.standard_normal((len(texts), dim), dtype=np.float32)
+
+    # batches larger than the chunks flushed here, so the loop of the store never flushes at the same time
+    store = MemoryStore(directory, embed, num_shards=num_shards, batch_size=1024, flush_interval=3600, min_chars=0)
+    if len(store) >= snippets:
+        return store
+    start = time.perf_counter()
+    for i in range(len(store), snippets, 1000):
+        for j in range(i, min(i + 1000, snippets)):
+            store.remember(f"+{j % senders}", [dict(role="user", content=f"Snippet {j} of sender {j % senders}")])
+        store.background.submit(store.flush()).result()
+    print(f"Built {len(store)} snippets in {time.perf_counter() - start:.1f} seconds")
+    return store
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--snippets", type=int, default=100000, help="number of snippets of the index")
+    parser.add_argument("--senders", type=int, default=1000, help="number of senders the snippets are split in")
+    parser.add_argument("--dim", type=int, default=1536, help="dimensions of the embeddings")
+    parser.add_argument("--shards", type=int, default=16, help="number of shards of the index")
+    parser.add_argument("--searches", type=int, default=10000, help="number of timed searches")
+    parser.add_argument("--k", type=int, default=3, help="snippets returned by every search")
+    parser.add_argument("--directory", help="directory of the index, by default a temporary one (reused if it exists)")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as temporary:
+        store = build(args.directory or temporary, args.snippets, args.senders, args.dim, args.shards, args.seed)
+        rng = np.random.default_rng(args.seed + 1)
+        queries = rng.standard_normal((args.searches, args.dim), dtype=np.float32)
+        senders = rng.integers(args.senders, size=args.searches)
+        # map every shard before timing
+        for sender in range(args.senders):
+            store.search(f"+{sender}", queries[0], k=args.k)
+        latencies = np.empty(args.searches)
+        for i, (sender, query) in enumerate(zip(senders, queries)):
+            start = time.perf_counter()
+            store.search(f"+{sender}", query, k=args.k)
+            latencies[i] = time.perf_counter() - start
+        store.stop()
+        report = dict(
+            snippets=len(store),
+            senders=args.senders,
+            dim=args.dim,
+            searches=args.searches,
+            latency_p50_ms=round(1000 * float(np.percentile(latencies, 50)), 3),
+            latency_p95_ms=round(1000 * float(np.percentile(latencies, 95)), 3),
+            latency_p99_ms=round(1000 * float(np.percentile(latencies, 99)), 3),
+            latency_max_ms=round(1000 * float(latencies.max()), 3),
+        )
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,52 @@
+"""
+Benchmark of the async Twilio sender against a local stand-in of Twilio's Messages API
+
+Usage
+-----
+python -m benchmarks.twilio_send --messages 1000 --latency 0.2 --concurrency 1 5 20 50
+"""
+import argparse
+import asyncio
+import time
+
+from benchmarks.fakes import Latency, make_twilio_app, start_server
+from chat.clients.twilio import AsyncTwilioSender, TwilioWhatsAppMessage
+
+
+async def run(num_messages: int, latency: float, concurrency_levels: list, num_destinations: int):
+    runner, base_url = await start_server(make_twilio_app(Latency("uniform", latency - 0.05, latency + 0.05)))
+    try:
+        messages = [
+            TwilioWhatsAppMessage(
+                body=f"Message {i}", from_="+14155238886", to=f"+3460000{i % num_destinations:04d}"
+            )
+            for i in range(num_messages)
+        ]
+        print(f"{'concurrency':>12} {'seconds':>8} {'msgs/s':>8} {'errors':>7}")
+        for concurrency in concurrency_levels:
+            sender = AsyncTwilioSender(
+                "ACbenchmark", "token", api_base=base_url,
+                max_concurrency=concurrency, max_per_destination=1,
+            )
+            start = time.perf_counter()
+            results = await sender.send_many(messages)
+            elapsed = time.perf_counter() - start
+            errors = sum(isinstance(r, Exception) for r in results)
+            print(f"{concurrency:>12} {elapsed:>8.2f} {num_messages / elapsed:>8.1f} {errors:>7}")
+            await sender.close()
+    finally:
+        await runner.cleanup()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--messages", type=int, default=1000)
+    parser.add_argument("--latency", type=float, default=0.2, help="latency of the stand-in in seconds")
+    parser.add_argument("--destinations", type=int, default=500, help="number of different recipients")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 5, 20, 50])
+    args = parser.parse_args()
+    asyncio.run(run(args.messages, args.latency, args.concurrency, args.destinations))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,3 +1,3 @@
-from .twilio_whatsapp import TwilioWhatsAppClient, TwilioWhatsAppMessage
+from .twilio_whatsapp import TwilioWhatsAppClient, TwilioWhatsAppMessage, AsyncTwilioSender, TwilioSendError
 
-__all__ = ["TwilioWhatsAppClient", "TwilioWhatsAppMessage"]
\ No newline at end of file
+__all__ = ["TwilioWhatsAppClient", "TwilioWhatsAppMessage", "AsyncTwilioSender", "TwilioSendError"]
\ No newline at end of file
@@ -1,11 +1,17 @@
+import asyncio
 import inspect
 import logging
-from typing import Union
+import os
+from typing import Dict, List, Optional, Union
 
+import aiohttp
 from twilio.rest import Client
 from chat.clients import ChatClient
 from dataclasses import dataclass, field
 
+# maximum number of characters in the body of a WhatsApp message sent with Twilio
+MAX_BODY_LENGTH = 1600
+
 @dataclass(frozen=True)
 class Media:
     url: str
@@ -47,20 +53,159 @@ class TwilioWhatsAppMessage:
                 body=self.body
             )
     
-    async def send_async(self, client: Client):
+    async def send_async(self, client: Union["AsyncTwilioSender", Client]):
+        if isinstance(client, AsyncTwilioSender):
+            return await client.send(self)
+        # the twilio client is blocking, don't block the event loop with it
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(None, self.send, client)
+
+    def to_form(self) -> dict:
+        """Returns the parameters of Twilio's Messages API to send the message"""
+        form = {"From": self.from_, "To": self.to}
+        if self.body is not None:
+            form["Body"] = self.body
         if self.media:
-            return client.messages.create(
-                from_=self.from_,
-                to=self.to,
-                media_url=self.media.url,
-                body=self.body
-            )
-        else:
-            return client.messages.create(
-                from_=self.from_,
-                to=self.to,
-                body=self.body
-            )
+            form["MediaUrl"] = self.media.url
+        return form
+
+
+class AsyncTwilioSender:
+    """
+    Sends messages with Twilio's Messages API without blocking the event loop.
+
+    Requests go through a keep-alive connection pool, opened with `open` in the
+    (long-lived) event loops that send messages and closed with `close`. The
+    messages sent from other loops (e.g. one per request) use a connection pool
+    that is closed once they're sent. The number of messages being sent at the
+    same time is limited globally and per destination number (1 by default, so
+    that the messages sent to a number arrive in the order they were sent).
+
+    Parameters
+    ----------
+    account_sid : str
+        The SID of the Twilio account
+    auth_token : str
+        The auth token of the Twilio account
+    api_base : str, optional
+        Base URL of the API, by default the TWILIO_API_BASE environment variable
+        or "https://api.twilio.com"
+    max_concurrency : int, optional
+        Maximum number of messages being sent at the same time, by default 20
+    max_per_destination : int, optional
+        Maximum number of messages being sent at the same time to the same number, by default 1
+    timeout : float, optional
+        Timeout of each request in seconds, by default 15
+    """
+
+    def __init__(
+        self,
+        account_sid: str,
+        auth_token: str,
+        api_base: str = None,
+        max_concurrency: int = 20,
+        max_per_destination: int = 1,
+        timeout: float = 15,
+    ):
+        self.account_sid = account_sid
+        self.auth_token = auth_token
+        self.api_base = (api_base or os.environ.get("TWILIO_API_BASE", "https://api.twilio.com")).rstrip("/")
+        self.max_concurrency = max_concurrency
+        self.max_per_destination = max_per_destination
+        self.timeout = timeout
+        self.url = f"{self.api_base}/2010-04-01/Accounts/{account_sid}/Messages.json"
+        # a session keeps a reference to its loop, so the states are only removed by `close`
+        self._states: Dict[asyncio.AbstractEventLoop, _SenderState] = {}
+
+    def _new_state(self) -> "_SenderState":
+        return _SenderState(
+            session=aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.max_concurrency, keepalive_timeout=60),
+                auth=aiohttp.BasicAuth(self.account_sid, self.auth_token),
+                timeout=aiohttp.ClientTimeout(total=self.timeout),
+            ),
+            semaphore=asyncio.Semaphore(self.max_concurrency),
+        )
+
+    def _state(self) -> Optional["_SenderState"]:
+        """Returns the state of the running event loop if it was opened, otherwise None"""
+        state = self._states.get(asyncio.get_event_loop())
+        if state is None or state.session.closed:
+            return None
+        return state
+
+    async def open(self):
+        """Creates the connection pool of the running event loop"""
+        if self._state() is None:
+            self._states[asyncio.get_event_loop()] = self._new_state()
+
+    async def close(self):
+        """Closes the connection pool of the running event loop"""
+        state = self._states.pop(asyncio.get_event_loop(), None)
+        if state is not None and not state.session.closed:
+            await state.session.close()
+
+    async def send(self, message: TwilioWhatsAppMessage) -> dict:
+        """Sends a message and returns the created message resource"""
+        state = self._state()
+        if state is None:
+            state = self._new_state()
+            try:
+                return await self._send(state, message)
+            finally:
+                await state.session.close()
+        return await self._send(state, message)
+
+    async def _send(self, state: "_SenderState", message: TwilioWhatsAppMessage) -> dict:
+        destination = state.acquire_destination(message.to, self.max_per_destination)
+        try:
+            async with destination, state.semaphore:
+                async with state.session.post(self.url, data=message.to_form()) as response:
+                    data = await response.json(content_type=None)
+                    if response.status >= 400:
+                        raise TwilioSendError(response.status, data)
+                    return data
+        finally:
+            state.release_destination(message.to)
+
+    async def send_many(self, messages: List[TwilioWhatsAppMessage], return_exceptions: bool = True) -> list:
+        """
+        Sends several messages concurrently (within the concurrency limits).
+        Returns the created message resources (or the exceptions raised sending them) in order.
+        """
+        return await asyncio.gather(
+            *(self.send(message) for message in messages), return_exceptions=return_exceptions
+        )
+
+
+@dataclass
+class _SenderState:
+    session: aiohttp.ClientSession
+    semaphore: asyncio.Semaphore
+    destinations: Dict[str, list] = field(default_factory=dict) # number -> [semaphore, users]
+
+    def acquire_destination(self, number: str, limit: int) -> asyncio.Semaphore:
+        entry = self.destinations.get(number)
+        if entry is None:
+            entry = self.destinations[number] = [asyncio.Semaphore(limit), 0]
+        entry[1] += 1
+        return entry[0]
+
+    def release_destination(self, number: str):
+        entry = self.destinations[number]
+        entry[1] -= 1
+        if entry[1] == 0:
+            del self.destinations[number]
+
+
+class TwilioSendError(Exception):
+    """Error returned by Twilio's Messages API"""
+
+    def __init__(self, status: int, data: dict):
+        self.status = status
+        self.data = data
+        message = data.get("message") if isinstance(data, dict) else data
+        super().__init__(f"Twilio returned {status}: {message}")
 
 
 class TwilioWhatsAppClient(ChatClient):
@@ -86,6 +231,11 @@ class TwilioWhatsAppClient(ChatClient):
         self.client = client
         self.config = config
         self.from_number = from_number
+        self.async_sender = AsyncTwilioSender(
+            account_sid or client.username,
+            auth_token or client.password,
+            **kwargs.get("async_sender_kwargs", {}),
+        )
         self.logger = logging.getLogger("twilio_whatsapp")
         self.logger.setLevel(logging.INFO)
     
@@ -113,7 +263,7 @@ class TwilioWhatsAppClient(ChatClient):
             return message.send(self.client)
         except Exception as e:
             if on_failure is not None:
-                if isinstance(on_failure, callable):
+                if callable(on_failure):
                     return on_failure(e, **kwargs)
                 return on_failure
             else:
@@ -125,9 +275,10 @@ class TwilioWhatsAppClient(ChatClient):
         to_number:str = None,
         media_url:str = None,
         media_type:str = None,
-        ):
+        on_failure:str = None,
+        **kwargs):
         """
-        Send media to a WhatsApp number asynchronously.
+        Send a WhatsApp message (or media) to a number asynchronously.
         """
         if inspect.iscoroutine(message):
             message = await message
@@ -135,7 +286,21 @@ class TwilioWhatsAppClient(ChatClient):
             media_url = await media_url
         if not isinstance(message, TwilioWhatsAppMessage):
             message = self.make_message(message, to_number, media_url, media_type)
-        return await message.send_async(self.client)
+        try:
+            return await message.send_async(self.async_sender)
+        except Exception as e:
+            if on_failure is not None:
+                if callable(on_failure):
+                    return on_failure(e, **kwargs)
+                return on_failure
+            else:
+                self.on_failure(e, **kwargs)
+
+    async def send_many(self, messages:List[TwilioWhatsAppMessage], return_exceptions:bool = True) -> list:
+        """
+        Send several WhatsApp messages concurrently.
+        """
+        return await self.async_sender.send_many(messages, return_exceptions=return_exceptions)
     
     def make_message(self, message:str, to_number:str = None, media_url:str = None, media_type:str = None) -> TwilioWhatsAppMessage:
         """
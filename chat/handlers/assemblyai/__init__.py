@@ -1,6 +1,21 @@
-from .audio_transcription import transcribe_audio, supported_language_codes
+from .audio_transcription import (
+    transcribe_audio,
+    atranscribe_audio,
+    aupload_audio,
+    notify_transcription_status,
+    open_session,
+    close_session,
+    supported_language_codes,
+    WEBHOOK_AUTH_HEADER,
+)
 
 __all__ = [
     "transcribe_audio",
+    "atranscribe_audio",
+    "aupload_audio",
+    "notify_transcription_status",
+    "open_session",
+    "close_session",
     "supported_language_codes",
+    "WEBHOOK_AUTH_HEADER",
 ]
\ No newline at end of file
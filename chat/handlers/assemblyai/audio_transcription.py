@@ -1,8 +1,13 @@
 """Use AssemblyAI's API for audio transcription"""
 
-import os, time, logging
+import asyncio, os, random, threading, time, logging
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+import aiohttp
 import requests
 
+API_BASE = os.environ.get("ASSEMBLYAI_API_BASE", "https://api.assemblyai.com")
+
 supported_language_codes = { # https://www.assemblyai.com/docs/#supported-languages
     'en': 'en',
     'english': 'en',
@@ -28,27 +33,21 @@ supported_language_codes = { # https://www.assemblyai.com/docs/#supported-langua
     'hindi': 'hi',
 }
 
-def transcribe_audio(media_url, *, chat=None, language_detection:bool=True, language_code=None, api_key=None, as_json:bool=False):
+def transcribe_audio(media_url, *, chat=None, language_detection:bool=True, language_code=None, api_key=None, as_json:bool=False, timeout:float=30):
     if chat is not None:
         logger = chat.logger
     else:
         logger = logging.getLogger(__name__)
     now = time.time()
-    endpoint = "https://api.assemblyai.com/v2/transcript"
-    headers = {
-        "authorization": os.environ.get('ASSEMBLYAI_API_KEY') if api_key is None else api_key,
-        "content-type": "application/json"
-    }
-    data = dict(audio_url=media_url, language_detection=language_detection)
-    if language_code is not None:
-        data['language_code'] = supported_language_codes.get(language_code, 'en')
-        data['language_detection'] = False
-    logger.info(f"Attempting to transcribe audio with {data=}")
+    endpoint = f"{API_BASE}/v2/transcript"
+    headers = _make_headers(api_key)
+    data = _make_request_data(media_url, language_detection, language_code)
+    logger.info("Attempting to transcribe audio with data=%s", data)
     response = requests.post(endpoint, json=data, headers=headers)
     response.raise_for_status()
     transcription_id = response.json()['id']
     try:
-        transcription_res = _wait_for_transcription(transcription_id, headers, logger=logger)
+        transcription_res = _wait_for_transcription(transcription_id, headers, timeout=timeout, logger=logger)
     except requests.exceptions.HTTPError as e:
         logger.error(f"Error getting transcription {transcription_id}: {e} with request data: {data}")
         raise e
@@ -58,21 +57,232 @@ def transcribe_audio(media_url, *, chat=None, language_detection:bool=True, lang
 
     transcription_res.pop('words', None)
     logger.info(f"Transcription took {time.time() - now:.2f} seconds")
-    logger.info(f"Transcription data:\n{transcription_res}")
+    logger.debug("Transcription data:\n%s", transcription_res, extra={"event": "transcription"})
+    if as_json:
+        return transcription_res
+    return transcription_res['text']
+
+async def atranscribe_audio(media_url, *, chat=None, language_detection:bool=True, language_code=None, api_key=None, as_json:bool=False, timeout:float=30, webhook_url:str=None, webhook_secret:str=None):
+    """
+    Transcribes the audio of the given url asynchronously.
+
+    The transcription is polled with jittered exponential backoff until it completes
+    or `timeout` seconds pass. If `webhook_url` is given, AssemblyAI is asked to call it
+    when the transcription completes instead, and the coroutine is suspended until the
+    app calls `notify_transcription_status` from that webhook (the status is only polled,
+    less and less often, if the webhook is late).
+    """
+    if chat is not None:
+        logger = chat.logger
+    else:
+        logger = logging.getLogger(__name__)
+    now = time.time()
+    headers = _make_headers(api_key)
+    data = _make_request_data(media_url, language_detection, language_code)
+    logger.info("Attempting to transcribe audio with data=%s", data)
+    if webhook_url is not None:
+        data['webhook_url'] = webhook_url
+        if webhook_secret is not None:
+            data['webhook_auth_header_name'] = WEBHOOK_AUTH_HEADER
+            data['webhook_auth_header_value'] = webhook_secret
+    async with _use_session() as session:
+        async with session.post(f"{API_BASE}/v2/transcript", json=data, headers=headers) as response:
+            response.raise_for_status()
+            transcription_id = (await response.json())['id']
+        try:
+            if webhook_url is not None:
+                transcription_res = await _await_transcription_webhook(session, transcription_id, headers, timeout=timeout)
+            else:
+                transcription_res = await _poll_transcription(session, transcription_id, headers, timeout=timeout)
+        except aiohttp.ClientResponseError as e:
+            logger.error(f"Error getting transcription {transcription_id}: {e} with request data: {data}")
+            raise e
+        except ValueError as e:
+            logger.error(e)
+            return None
+
+    transcription_res.pop('words', None)
+    logger.info(f"Transcription took {time.time() - now:.2f} seconds")
+    logger.debug("Transcription data:\n%s", transcription_res, extra={"event": "transcription"})
     if as_json:
         return transcription_res
     return transcription_res['text']
 
+async def aupload_audio(file, *, api_key=None, chunk_size:int=64 * 1024) -> str:
+    """
+    Uploads the audio of a (binary) file object to AssemblyAI and returns the url to transcribe it from,
+    for audio that was already downloaded and shouldn't be fetched again from its original url.
+    """
+    async def chunks():
+        file.seek(0)
+        while True:
+            chunk = file.read(chunk_size)
+            if not chunk:
+                break
+            yield chunk
+    headers = {"authorization": _make_headers(api_key)["authorization"]}
+    async with _use_session() as session:
+        async with session.post(f"{API_BASE}/v2/upload", data=chunks(), headers=headers) as response:
+            response.raise_for_status()
+            return (await response.json())['upload_url']
+
+def _make_headers(api_key:str=None) -> dict:
+    return {
+        "authorization": os.environ.get('ASSEMBLYAI_API_KEY') if api_key is None else api_key,
+        "content-type": "application/json"
+    }
+
+def _make_request_data(media_url:str, language_detection:bool=True, language_code:str=None) -> dict:
+    data = dict(audio_url=media_url, language_detection=language_detection)
+    if language_code is not None:
+        data['language_code'] = supported_language_codes.get(language_code, 'en')
+        data['language_detection'] = False
+    return data
+
+def _check_status(transcription:dict) -> bool:
+    """Returns True if the transcription is completed, raises a ValueError if it failed"""
+    status = transcription['status'].lower()
+    if status == 'error':
+        raise ValueError(f"Transcription {transcription.get('id')} failed: {transcription.get('error')}")
+    return status == 'completed'
+
+def _backoff_delays(initial:float=0.5, factor:float=1.5, maximum:float=5.0):
+    """Yields jittered exponentially increasing delays"""
+    delay = initial
+    while True:
+        yield delay * random.uniform(0.5, 1.0)
+        delay = min(delay * factor, maximum)
+
 def _wait_for_transcription(transcription_id:str, headers:dict, timeout=30, logger=None):
-    endpoint = f"https://api.assemblyai.com/v2/transcript/{transcription_id}"
-    time_now = time.time()
+    endpoint = f"{API_BASE}/v2/transcript/{transcription_id}"
+    deadline = time.monotonic() + timeout
+    delays = _backoff_delays()
     response = requests.get(endpoint, headers=headers)
-    while (status := response.json()['status']).lower() != 'completed':
-        try:
-            response = requests.get(endpoint, headers=headers)
+    response.raise_for_status()
+    while not _check_status(response.json()):
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise ValueError(f"Timed out waiting for transcription to complete. Status: {response.json()['status']}")
+        time.sleep(min(next(delays), remaining))
+        response = requests.get(endpoint, headers=headers)
+        response.raise_for_status()
+    return response.json()
+
+async def _poll_transcription(session:aiohttp.ClientSession, transcription_id:str, headers:dict, timeout:float=30) -> dict:
+    """Polls the transcription with backoff until it completes"""
+    endpoint = f"{API_BASE}/v2/transcript/{transcription_id}"
+    deadline = time.monotonic() + timeout
+    delays = _backoff_delays()
+    while True:
+        async with session.get(endpoint, headers=headers) as response:
             response.raise_for_status()
-        except requests.exceptions.HTTPError as e:
-            raise e
-        if time.time() - time_now > 30: # 30 second timeout
-            raise ValueError(f"Timed out waiting for transcription to complete. Status: {status}")
-    return response.json()
\ No newline at end of file
+            transcription = await response.json()
+        if _check_status(transcription):
+            return transcription
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise ValueError(f"Timed out waiting for transcription to complete. Status: {transcription['status']}")
+        await asyncio.sleep(min(next(delays), remaining))
+
+# webhook completion of the transcriptions
+#
+# The notifications are handed to the transcriptions waiting in this process. With several
+# processes (e.g. gunicorn workers) the webhook may reach one that isn't waiting for it, so if
+# it hasn't arrived after `WEBHOOK_POLL_SECONDS` the waiting transcription checks its status,
+# and checks it again at doubling intervals (and at the deadline) until the webhook arrives.
+WEBHOOK_AUTH_HEADER = "X-Transcription-Webhook-Secret"
+WEBHOOK_POLL_SECONDS = float(os.environ.get("ASSEMBLYAI_WEBHOOK_POLL_SECONDS", 5))
+MAX_EARLY_NOTIFICATIONS = 1000
+_webhook_lock = threading.Lock()  # guards both dicts, they're used from the loops and the request threads
+_pending_webhooks = {}  # transcription id -> (loop, future)
+_early_notifications = OrderedDict()  # statuses received before the transcription was awaited
+
+async def _await_transcription_webhook(session:aiohttp.ClientSession, transcription_id:str, headers:dict, timeout:float=30) -> dict:
+    """Waits for the webhook of the transcription to be called and returns the transcription"""
+    loop = asyncio.get_event_loop()
+    future = loop.create_future()
+    with _webhook_lock:
+        if transcription_id in _early_notifications:
+            future.set_result(_early_notifications.pop(transcription_id))
+        else:
+            _pending_webhooks[transcription_id] = (loop, future)
+    endpoint = f"{API_BASE}/v2/transcript/{transcription_id}"
+    deadline = time.monotonic() + timeout
+    poll_interval = WEBHOOK_POLL_SECONDS
+    try:
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise ValueError(f"Timed out waiting for the webhook of transcription {transcription_id}")
+            try:
+                status = await asyncio.wait_for(asyncio.shield(future), min(poll_interval, remaining))
+                break
+            except asyncio.TimeoutError:
+                # the webhook may have reached another process
+                async with session.get(endpoint, headers=headers) as response:
+                    response.raise_for_status()
+                    transcription = await response.json()
+                if _check_status(transcription):
+                    return transcription
+                poll_interval *= 2
+    finally:
+        with _webhook_lock:
+            _pending_webhooks.pop(transcription_id, None)
+    if status.lower() == 'error':
+        raise ValueError(f"Transcription {transcription_id} failed")
+    async with session.get(endpoint, headers=headers) as response:
+        response.raise_for_status()
+        return await response.json()
+
+def notify_transcription_status(transcription_id:str, status:str) -> bool:
+    """
+    Resumes the transcription waiting for its webhook. Safe to call from any thread.
+    Returns False if no transcription of this process was waiting for it (it's kept in case
+    the transcription starts waiting later).
+    """
+    with _webhook_lock:
+        pending = _pending_webhooks.get(transcription_id)
+        if pending is None:
+            _early_notifications[transcription_id] = status
+            while len(_early_notifications) > MAX_EARLY_NOTIFICATIONS:
+                _early_notifications.popitem(last=False)
+            return False
+    loop, future = pending
+    loop.call_soon_threadsafe(lambda: future.done() or future.set_result(status))
+    return True
+
+# http sessions shared by the requests made from the (long-lived) event loops that opened one,
+# a session keeps a reference to its loop so they're only removed by `close_session`
+_sessions = {}  # event loop -> session
+
+async def open_session(limit:int=20) -> aiohttp.ClientSession:
+    """Creates the shared session of the running event loop"""
+    loop = asyncio.get_event_loop()
+    session = _sessions.get(loop)
+    if session is None or session.closed:
+        session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=limit, keepalive_timeout=60))
+        _sessions[loop] = session
+    return session
+
+def get_session() -> aiohttp.ClientSession:
+    """Returns the shared session of the running event loop if it was opened, otherwise None"""
+    session = _sessions.get(asyncio.get_event_loop())
+    if session is None or session.closed:
+        return None
+    return session
+
+@asynccontextmanager
+async def _use_session():
+    """Yields the shared session of the running event loop, or a session closed after the call if there's none"""
+    session = get_session()
+    if session is not None:
+        yield session
+        return
+    async with aiohttp.ClientSession() as session:
+        yield session
+
+async def close_session():
+    """Closes the shared session of the running event loop"""
+    session = _sessions.pop(asyncio.get_event_loop(), None)
+    if session is not None and not session.closed:
+        await session.close()
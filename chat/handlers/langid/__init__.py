@@ -0,0 +1,6 @@
+from .language_identification import identify_language, supported_languages
+
+__all__ = [
+    "identify_language",
+    "supported_languages",
+]
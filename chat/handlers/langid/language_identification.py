@@ -0,0 +1,107 @@
+"""
+Local language identification with character n-gram profiles.
+
+The profiles of every language are built once from the bundled sample texts
+and a text is classified with a naive Bayes model over its character 1 to 3-grams,
+which takes a few microseconds for a chat message and needs no API call.
+
+The naive Bayes posterior only compares the known languages, so a text in any other
+language (e.g. polish or danish) is still given to one of them with a high posterior.
+The confidence is therefore also lowered when many of the n-grams of the text were never
+seen in the samples of the identified language, which happens to texts out of the model.
+"""
+import math
+import re
+from typing import Dict, Tuple
+
+from .samples import SAMPLES
+
+__all__ = [
+    "identify_language",
+    "supported_languages",
+]
+
+NGRAM_SIZES = (1, 2, 3)
+# number of letters from which the identification is fully trusted
+MIN_RELIABLE_LETTERS = 20
+# share of the 2 and 3-grams of a text missing from the profile of its language,
+# up to which the text is fully trusted and from which it's considered out of the model
+MAX_RELIABLE_UNSEEN_RATE = 0.2
+MAX_UNSEEN_RATE = 0.4
+
+_non_letters = re.compile(r"[^\w']+|[\d_]+")
+
+
+def _normalize(text: str) -> str:
+    return " " + _non_letters.sub(" ", text.lower()).strip() + " "
+
+
+def _ngrams(text: str):
+    for n in NGRAM_SIZES:
+        for i in range(len(text) - n + 1):
+            gram = text[i:i + n]
+            if gram != " " * n:
+                yield gram
+
+
+def _build_model(samples: Dict[str, str]) -> Tuple[tuple, dict, tuple, tuple]:
+    """
+    Returns the languages, the log-probabilities of each n-gram, those of unseen n-grams
+    and the n-grams seen in the samples of each language
+    """
+    languages = tuple(samples)
+    counts = {lang: {} for lang in languages}
+    for lang, sample in samples.items():
+        for gram in _ngrams(_normalize(sample)):
+            counts[lang][gram] = counts[lang].get(gram, 0) + 1
+    vocabulary = set().union(*counts.values())
+    totals = {lang: sum(c.values()) + len(vocabulary) for lang, c in counts.items()}
+    unseen = tuple(math.log(1 / totals[lang]) for lang in languages)
+    log_probs = {
+        gram: tuple(
+            math.log((counts[lang].get(gram, 0) + 1) / totals[lang]) for lang in languages
+        )
+        for gram in vocabulary
+    }
+    profiles = tuple(frozenset(counts[lang]) for lang in languages)
+    return languages, log_probs, unseen, profiles
+
+
+_languages, _log_probs, _unseen, _profiles = _build_model(SAMPLES)
+
+
+def supported_languages() -> tuple:
+    """Returns the languages that can be identified"""
+    return _languages
+
+
+def identify_language(text: str) -> Tuple[str, float]:
+    """
+    Identifies the language of a text.
+
+    Returns the language (in lowercase english, e.g. "spanish") and a confidence
+    between 0 and 1. Short texts get a low confidence since they are ambiguous, and
+    texts that don't look like any supported language get a low confidence as well.
+    """
+    normalized = _normalize(text)
+    num_letters = sum(c.isalpha() for c in normalized)
+    if num_letters == 0:
+        return _languages[0], 0.0
+    grams = list(_ngrams(normalized))
+    scores = [0.0] * len(_languages)
+    for gram in grams:
+        gram_log_probs = _log_probs.get(gram, _unseen)
+        for i, log_prob in enumerate(gram_log_probs):
+            scores[i] += log_prob
+    best = max(range(len(scores)), key=scores.__getitem__)
+    # posterior probability of the best language (softmax of the scores)
+    total = sum(math.exp(score - scores[best]) for score in scores)
+    confidence = 1 / total * min(1.0, num_letters / MIN_RELIABLE_LETTERS)
+    # out of model check, the posterior is only relative to the other known languages
+    long_grams = [gram for gram in grams if len(gram) > 1]
+    if long_grams:
+        profile = _profiles[best]
+        unseen_rate = sum(gram not in profile for gram in long_grams) / len(long_grams)
+        reliability = (MAX_UNSEEN_RATE - unseen_rate) / (MAX_UNSEEN_RATE - MAX_RELIABLE_UNSEEN_RATE)
+        confidence *= max(0.0, min(1.0, reliability))
+    return _languages[best], confidence
@@ -0,0 +1,99 @@
+"""
+Sample texts used to build the character n-gram profiles of each language.
+They mix everyday chat phrases with general prose.
+"""
+
+SAMPLES = {
+    "english": """
+Hello, how are you doing today? I am fine, thank you. What are you up to this weekend?
+Can you help me with something? I would like to know what the weather will be like tomorrow.
+Thanks a lot for your help, that was really useful. Could you tell me a joke please?
+Where is the nearest restaurant? I think we should go there together after work.
+The quick brown fox jumps over the lazy dog. She sells sea shells by the sea shore.
+It was the best of times, it was the worst of times, it was the age of wisdom.
+I have been thinking about what you said yesterday and I believe that you were right.
+Please send me a picture of a cat wearing a hat. What time is it in London right now?
+My friends and I are planning a trip to the mountains next month, do you have any advice?
+There is nothing more important than the health of your family and the people you love.
+Why do you think that happened? Which one would you choose if you were in my place?
+We should write the report before the meeting, because they will ask about the numbers.
+""",
+    "spanish": """
+Hola, ¿cómo estás hoy? Estoy bien, gracias. ¿Qué vas a hacer este fin de semana?
+¿Me puedes ayudar con algo? Quisiera saber qué tiempo va a hacer mañana en la ciudad.
+Muchas gracias por tu ayuda, ha sido muy útil. ¿Me cuentas un chiste por favor?
+¿Dónde está el restaurante más cercano? Creo que deberíamos ir juntos después del trabajo.
+En un lugar de la Mancha, de cuyo nombre no quiero acordarme, no ha mucho tiempo que vivía un hidalgo.
+He estado pensando en lo que dijiste ayer y creo que tenías razón en todo.
+Por favor mándame una foto de un gato con sombrero. ¿Qué hora es ahora mismo en Madrid?
+Mis amigos y yo estamos planeando un viaje a la montaña el mes que viene, ¿tienes algún consejo?
+No hay nada más importante que la salud de tu familia y de las personas que quieres.
+¿Por qué crees que pasó eso? ¿Cuál elegirías tú si estuvieras en mi lugar?
+Deberíamos escribir el informe antes de la reunión, porque nos van a preguntar por los números.
+""",
+    "french": """
+Bonjour, comment vas-tu aujourd'hui ? Je vais bien, merci. Qu'est-ce que tu fais ce week-end ?
+Est-ce que tu peux m'aider avec quelque chose ? J'aimerais savoir quel temps il fera demain.
+Merci beaucoup pour ton aide, c'était vraiment utile. Tu peux me raconter une blague s'il te plaît ?
+Où est le restaurant le plus proche ? Je pense que nous devrions y aller ensemble après le travail.
+Longtemps, je me suis couché de bonne heure. Parfois, à peine ma bougie éteinte, mes yeux se fermaient.
+J'ai réfléchi à ce que tu m'as dit hier et je crois que tu avais raison sur tout.
+Envoie-moi une photo d'un chat avec un chapeau, s'il te plaît. Quelle heure est-il à Paris maintenant ?
+Mes amis et moi prévoyons un voyage à la montagne le mois prochain, as-tu des conseils ?
+Il n'y a rien de plus important que la santé de ta famille et des personnes que tu aimes.
+Pourquoi penses-tu que c'est arrivé ? Lequel choisirais-tu si tu étais à ma place ?
+Nous devrions écrire le rapport avant la réunion, parce qu'ils vont nous poser des questions sur les chiffres.
+""",
+    "german": """
+Hallo, wie geht es dir heute? Mir geht es gut, danke. Was machst du am Wochenende?
+Kannst du mir bei etwas helfen? Ich möchte wissen, wie das Wetter morgen wird.
+Vielen Dank für deine Hilfe, das war wirklich nützlich. Kannst du mir bitte einen Witz erzählen?
+Wo ist das nächste Restaurant? Ich glaube, wir sollten nach der Arbeit zusammen dorthin gehen.
+Als Gregor Samsa eines Morgens aus unruhigen Träumen erwachte, fand er sich in seinem Bett verwandelt.
+Ich habe über das nachgedacht, was du gestern gesagt hast, und ich glaube, du hattest recht.
+Bitte schick mir ein Bild von einer Katze mit einem Hut. Wie spät ist es gerade in Berlin?
+Meine Freunde und ich planen nächsten Monat eine Reise in die Berge, hast du einen Rat für uns?
+Es gibt nichts Wichtigeres als die Gesundheit deiner Familie und der Menschen, die du liebst.
+Warum glaubst du, dass das passiert ist? Welches würdest du wählen, wenn du an meiner Stelle wärst?
+Wir sollten den Bericht vor der Besprechung schreiben, weil sie nach den Zahlen fragen werden.
+""",
+    "italian": """
+Ciao, come stai oggi? Sto bene, grazie. Che cosa fai questo fine settimana?
+Mi puoi aiutare con una cosa? Vorrei sapere che tempo farà domani in città.
+Grazie mille per il tuo aiuto, è stato davvero utile. Mi racconti una barzelletta per favore?
+Dov'è il ristorante più vicino? Penso che dovremmo andarci insieme dopo il lavoro.
+Nel mezzo del cammin di nostra vita mi ritrovai per una selva oscura, ché la diritta via era smarrita.
+Ho pensato a quello che hai detto ieri e credo che tu avessi ragione su tutto.
+Per favore mandami una foto di un gatto con il cappello. Che ore sono adesso a Roma?
+Io e i miei amici stiamo organizzando un viaggio in montagna il mese prossimo, hai qualche consiglio?
+Non c'è niente di più importante della salute della tua famiglia e delle persone che ami.
+Perché pensi che sia successo? Quale sceglieresti se fossi al mio posto?
+Dovremmo scrivere la relazione prima della riunione, perché ci faranno domande sui numeri.
+""",
+    "portuguese": """
+Olá, como você está hoje? Estou bem, obrigado. O que você vai fazer neste fim de semana?
+Você pode me ajudar com uma coisa? Eu gostaria de saber como vai estar o tempo amanhã.
+Muito obrigado pela sua ajuda, foi muito útil. Você me conta uma piada, por favor?
+Onde fica o restaurante mais próximo? Acho que devíamos ir juntos depois do trabalho.
+Tinha eu catorze anos e estava no colégio quando conheci a menina que mudou a minha vida.
+Estive a pensar no que você disse ontem e acho que você tinha razão em tudo.
+Por favor, me manda uma foto de um gato de chapéu. Que horas são agora em Lisboa?
+Eu e os meus amigos estamos planejando uma viagem para as montanhas no mês que vem, tem algum conselho?
+Não há nada mais importante do que a saúde da sua família e das pessoas que você ama.
+Por que você acha que isso aconteceu? Qual você escolheria se estivesse no meu lugar?
+Devíamos escrever o relatório antes da reunião, porque eles vão perguntar sobre os números.
+""",
+    "dutch": """
+Hallo, hoe gaat het vandaag met je? Het gaat goed, dank je. Wat ga je dit weekend doen?
+Kun je me ergens mee helpen? Ik zou graag willen weten wat voor weer het morgen wordt.
+Heel erg bedankt voor je hulp, dat was echt nuttig. Kun je me alsjeblieft een grap vertellen?
+Waar is het dichtstbijzijnde restaurant? Ik denk dat we er na het werk samen heen moeten gaan.
+Het was een koude dag in de winter en de kinderen speelden buiten in de sneeuw bij de gracht.
+Ik heb nagedacht over wat je gisteren zei en ik geloof dat je gelijk had.
+Stuur me alsjeblieft een foto van een kat met een hoed. Hoe laat is het nu in Amsterdam?
+Mijn vrienden en ik plannen volgende maand een reis naar de bergen, heb je nog tips voor ons?
+Er is niets belangrijker dan de gezondheid van je familie en de mensen van wie je houdt.
+Waarom denk je dat dat is gebeurd? Welke zou jij kiezen als je in mijn plaats was?
+We moeten het verslag voor de vergadering schrijven, want ze gaan naar de cijfers vragen.
+""",
+}
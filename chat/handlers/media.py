@@ -0,0 +1,144 @@
+"""
+Download of the media (audio, images, ...) of incoming messages.
+
+Media is streamed in chunks into a spooled temporary file, which stays in
+memory while it's small and rolls over to disk when it grows, and which is
+always closed (and deleted) when the context manager exits. Downloads larger
+than a maximum size are aborted. The SHA-256 digest of the content is
+computed while it is streamed.
+"""
+import hashlib
+import mimetypes
+import os
+import tempfile
+from contextlib import asynccontextmanager, contextmanager
+from dataclasses import dataclass
+from typing import IO, Tuple
+
+import aiohttp
+import requests
+
+__all__ = [
+    "FetchedMedia",
+    "MediaTooLargeError",
+    "fetch_media",
+    "afetch_media",
+]
+
+# maximum size of the downloaded media (WhatsApp's limit for audio and video is 16MB)
+MAX_MEDIA_BYTES = int(os.environ.get("MAX_MEDIA_BYTES", 16 * 1024 * 1024))
+# media larger than this is spooled to disk instead of kept in memory
+SPOOL_MAX_MEMORY = 1024 * 1024
+CHUNK_SIZE = 64 * 1024
+# extensions of common media types that mimetypes doesn't know (or guesses differently across versions)
+_EXTENSIONS = {
+    "audio/ogg": ".ogg",
+    "audio/opus": ".ogg",
+    "audio/wav": ".wav",
+    "audio/x-wav": ".wav",
+    "audio/amr": ".amr",
+}
+
+
+class MediaTooLargeError(ValueError):
+    """The media is larger than the maximum size allowed"""
+
+
+@dataclass
+class FetchedMedia:
+    file: IO[bytes]
+    content_type: str = None
+    size: int = 0
+    name: str = None
+    sha256: str = None
+
+    @property
+    def filename(self) -> str:
+        """A file name with the extension of the content type (some APIs need it)"""
+        if self.name is not None:
+            return self.name
+        extension = None
+        if self.content_type:
+            content_type = self.content_type.split(";")[0].strip().lower()
+            extension = _EXTENSIONS.get(content_type) or mimetypes.guess_extension(content_type)
+        return "media" + (extension or ".bin")
+
+    def read(self) -> bytes:
+        self.file.seek(0)
+        return self.file.read()
+
+
+def _new_spooled_file():
+    return tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_MEMORY, mode="w+b")
+
+
+def _check_size(size: int, max_bytes: int, url: str):
+    if max_bytes is not None and size > max_bytes:
+        raise MediaTooLargeError(f"Media at {url} is larger than the maximum of {max_bytes} bytes")
+
+
+@contextmanager
+def fetch_media(url: str, max_bytes: int = MAX_MEDIA_BYTES, auth: Tuple[str, str] = None, timeout: float = 30):
+    """
+    Streams the media at the url into a spooled temporary file.
+
+    Usage
+    -----
+    >>> with fetch_media(url) as media:
+    ...     openai.Audio.transcribe_raw("whisper-1", media.file, media.filename)
+    """
+    f = _new_spooled_file()
+    try:
+        with requests.get(url, stream=True, auth=auth, timeout=timeout) as response:
+            response.raise_for_status()
+            _check_size(int(response.headers.get("Content-Length") or 0), max_bytes, url)
+            media = FetchedMedia(f, response.headers.get("Content-Type"))
+            digest = hashlib.sha256()
+            for chunk in response.iter_content(CHUNK_SIZE):
+                media.size += len(chunk)
+                _check_size(media.size, max_bytes, url)
+                digest.update(chunk)
+                f.write(chunk)
+        media.sha256 = digest.hexdigest()
+        f.seek(0)
+        yield media
+    finally:
+        f.close()
+
+
+@asynccontextmanager
+async def afetch_media(
+    url: str,
+    max_bytes: int = MAX_MEDIA_BYTES,
+    auth: Tuple[str, str] = None,
+    session: aiohttp.ClientSession = None,
+    timeout: float = 30,
+):
+    """Streams the media at the url into a spooled temporary file asynchronously (see `fetch_media`)"""
+    f = _new_spooled_file()
+    own_session = session is None
+    if own_session:
+        session = aiohttp.ClientSession()
+    try:
+        async with session.get(
+            url,
+            auth=aiohttp.BasicAuth(*auth) if auth else None,
+            timeout=aiohttp.ClientTimeout(total=timeout),
+        ) as response:
+            response.raise_for_status()
+            _check_size(response.content_length or 0, max_bytes, url)
+            media = FetchedMedia(f, response.headers.get("Content-Type"))
+            digest = hashlib.sha256()
+            async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+                media.size += len(chunk)
+                _check_size(media.size, max_bytes, url)
+                digest.update(chunk)
+                f.write(chunk)
+        media.sha256 = digest.hexdigest()
+        f.seek(0)
+        yield media
+    finally:
+        f.close()
+        if own_session:
+            await session.close()
+
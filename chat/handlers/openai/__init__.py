@@ -1,8 +1,14 @@
-from .completions import text_completion, chat_completion, code_generation
-from .speech import voice_transcription, voice_translation
+from .completions import (
+    text_completion, chat_completion, code_generation,
+    atext_completion, achat_completion, acode_generation,
+)
+from .speech import voice_transcription, voice_translation, avoice_transcription, avoice_translation
 from .images import text_to_image#, image_edit, image_variation
-from .edits import edit_text, edit_code
-from .moderation import text_moderation
+from .edits import edit_text, edit_code, aedit_text, aedit_code
+from .moderation import text_moderation, atext_moderation, ModerationBatcher
+from .embeddings import text_embedding, atext_embedding
+from .session import open_session, close_session
+from .tokens import count_tokens, count_message_tokens, context_window, preload_encodings
 
 __all__ = [
     "text_completion",
@@ -14,4 +20,21 @@ __all__ = [
     "edit_text",
     "edit_code",
     "text_moderation",
+    "atext_completion",
+    "achat_completion",
+    "acode_generation",
+    "avoice_transcription",
+    "avoice_translation",
+    "aedit_text",
+    "aedit_code",
+    "atext_moderation",
+    "ModerationBatcher",
+    "text_embedding",
+    "atext_embedding",
+    "open_session",
+    "close_session",
+    "count_tokens",
+    "count_message_tokens",
+    "context_window",
+    "preload_encodings",
 ]
\ No newline at end of file
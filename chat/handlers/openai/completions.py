@@ -6,13 +6,20 @@ from typing import List
 
 import openai
 from chat.clients import ChatClient
+from .session import use_session
+from .resilience import resilient_call
 
 __all__ = [
     "text_completion",
     "chat_completion",
     "code_generation",
-    "whisper_voice_transcription",
-    "dalle_text_to_image",
+    "atext_completion",
+    "achat_completion",
+    "acode_generation",
+    "text_translation",
+    "atext_translation",
+    "language_detection",
+    "alanguage_detection",
 ]
 
 def text_completion(
@@ -51,6 +58,30 @@ def text_completion(
     )
     return response.get("choices",[{}])[0].get("text")
 
+async def atext_completion(
+    prompt: str,
+    chat: ChatClient = None,
+    engine: str = "text-davinci-003",
+    **kwargs
+):
+    """
+    Generates text completion asynchronously using OpenAI's Completion API.
+    See `text_completion` for the parameters.
+    """
+    if "model" in kwargs:
+        engine = kwargs.pop("model")
+    logging.info(f"Querying OpenAI's Completion API with prompt '{prompt}'")
+    if engine == 'gpt-3.5-turbo':
+        return await achat_completion(prompt, model=engine, **kwargs)
+    elif isinstance(prompt, list):
+        prompt = "\n".join(f"{d['role'].upper()}: {d['content']}" for d in prompt)
+    use_session()
+    response = await resilient_call(
+        lambda: openai.Completion.acreate(prompt=prompt, engine=engine, **kwargs),
+        key=engine,
+    )
+    return response.get("choices",[{}])[0].get("text")
+
 def chat_completion(
     messages: List[dict],
     model: str = "gpt-3.5-turbo",
@@ -67,6 +98,9 @@ def chat_completion(
         The chat client, by default None
     model : str, optional
         The model to use, by default "gpt-3.5-turbo"
+    stream : bool, optional
+        Whether to stream the reply. If True, a generator yielding the
+        pieces (deltas) of the reply as they are generated is returned.
     **kwargs
         Additional keyword arguments to pass to the Chat Completion API.
         See https://platform.openai.com/docs/api-reference/chat/create for a list of
@@ -79,9 +113,65 @@ def chat_completion(
         messages=messages,
         **kwargs
     )
+    if kwargs.get("stream"):
+        return _iter_chat_deltas(response)
+    return response.get("choices",[{}])[0].get("message", {}).get("content")
+
+async def achat_completion(
+    messages: List[dict],
+    model: str = "gpt-3.5-turbo",
+    fallback: str = None,
+    **kwargs
+):
+    """
+    Generates chat completion asynchronously using OpenAI's Chat Completion API.
+    See `chat_completion` for the parameters. If `stream=True`, an async generator
+    yielding the pieces of the reply is returned.
 
+    The request is retried, cut at the current deadline and rejected while the
+    circuit of the model is open (see `resilience`). If `fallback` is given, it's
+    returned (or streamed) instead of raising when the request fails.
+    """
+    if "engine" in kwargs:
+        model = kwargs.pop("engine")
+    stream = kwargs.get("stream", False)
+    use_session()
+    try:
+        response = await resilient_call(
+            lambda: openai.ChatCompletion.acreate(model=model, messages=messages, **kwargs),
+            key=model,
+            # a streamed reply can't be hedged once it started
+            hedge=False if stream else None,
+        )
+    except openai.error.OpenAIError as e:
+        if fallback is None:
+            raise
+        logging.warning(f"Chat completion with model '{model}' failed, replying with the fallback: {e!r}")
+        return _aiter_fallback(fallback) if stream else fallback
+    if stream:
+        return _aiter_chat_deltas(response)
     return response.get("choices",[{}])[0].get("message", {}).get("content")
 
+def _iter_chat_deltas(response):
+    """Yields the content of the chunks of a streamed chat completion"""
+    for chunk in response:
+        delta = _chunk_delta(chunk)
+        if delta:
+            yield delta
+
+async def _aiter_chat_deltas(response):
+    """Yields the content of the chunks of an async streamed chat completion"""
+    async for chunk in response:
+        delta = _chunk_delta(chunk)
+        if delta:
+            yield delta
+
+async def _aiter_fallback(text: str):
+    yield text
+
+def _chunk_delta(chunk) -> str:
+    return chunk.get("choices",[{}])[0].get("delta", {}).get("content")
+
 
 def text_translation(
     text: str,
@@ -129,16 +219,7 @@ def text_translation(
     "¿Cómo estás?"
     """
     logging.info(f"Querying OpenAI's Completion API with prompt '{prompt}'")
-    if prompt is None:
-        if from_ is None:
-            prompt = f"Translate the text '{text}' to {to.capitalize()}."
-        else:
-            prompt = f"Translate the text '{text}' from {from_.capitalize()} to {to.capitalize()}."
-    if examples is not None:
-        prompt += " For example: " + ", ".join(
-            [f"{txt} -> {translation}" for txt, translation in examples]
-        )
-    prompt += f"\n----\n{text} ->"
+    prompt = _translation_prompt(text, to, from_, prompt, examples)
     if engine == 'gpt-3.5-turbo':
         messages = [
             {'role': 'user', 'content': prompt},
@@ -151,8 +232,42 @@ def text_translation(
         result_text = text_completion(prompt, engine=engine, **kwargs)
     return re.sub(r" ->.*", "", result_text).strip()
 
-async def atext_translation(*args, **kwargs):
-    return text_translation(*args, **kwargs)
+async def atext_translation(
+    text: str,
+    to: str = "english",
+    from_: str = None,
+    engine: str = "text-da-vinci-003",
+    prompt: str = None,
+    examples: List[str] = None,
+    **kwargs
+):
+    """
+    Translates text asynchronously using OpenAI's Completion API.
+    See `text_translation` for the parameters.
+    """
+    prompt = _translation_prompt(text, to, from_, prompt, examples)
+    if engine == 'gpt-3.5-turbo':
+        messages = [
+            {'role': 'user', 'content': prompt},
+        ]
+        result_text = await achat_completion(messages, model=engine, **kwargs)
+    else:
+        kwargs['stop'] = '\n'
+        result_text = await atext_completion(prompt, engine=engine, **kwargs)
+    return re.sub(r" ->.*", "", result_text).strip()
+
+def _translation_prompt(text, to, from_=None, prompt=None, examples=None) -> str:
+    if prompt is None:
+        if from_ is None:
+            prompt = f"Translate the text '{text}' to {to.capitalize()}."
+        else:
+            prompt = f"Translate the text '{text}' from {from_.capitalize()} to {to.capitalize()}."
+    if examples is not None:
+        prompt += " For example: " + ", ".join(
+            [f"{txt} -> {translation}" for txt, translation in examples]
+        )
+    prompt += f"\n----\n{text} ->"
+    return prompt
 
 def language_detection(
     text: str,
@@ -179,6 +294,43 @@ def language_detection(
     **kwargs
         Additional keyword arguments to pass to the Completion API.
     """
+    prompt = _language_detection_prompt(text, prompt, examples)
+    if engine == 'gpt-3.5-turbo':
+        messages = [
+            {'role': 'system', 'content': prompt},
+        ]
+        # kwargs['stop'] = ['\n']
+        print(f"Querying OpenAI's Chat Completion API with messages {messages}")
+        result_text = chat_completion(messages, model=engine, **kwargs)
+    else:
+        # print(f"Querying OpenAI's Completion API with prompt '{prompt}'")
+        kwargs['stop'] = '\n'
+        result_text = text_completion(prompt, engine=engine, **kwargs)
+    return _parse_detected_language(result_text)
+
+async def alanguage_detection(
+    text: str,
+    engine: str = "gpt-3.5-turbo",
+    prompt: str = None,
+    examples: List[str] = None,
+    **kwargs
+) -> str:
+    """
+    Recognizes the language of a text asynchronously using OpenAI's Completion API.
+    See `language_detection` for the parameters.
+    """
+    prompt = _language_detection_prompt(text, prompt, examples)
+    if engine == 'gpt-3.5-turbo':
+        messages = [
+            {'role': 'system', 'content': prompt},
+        ]
+        result_text = await achat_completion(messages, model=engine, **kwargs)
+    else:
+        kwargs['stop'] = '\n'
+        result_text = await atext_completion(prompt, engine=engine, **kwargs)
+    return _parse_detected_language(result_text)
+
+def _language_detection_prompt(text, prompt=None, examples=None) -> str:
     if prompt is None:
         prompt = f"You are a language recognition program. You can only output a single word saying the language of a given text."
     else:
@@ -194,25 +346,14 @@ def language_detection(
         [f"\"{txt}\" -> {language}" for txt, language in examples]
     )
     prompt += f"\n---\n{text} ->"
-    if engine == 'gpt-3.5-turbo':
-        messages = [
-            {'role': 'system', 'content': prompt},
-        ]
-        # kwargs['stop'] = ['\n']
-        print(f"Querying OpenAI's Chat Completion API with messages {messages}")
-        result_text = chat_completion(messages, model=engine, **kwargs)
-    else:
-        # print(f"Querying OpenAI's Completion API with prompt '{prompt}'")
-        kwargs['stop'] = '\n'
-        result_text = text_completion(prompt, engine=engine, **kwargs)
+    return prompt
+
+def _parse_detected_language(result_text: str) -> str:
     detected_lang = re.sub(r" ->.*", "", result_text).strip().lower()
     if len(detected_lang.split()) > 1:
         detected_lang = detected_lang.split()[0]
     return detected_lang
 
-async def alanguage_detection(*args, **kwargs):
-    return language_detection(*args, **kwargs)
-
 def code_generation(
     prompt: str,
     chat: ChatClient = None,
@@ -228,4 +369,21 @@ def code_generation(
         engine=engine,
         **kwargs
     )
-    return response.get("choices",[{}])[0].get("text")
\ No newline at end of file
+    return response.get("choices",[{}])[0].get("text")
+
+async def acode_generation(
+    prompt: str,
+    chat: ChatClient = None,
+    engine: str = "davinci-codex",
+    **kwargs
+):
+    """
+    Generates code completion asynchronously using OpenAI's Completion API.
+    """
+    logging.info(f"Querying OpenAI's Completion API with prompt '{prompt}'")
+    use_session()
+    response = await resilient_call(
+        lambda: openai.Completion.acreate(prompt=prompt, engine=engine, **kwargs),
+        key=engine,
+    )
+    return response.get("choices",[{}])[0].get("text")
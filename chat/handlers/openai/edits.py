@@ -2,6 +2,8 @@ from typing import Union, Tuple, List
 
 import openai
 from chat.clients import ChatClient
+from .session import use_session
+from .resilience import resilient_call
 
 def edit_text(
     text:str, 
@@ -32,6 +34,30 @@ def edit_text(
     if chat:
         chat.logger.info(f"Text edit with prompt '{prompt}'")
     response = openai.Edit.create(input=text, instruction=prompt, model=model, **kwargs)
+    return _apply_edit(text, response, chat, return_index)
+
+async def aedit_text(
+    text:str, 
+    prompt:str, 
+    chat: ChatClient = None, 
+    model:str = 'text-davinci-edit-001',
+    return_index:bool = False,
+    **kwargs
+) -> Union[str, Tuple[str, int]]:
+    """
+    Returns a completion from OpenAI's Edit API asynchronously.
+    See `edit_text` for the parameters.
+    """
+    if chat:
+        chat.logger.info(f"Text edit with prompt '{prompt}'")
+    use_session()
+    response = await resilient_call(
+        lambda: openai.Edit.acreate(input=text, instruction=prompt, model=model, **kwargs),
+        key=model,
+    )
+    return _apply_edit(text, response, chat, return_index)
+
+def _apply_edit(text, response, chat=None, return_index=False):
     if chat:
         chat.log("OpenAI", response.get("text"))
     choice = response.get("choices",[{}])[0]
@@ -68,4 +94,18 @@ def edit_code(
         See https://platform.openai.com/docs/api-reference/edits/create for a list of
         valid parameters.
     """
-    return edit_text(code, prompt, chat, model, return_index, **kwargs)
\ No newline at end of file
+    return edit_text(code, prompt, chat, model, return_index, **kwargs)
+
+async def aedit_code(
+    code:str, 
+    prompt:str, 
+    chat: ChatClient = None, 
+    model:str = 'code-davinci-edit-001',
+    return_index:bool = False,
+    **kwargs
+) -> Union[str, Tuple[str, int]]:
+    """
+    Returns a completion from OpenAI's Edit API asynchronously.
+    See `edit_code` for the parameters.
+    """
+    return await aedit_text(code, prompt, chat, model, return_index, **kwargs)
@@ -0,0 +1,69 @@
+"""
+Handlers for OpenAI's Embeddings API
+"""
+from typing import List, Union
+
+import openai
+from chat.clients import ChatClient
+from .session import use_session
+from .resilience import resilient_call
+
+__all__ = [
+    "text_embedding",
+    "atext_embedding",
+]
+
+Embedding = List[float]
+
+
+def text_embedding(
+    text: Union[str, List[str]],
+    chat: ChatClient = None,
+    model: str = "text-embedding-ada-002",
+    **kwargs
+) -> Union[Embedding, List[Embedding]]:
+    """
+    Returns the embedding of the text using OpenAI's Embeddings API.
+
+    Parameters
+    ----------
+    text : str or List[str]
+        The text to embed, or a list of texts to embed in a single request
+        (then a list with the embedding of each of them is returned).
+    chat : ChatClient, optional
+        The chat client to use for logging, by default None
+    model : str, optional
+        The model to use, by default "text-embedding-ada-002"
+    **kwargs
+        Additional keyword arguments to pass to the Embeddings API.
+        See https://platform.openai.com/docs/api-reference/embeddings for a list of
+        valid parameters.
+    """
+    if chat:
+        chat.logger.info(f"Text embedding with model '{model}'")
+    response = openai.Embedding.create(input=text, model=model, **kwargs)
+    return _embeddings(response, text)
+
+async def atext_embedding(
+    text: Union[str, List[str]],
+    chat: ChatClient = None,
+    model: str = "text-embedding-ada-002",
+    **kwargs
+) -> Union[Embedding, List[Embedding]]:
+    """
+    Returns the embedding of the text asynchronously using OpenAI's Embeddings API.
+    See `text_embedding` for the parameters.
+    """
+    if chat:
+        chat.logger.info(f"Text embedding with model '{model}'")
+    use_session()
+    response = await resilient_call(
+        lambda: openai.Embedding.acreate(input=text, model=model, **kwargs),
+        key=model,
+    )
+    return _embeddings(response, text)
+
+def _embeddings(response, text):
+    data = sorted(response.get("data") or [], key=lambda d: d.get("index", 0))
+    embeddings = [d.get("embedding") for d in data]
+    return embeddings if isinstance(text, list) else embeddings[0]
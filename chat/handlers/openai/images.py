@@ -1,6 +1,8 @@
 import os, logging
 from chat.clients import ChatClient
-import openai, requests
+import aiohttp, openai
+from .session import get_session, use_session
+from .resilience import resilient_call
 
 async def text_to_image(prompt: str, *, as_url=True, **kwargs):
     """Generate an image asychronously given the prompt"""
@@ -9,10 +11,12 @@ async def text_to_image(prompt: str, *, as_url=True, **kwargs):
     )
     creation_params = dict(n=1, size="1024x1024")
     creation_params.update(kwargs)
-    # create a partial function to send the image with the given parameters
-    response = openai.Image.create(
-        prompt=prompt,
-        **creation_params)
+    use_session()
+    # a hedged generation would be paid twice
+    response = await resilient_call(
+        lambda: openai.Image.acreate(prompt=prompt, **creation_params),
+        key="dall-e", hedge=False,
+    )
     data = response.get("data")
     if data is None:
         return None
@@ -21,5 +25,12 @@ async def text_to_image(prompt: str, *, as_url=True, **kwargs):
         return None
     if as_url:
         return image_url
-    else:
-        return requests.get(image_url).content
\ No newline at end of file
+    session = get_session()
+    if session is not None:
+        async with session.get(image_url) as response:
+            response.raise_for_status()
+            return await response.read()
+    async with aiohttp.ClientSession() as session:
+        async with session.get(image_url) as response:
+            response.raise_for_status()
+            return await response.read()
@@ -1,5 +1,25 @@
-from typing import Union
+"""
+Handlers for OpenAI's Moderation API.
+
+The API takes a list of inputs, so `ModerationBatcher` gathers the texts
+moderated by concurrent conversations (in any thread or event loop) for a few
+milliseconds and sends them in a single request, giving every caller its own
+result.
+"""
+import asyncio
+import logging
+import threading
+from typing import List, Union
+
 import openai
+from .session import use_session
+from .resilience import resilient_call
+
+__all__ = [
+    "text_moderation",
+    "atext_moderation",
+    "ModerationBatcher",
+]
 
 def text_moderation(
     text, 
@@ -7,14 +27,15 @@ def text_moderation(
     model="text-moderation-latest", 
     return_flagged=False,
     **kwargs
-) -> Union[bool, dict]:
+) -> Union[bool, dict, List[bool], List[dict]]:
     """
     Returns a completion from OpenAI's Moderation API.
 
     Parameters
     ----------
-    text : str
-        The text to moderate.
+    text : str or List[str]
+        The text to moderate, or a list of texts to moderate in a single request
+        (then a list with the result of each of them is returned).
     chat : ChatClient, optional
         The chat client to use for logging, by default None
     model : str, optional
@@ -31,7 +52,147 @@ def text_moderation(
     if chat:
         chat.logger.info(f"Text moderation with model '{model}'")
     response = openai.Moderation.create(input=text, model=model, **kwargs)
-    result = response.get("results", [{}])[0]
+    return _moderation_results(response, text, return_flagged)
+
+async def atext_moderation(
+    text, 
+    chat=None, 
+    model="text-moderation-latest", 
+    return_flagged=False,
+    **kwargs
+) -> Union[bool, dict, List[bool], List[dict]]:
+    """
+    Returns a completion from OpenAI's Moderation API asynchronously.
+    See `text_moderation` for the parameters.
+    """
+    if chat:
+        chat.logger.info(f"Text moderation with model '{model}'")
+    use_session()
+    response = await resilient_call(
+        lambda: openai.Moderation.acreate(input=text, model=model, **kwargs),
+        key=model,
+    )
+    return _moderation_results(response, text, return_flagged)
+
+def _moderation_results(response, text, return_flagged=False):
+    results = response.get("results") or [{}]
     if return_flagged:
-        return result.get("flagged")
-    return result
\ No newline at end of file
+        results = [result.get("flagged") for result in results]
+    return results if isinstance(text, list) else results[0]
+
+
+class ModerationBatcher:
+    """
+    Moderates texts in batches: the texts moderated within `max_delay` seconds
+    of the first one (or until there are `max_batch_size` of them) are sent in
+    a single request to the Moderation API.
+
+    Parameters
+    ----------
+    model : str, optional
+        The model to use for moderation, by default "text-moderation-latest"
+    max_batch_size : int, optional
+        Maximum number of texts in a request, by default 32
+    max_delay : float, optional
+        Seconds a text waits for others to be batched with, by default 0.01
+
+    Usage
+    -----
+    >>> moderator = ModerationBatcher()
+    >>> result = await moderator.moderate("I want to hurt them")
+    >>> result["flagged"]
+    True
+    """
+
+    def __init__(self, model: str = "text-moderation-latest", max_batch_size: int = 32, max_delay: float = 0.01):
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.max_delay = max_delay
+        # texts waiting, as (text, event loop, future) of the callers
+        self._batch = None
+        self._lock = threading.Lock()
+        self._tasks = set()
+        self.batches = 0
+        self.items = 0
+
+    async def moderate(self, text: str, return_flagged: bool = False) -> Union[bool, dict]:
+        """Returns the moderation results of the text (or only if it was flagged)"""
+        loop = asyncio.get_event_loop()
+        future = loop.create_future()
+        with self._lock:
+            batch = self._batch
+            first = batch is None
+            if first:
+                batch = self._batch = []
+            batch.append((text, loop, future))
+            full = len(batch) >= self.max_batch_size
+            if full:
+                self._batch = None
+        if full:
+            self._spawn(self._send(batch))
+        elif first:
+            self._spawn(self._send_later(batch))
+        result = await future
+        return result.get("flagged") if return_flagged else result
+
+    def _spawn(self, coro):
+        # the batch is sent even if the caller that started it is cancelled
+        task = asyncio.ensure_future(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _send_later(self, batch: list):
+        await asyncio.sleep(self.max_delay)
+        with self._lock:
+            if self._batch is not batch:
+                return  # it was sent when it filled up
+            self._batch = None
+        await self._send(batch)
+
+    async def _send(self, batch: list):
+        # identical texts (e.g. the same greeting) are only moderated once
+        texts = list(dict.fromkeys(text for text, _, _ in batch))
+        try:
+            use_session()
+            response = await resilient_call(
+                lambda: openai.Moderation.acreate(input=texts, model=self.model),
+                key=self.model,
+            )
+            results = response.get("results") or []
+            if len(results) != len(texts):
+                raise openai.error.APIError(f"Got {len(results)} moderation results for {len(texts)} inputs")
+        except Exception as e:
+            for _, loop, future in batch:
+                _resolve(loop, future, exception=e)
+            return
+        with self._lock:
+            self.batches += 1
+            self.items += len(batch)
+        by_text = dict(zip(texts, results))
+        for text, loop, future in batch:
+            _resolve(loop, future, result=by_text[text])
+
+    def stats(self) -> dict:
+        return dict(
+            batches=self.batches,
+            items=self.items,
+            mean_batch_size=self.items / self.batches if self.batches else 0.0,
+        )
+
+
+def _resolve(loop, future, result=None, exception=None):
+    """Sets the result of the future of a caller, which may be in another event loop"""
+    def resolve():
+        if future.done():
+            return
+        if exception is not None:
+            future.set_exception(exception)
+        else:
+            future.set_result(result)
+    try:
+        if loop is asyncio.get_event_loop():
+            resolve()
+        else:
+            loop.call_soon_threadsafe(resolve)
+    except RuntimeError:  # the loop of the caller was closed
+        logging.debug("Dropped the moderation result of a caller whose loop is closed")
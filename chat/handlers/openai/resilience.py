@@ -0,0 +1,400 @@
+"""
+Guarded calls to OpenAI's API.
+
+`resilient_call` runs a request to the API with:
+
+- a deadline: every attempt is cut when the deadline of the current request
+  (set with `deadline(seconds)`, e.g. the time left to answer the webhook) passes
+- retries with jittered exponential backoff for rate limits, timeouts and server
+  errors, waiting at least what the `Retry-After` header asks for when it's given
+- a circuit breaker per model that, after a number of consecutive failures,
+  fails fast with `CircuitOpenError` until a probe request succeeds again
+- optional hedging: when an attempt takes longer than the p95 latency of the
+  model, a second identical request is sent and the first answer is used
+
+Usage
+-----
+>>> with deadline(14):
+...     response = await resilient_call(
+...         lambda: openai.ChatCompletion.acreate(model=model, messages=messages),
+...         key=model, hedge=True,
+...     )
+"""
+import asyncio
+import contextvars
+import logging
+import os
+import random
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from email.utils import parsedate_to_datetime
+from typing import Awaitable, Callable, Dict, Optional
+
+import openai
+
+__all__ = [
+    "resilient_call",
+    "deadline",
+    "time_left",
+    "get_breaker",
+    "health",
+    "stats",
+    "CircuitBreaker",
+    "CircuitOpenError",
+    "DeadlineExceededError",
+]
+
+logger = logging.getLogger(__name__)
+
+# retries of a failed request (so up to MAX_RETRIES + 1 attempts)
+MAX_RETRIES = int(os.environ.get("OPENAI_MAX_RETRIES", 2))
+# maximum seconds of an attempt when there's no (closer) deadline
+CALL_TIMEOUT = float(os.environ.get("OPENAI_CALL_TIMEOUT", 60))
+# consecutive failures that open the circuit of a model, and seconds until it's probed again
+BREAKER_THRESHOLD = int(os.environ.get("OPENAI_BREAKER_THRESHOLD", 5))
+BREAKER_RESET_SECONDS = float(os.environ.get("OPENAI_BREAKER_RESET_SECONDS", 30))
+# send a second request when the first one is slower than the p95 latency of the model
+HEDGE = os.environ.get("OPENAI_HEDGE", "false").lower() in ("1", "true", "yes")
+# latencies needed before hedging (the p95 of a few samples is meaningless)
+HEDGE_MIN_SAMPLES = 20
+
+BACKOFF_BASE = 0.5
+BACKOFF_MAX = 8.0
+
+CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+_deadline = contextvars.ContextVar("openai_deadline", default=None)
+
+
+class CircuitOpenError(openai.error.ServiceUnavailableError):
+    """Raised without calling the API while the circuit of the model is open"""
+
+
+class DeadlineExceededError(openai.error.Timeout):
+    """Raised when the deadline of the request passes before the API answers"""
+
+
+@contextmanager
+def deadline(seconds: float):
+    """Sets the deadline of the API calls made in the block (and the tasks it creates)"""
+    at = time.monotonic() + seconds
+    current = _deadline.get()
+    token = _deadline.set(at if current is None else min(at, current))
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+def time_left() -> Optional[float]:
+    """Returns the seconds left until the current deadline, or None if there's none"""
+    at = _deadline.get()
+    return None if at is None else at - time.monotonic()
+
+
+class CircuitBreaker:
+    """
+    Counts the consecutive failures of a model. After `failure_threshold` of
+    them the circuit opens and requests are rejected for `reset_timeout`
+    seconds, then a single probe request is let through: if it succeeds the
+    circuit closes again, otherwise it stays open for another period.
+    """
+
+    def __init__(self, failure_threshold: int = BREAKER_THRESHOLD, reset_timeout: float = BREAKER_RESET_SECONDS):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.rejected = 0
+        self._probing = False
+        # the workers of different event loops share the breakers
+        self._lock = threading.Lock()
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self.state == OPEN and time.monotonic() - self.opened_at >= self.reset_timeout:
+                self.state = HALF_OPEN
+                self._probing = False
+            if self.state == CLOSED:
+                return True
+            if self.state == HALF_OPEN and not self._probing:
+                self._probing = True
+                return True
+            self.rejected += 1
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.state = CLOSED
+            self.failures = 0
+            self._probing = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == HALF_OPEN or self.failures >= self.failure_threshold:
+                if self.state != OPEN:
+                    logger.warning("Opening the circuit after %d consecutive failures", self.failures)
+                self.state = OPEN
+                self.opened_at = time.monotonic()
+                self._probing = False
+
+    def release(self):
+        """Ends a request that neither succeeded nor failed (e.g. it was cancelled)"""
+        with self._lock:
+            self._probing = False
+
+
+class _History:
+    """The latencies of the last successful requests of a model and the outcomes of its last requests"""
+
+    def __init__(self, size: int = 200):
+        self._values = deque(maxlen=size)
+        self._outcomes = deque(maxlen=size)
+        self._lock = threading.Lock()
+
+    def observe(self, seconds: float):
+        with self._lock:
+            self._values.append(seconds)
+            self._outcomes.append(True)
+
+    def observe_failure(self):
+        with self._lock:
+            self._outcomes.append(False)
+
+    def percentile(self, q: float, min_samples: int = HEDGE_MIN_SAMPLES) -> Optional[float]:
+        with self._lock:
+            if not self._values or len(self._values) < min_samples:
+                return None
+            values = sorted(self._values)
+        return values[min(len(values) - 1, int(q * len(values)))]
+
+    def error_rate(self) -> float:
+        with self._lock:
+            if not self._outcomes:
+                return 0.0
+            return self._outcomes.count(False) / len(self._outcomes)
+
+
+_breakers: Dict[str, CircuitBreaker] = {}
+_histories: Dict[str, _History] = {}
+_registry_lock = threading.Lock()
+_counts = {"retries": 0, "hedges": 0, "hedge_wins": 0, "deadline_exceeded": 0}
+
+
+def _count(event: str):
+    with _registry_lock:
+        _counts[event] += 1
+
+
+def get_breaker(key: str) -> CircuitBreaker:
+    """Returns the circuit breaker of the model (or API)"""
+    with _registry_lock:
+        breaker = _breakers.get(key)
+        if breaker is None:
+            breaker = _breakers[key] = CircuitBreaker()
+            _histories[key] = _History()
+        return breaker
+
+
+def health(key: str, min_samples: int = 5) -> dict:
+    """
+    Returns the state of the circuit of the model (or API), the p50 and p95
+    latency of its last successful requests (None with fewer than `min_samples`)
+    and the fraction of its last requests that failed.
+    """
+    breaker = get_breaker(key)
+    history = _histories[key]
+    return {
+        "state": breaker.state,
+        "available": breaker.state != OPEN or time.monotonic() - breaker.opened_at >= breaker.reset_timeout,
+        "latency_p50": history.percentile(0.5, min_samples),
+        "latency_p95": history.percentile(0.95, min_samples),
+        "error_rate": history.error_rate(),
+    }
+
+
+def stats() -> dict:
+    """Returns the retries and hedges made and the state of the circuit of each model"""
+    with _registry_lock:
+        breakers = dict(_breakers)
+        counts = dict(_counts)
+    return dict(
+        counts,
+        circuits={
+            key: {"state": breaker.state, "failures": breaker.failures, "rejected": breaker.rejected}
+            for key, breaker in breakers.items()
+        },
+    )
+
+
+def _is_retryable(error: BaseException) -> bool:
+    if isinstance(error, (
+        asyncio.TimeoutError,
+        openai.error.RateLimitError,
+        openai.error.ServiceUnavailableError,
+        openai.error.APIConnectionError,
+        openai.error.Timeout,
+        openai.error.TryAgain,
+    )):
+        return True
+    if isinstance(error, openai.error.APIError):
+        return error.http_status is None or error.http_status >= 500
+    return False
+
+
+def _retry_after(error: BaseException) -> Optional[float]:
+    """Returns the seconds to wait asked by the `Retry-After` header of the error, if any"""
+    headers = getattr(error, "headers", None) or {}
+    values = {str(name).lower(): value for name, value in headers.items()}
+    if values.get("retry-after-ms"):
+        try:
+            return float(values["retry-after-ms"]) / 1000
+        except ValueError:
+            pass
+    value = values.get("retry-after")
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def _backoff(attempt: int, error: BaseException) -> float:
+    delay = random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
+    retry_after = _retry_after(error)
+    if retry_after is not None:
+        # never earlier than asked, with a bit of jitter so the retries don't arrive together
+        delay = retry_after + random.uniform(0, BACKOFF_BASE)
+    return delay
+
+
+async def _hedged(call: Callable[[], Awaitable], hedge_after: float):
+    """Awaits the call, sending a second one if the first takes longer than `hedge_after`"""
+    first = asyncio.ensure_future(call())
+    tasks = {first}
+    try:
+        done, _ = await asyncio.wait(tasks, timeout=hedge_after)
+        if done:
+            return first.result()
+        _count("hedges")
+        second = asyncio.ensure_future(call())
+        tasks.add(second)
+        pending = set(tasks)
+        error = None
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    if task is second:
+                        _count("hedge_wins")
+                    return task.result()
+                error = task.exception()
+        raise error
+    finally:
+        for task in tasks:
+            if not task.done():
+                task.cancel()
+
+
+async def resilient_call(
+    call: Callable[[], Awaitable],
+    key: str,
+    *,
+    max_retries: int = None,
+    timeout: float = None,
+    hedge: bool = None,
+):
+    """
+    Awaits `call()` (a request to the API) with the deadline, retries, circuit
+    breaker and hedging described in the module.
+
+    Parameters
+    ----------
+    call : Callable[[], Awaitable]
+        Creates the request, it's called once per attempt (and hedge).
+    key : str
+        The model (or API) the request goes to, which has its own circuit breaker
+        and latencies.
+    max_retries : int, optional
+        Retries of a failed request, by default OPENAI_MAX_RETRIES (2)
+    timeout : float, optional
+        Maximum seconds of an attempt, by default OPENAI_CALL_TIMEOUT (60).
+        Attempts are also cut at the deadline set with `deadline`.
+    hedge : bool, optional
+        Whether to hedge slow requests, by default OPENAI_HEDGE (False).
+        Requests with side effects (e.g. image generations) shouldn't be hedged.
+
+    Raises
+    ------
+    CircuitOpenError
+        If the circuit of the model is open.
+    DeadlineExceededError
+        If the deadline passes before a successful attempt.
+    openai.error.OpenAIError
+        The error of the last attempt if it can't be retried (or there are no retries left).
+    """
+    max_retries = MAX_RETRIES if max_retries is None else max_retries
+    timeout = CALL_TIMEOUT if timeout is None else timeout
+    hedge = HEDGE if hedge is None else hedge
+    breaker = get_breaker(key)
+    history = _histories[key]
+    attempt = 0
+    while True:
+        left = time_left()
+        attempt_timeout = timeout if left is None else min(timeout, left)
+        if attempt_timeout <= 0:
+            _count("deadline_exceeded")
+            raise DeadlineExceededError(f"The deadline passed before the request to '{key}' could be made")
+        if not breaker.allow():
+            raise CircuitOpenError(f"The circuit of '{key}' is open after repeated failures")
+        hedge_after = history.percentile(0.95) if hedge else None
+        start = time.monotonic()
+        try:
+            if hedge_after is not None and hedge_after < attempt_timeout:
+                result = await asyncio.wait_for(_hedged(call, hedge_after), attempt_timeout)
+            else:
+                result = await asyncio.wait_for(call(), attempt_timeout)
+        except asyncio.CancelledError:
+            breaker.release()
+            raise
+        except Exception as error:
+            if not _is_retryable(error):
+                # the API answered (e.g. an invalid request), it isn't failing
+                breaker.release()
+                raise
+            if isinstance(error, asyncio.TimeoutError) and attempt_timeout < timeout:
+                # cut by our deadline, not slower than the model is allowed to be
+                breaker.release()
+            else:
+                breaker.record_failure()
+                history.observe_failure()
+            delay = _backoff(attempt, error)
+            left = time_left()
+            out_of_time = left is not None and delay >= left
+            if attempt >= max_retries or out_of_time or breaker.state == OPEN:
+                if isinstance(error, asyncio.TimeoutError):
+                    _count("deadline_exceeded")
+                    raise DeadlineExceededError(
+                        f"The request to '{key}' took longer than {attempt_timeout:.1f} seconds"
+                    ) from error
+                raise
+            _count("retries")
+            logger.warning(
+                "Request to '%s' failed (%s), retrying in %.2f seconds",
+                key, type(error).__name__, delay,
+            )
+            await asyncio.sleep(delay)
+            attempt += 1
+            continue
+        breaker.record_success()
+        history.observe(time.monotonic() - start)
+        return result
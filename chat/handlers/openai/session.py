@@ -0,0 +1,53 @@
+"""
+Shared HTTP session for the async calls to OpenAI's API.
+
+Without a shared session the `openai` library opens a new session (and a
+new TLS connection) for every async request. `open_session` creates one
+long-lived session with a size-limited connection pool for the running
+event loop, which the async handlers then use for all their requests.
+Loops without one (e.g. a loop per request) keep the library's behaviour.
+"""
+import asyncio
+import os
+
+import aiohttp
+import openai
+
+# maximum number of simultaneous connections to the API per event loop
+MAX_CONNECTIONS = int(os.environ.get("OPENAI_MAX_CONNECTIONS", 20))
+
+# a session keeps a reference to its loop, so it's only removed by `close_session`
+_sessions = {}  # event loop -> session
+
+
+async def open_session(limit: int = MAX_CONNECTIONS, **kwargs) -> aiohttp.ClientSession:
+    """Creates the shared session of the running event loop"""
+    loop = asyncio.get_event_loop()
+    session = _sessions.get(loop)
+    if session is None or session.closed:
+        connector = aiohttp.TCPConnector(limit=limit, keepalive_timeout=60)
+        session = aiohttp.ClientSession(connector=connector, **kwargs)
+        _sessions[loop] = session
+    return session
+
+
+def get_session() -> aiohttp.ClientSession:
+    """Returns the shared session of the running event loop if it was opened, otherwise None"""
+    session = _sessions.get(asyncio.get_event_loop())
+    if session is None or session.closed:
+        return None
+    return session
+
+
+def use_session():
+    """Makes the OpenAI calls of the current task go through the shared session (if any)"""
+    session = get_session()
+    if session is not None:
+        openai.aiosession.set(session)
+
+
+async def close_session():
+    """Closes the shared session of the running event loop"""
+    session = _sessions.pop(asyncio.get_event_loop(), None)
+    if session is not None and not session.closed:
+        await session.close()
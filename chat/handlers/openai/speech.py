@@ -1,10 +1,13 @@
-import tempfile
+import os
+from contextlib import asynccontextmanager, contextmanager
 from typing import List, Union
 
 import openai
-import requests
 
 from chat.clients import ChatClient
+from chat.handlers.media import FetchedMedia, afetch_media, fetch_media
+from .session import get_session, use_session
+from .resilience import resilient_call
 
 def voice_transcription(
     url_or_file: str,
@@ -26,24 +29,19 @@ def voice_transcription(
         The URL or path to the audio file to be transcribed.
     chat : ChatClient, optional
         The chat client to use for logging, by default None
+    asynch : bool, optional
+        If True, returns a coroutine that transcribes the audio asynchronously
+        (see `avoice_transcription`)
     **kwargs
     """
-    if url_or_file.startswith("http"):
-        response = requests.get(url_or_file)
-        response.raise_for_status()
-        audio = response.content
-        # create the file
-        f = tempfile.NamedTemporaryFile(delete=False)
-        f.write(audio)
-        url_or_file = f.name
-
-    params = dict(file=url_or_file,  model=model,  prompt=prompt, language=language, 
-                  response_format='json', **kwargs)
-
     if asynch:
-        return openai.Audio.atranscribe(**params)
-    
-    response = openai.Audio.transcribe(**params)
+        return avoice_transcription(
+            url_or_file, chat, language=language, model=model, prompt=prompt, **kwargs)
+
+    with _open_audio(url_or_file) as audio:
+        response = openai.Audio.transcribe_raw(
+            model, audio.file, audio.filename, prompt=prompt, language=language,
+            response_format='json', **kwargs)
     return response.get("text")
 
 def voice_translation(
@@ -67,18 +65,80 @@ def voice_translation(
         The chat client to use for logging, by default None
     **kwargs
     """
-    if url_or_file.startswith("http"):
-        response = requests.get(url_or_file)
-        response.raise_for_status()
-        audio = response.content
-        # create the file
-        f = tempfile.NamedTemporaryFile(delete=False)
-        f.write(audio)
-        url_or_file = f.name
+    with _open_audio(url_or_file) as audio:
+        response = openai.Audio.translate_raw(
+            model, audio.file, audio.filename, prompt=prompt,
+            language=language, response_format='json', **kwargs)
+    return response.get("text")
 
-    response = openai.Audio.translate(
-        url_or_file, model=model, prompt=prompt, 
-        language=language, response_format='json', 
-        **kwargs)
+async def avoice_transcription(
+    url_or_file: str,
+    chat: ChatClient = None,
+    *,
+    language: str = 'en',
+    model: str = 'whisper-1',
+    prompt: str = None,
+    **kwargs
+) -> str:
+    """
+    Transcribes the given audio file or URL asynchronously using OpenAI's Voice API.
+    See `voice_transcription` for the parameters.
+    """
+    async with _aopen_audio(url_or_file) as audio:
+        use_session()
+        # the file is read again by every attempt, so the attempts can't overlap
+        response = await resilient_call(
+            lambda: openai.Audio.atranscribe_raw(
+                model, _rewind(audio.file), audio.filename, prompt=prompt, language=language,
+                response_format='json', **kwargs),
+            key=model, hedge=False,
+        )
+    return response.get("text")
 
-    return response.get("text")
\ No newline at end of file
+async def avoice_translation(
+    url_or_file: str,
+    chat: ChatClient = None,
+    *,
+    language: str = 'en',
+    model: str = 'whisper-1',
+    prompt: str = None,
+    **kwargs
+) -> str:
+    """
+    Translates the given audio file or URL asynchronously using OpenAI's Voice API.
+    See `voice_translation` for the parameters.
+    """
+    async with _aopen_audio(url_or_file) as audio:
+        use_session()
+        # the file is read again by every attempt, so the attempts can't overlap
+        response = await resilient_call(
+            lambda: openai.Audio.atranslate_raw(
+                model, _rewind(audio.file), audio.filename, prompt=prompt, language=language,
+                response_format='json', **kwargs),
+            key=model, hedge=False,
+        )
+    return response.get("text")
+
+def _rewind(file):
+    file.seek(0)
+    return file
+
+@contextmanager
+def _open_audio(url_or_file: str):
+    """Opens the audio in the given URL (streamed into a temporary file) or path"""
+    if url_or_file.startswith("http"):
+        with fetch_media(url_or_file) as media:
+            yield media
+    else:
+        with open(url_or_file, "rb") as f:
+            yield FetchedMedia(f, size=os.path.getsize(url_or_file), name=os.path.basename(url_or_file))
+
+@asynccontextmanager
+async def _aopen_audio(url_or_file: str):
+    """Opens the audio in the given URL (streamed into a temporary file) or path asynchronously"""
+    if url_or_file.startswith("http"):
+        async with afetch_media(url_or_file, session=get_session()) as media:
+            yield media
+    else:
+        with open(url_or_file, "rb") as f:
+            yield FetchedMedia(f, size=os.path.getsize(url_or_file), name=os.path.basename(url_or_file))
@@ -0,0 +1,75 @@
+"""
+Offline token counting for OpenAI's chat models
+"""
+import logging
+from functools import lru_cache
+
+try:
+    import tiktoken
+except ImportError:  # fall back to an estimate based on the length of the text
+    tiktoken = None
+
+__all__ = [
+    "count_tokens",
+    "count_message_tokens",
+    "context_window",
+    "preload_encodings",
+]
+
+# number of tokens in the context window of the chat models
+CONTEXT_WINDOWS = {
+    "gpt-3.5-turbo": 4096,
+    "gpt-3.5-turbo-16k": 16384,
+    "gpt-4": 8192,
+    "gpt-4-32k": 32768,
+}
+# tokens added by the chat format to every message (role, separators)
+TOKENS_PER_MESSAGE = 4
+
+
+@lru_cache(maxsize=16)
+def _get_encoding(model: str):
+    # the result (even None) is cached, so a failed download isn't retried on every message
+    if tiktoken is None:
+        return None
+    try:
+        try:
+            return tiktoken.encoding_for_model(model)
+        except KeyError:
+            return tiktoken.get_encoding("cl100k_base")
+    except Exception as e:  # e.g. the encoding can't be downloaded
+        logging.warning(f"Could not load the tokenizer of model '{model}', token counts will be estimated: {e}")
+        return None
+
+
+def preload_encodings(*models: str) -> dict:
+    """
+    Loads (downloading them if needed) the tokenizers of the models, so that it
+    isn't done by the first message. Returns whether each of them could be loaded.
+    """
+    return {model: _get_encoding(model) is not None for model in models if model}
+
+
+def count_tokens(text: str, model: str = "gpt-3.5-turbo") -> int:
+    """Returns the number of tokens of the text for the given model"""
+    if not text:
+        return 0
+    encoding = _get_encoding(model)
+    if encoding is None:
+        # ~4 characters per token in english text
+        return len(text) // 4 + 1
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+def count_message_tokens(message: dict, model: str = "gpt-3.5-turbo") -> int:
+    """Returns the number of tokens that a chat message takes in a request"""
+    return TOKENS_PER_MESSAGE + count_tokens(message.get("content"), model)
+
+
+def context_window(model: str) -> int:
+    """Returns the size of the context window of the model in tokens"""
+    if model in CONTEXT_WINDOWS:
+        return CONTEXT_WINDOWS[model]
+    # versioned models, e.g. "gpt-4-0613" or "gpt-3.5-turbo-16k-0613"
+    prefixes = sorted((m for m in CONTEXT_WINDOWS if model.startswith(m)), key=len)
+    return CONTEXT_WINDOWS[prefixes[-1]] if prefixes else 4096
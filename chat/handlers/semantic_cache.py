@@ -0,0 +1,263 @@
+"""
+Semantic cache of answers to questions.
+
+The normalized embeddings of the cached questions are the rows of a NumPy
+matrix, so a lookup is a single matrix-vector product (the cosine similarity
+with every question) followed by a top-k selection. An answer is reused when
+the similarity of its question passes a threshold. Entries expire after a TTL
+and the least recently used one is replaced when the cache is full.
+
+If a path is given, the matrix is a memory-mapped `.npy` file and the
+questions and answers are saved next to it in a JSON file, so the cache
+survives restarts without being loaded in memory up front.
+"""
+import atexit
+import json
+import logging
+import os
+import threading
+import time
+from typing import List, Optional, Sequence, Tuple
+
+import numpy as np
+
+__all__ = [
+    "SemanticCache",
+]
+
+logger = logging.getLogger(__name__)
+
+
+def _normalize(vector: Sequence[float]) -> np.ndarray:
+    vector = np.asarray(vector, dtype=np.float32)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm > 0 else vector
+
+
+class SemanticCache:
+    """
+    A fixed-capacity cache of answers looked up by the similarity of their questions.
+
+    Parameters
+    ----------
+    threshold : float, optional
+        Minimum cosine similarity of a cached question to reuse its answer, by default 0.95
+    max_entries : int, optional
+        Maximum number of cached answers, by default 5000
+    ttl : float, optional
+        Seconds an answer is reused, by default a day. None for no expiration.
+    path : str, optional
+        Base path of the files of the cache (`{path}.npy` and `{path}.json`),
+        by default the cache is only kept in memory.
+    save_every : int, optional
+        The metadata is saved after this many new answers (and by `save`), by default 20
+    """
+
+    def __init__(
+        self,
+        threshold: float = 0.95,
+        max_entries: int = 5000,
+        ttl: Optional[float] = 24 * 60 * 60,
+        path: str = None,
+        save_every: int = 20,
+    ):
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.path = path
+        self.save_every = save_every
+        self._lock = threading.Lock()
+        self._vectors = None  # (max_entries, dim) created with the first answer
+        self._size = 0  # rows used so far (the matrix fills up before rows are reused)
+        self._valid = np.zeros(max_entries, dtype=bool)
+        self._expires_at = np.full(max_entries, np.inf)
+        self._last_used = np.zeros(max_entries)
+        self._scopes = np.full(max_entries, -1, dtype=np.int32)
+        self._scope_ids = {}
+        self._entries = [None] * max_entries  # (question, answer, scope, seconds to generate it)
+        self._unsaved = 0
+        self.hits = 0
+        self.misses = 0
+        self.seconds_saved = 0.0
+        self.lookup_seconds = 0.0
+        if path is not None:
+            self._load()
+            atexit.register(self.save)
+
+    @property
+    def dim(self) -> Optional[int]:
+        return None if self._vectors is None else self._vectors.shape[1]
+
+    def _scope_id(self, scope: str) -> int:
+        if scope not in self._scope_ids:
+            self._scope_ids[scope] = len(self._scope_ids)
+        return self._scope_ids[scope]
+
+    def _create_vectors(self, dim: int):
+        if self.path is None:
+            self._vectors = np.zeros((self.max_entries, dim), dtype=np.float32)
+            return
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        self._vectors = np.lib.format.open_memmap(
+            f"{self.path}.npy", mode="w+", dtype=np.float32, shape=(self.max_entries, dim))
+
+    def _scores(self, query: np.ndarray, scope: str) -> Optional[np.ndarray]:
+        """Returns the similarity of the query with every used row (-inf for the rows not live in the scope)"""
+        if self._vectors is None or self._size == 0 or query.shape[0] != self.dim:
+            return None
+        n = self._size
+        scores = self._vectors[:n] @ query
+        live = self._valid[:n] & (self._scopes[:n] == self._scope_ids.get(scope, -2))
+        live &= self._expires_at[:n] > time.time()
+        return np.where(live, scores, -np.inf)
+
+    def search(self, vector: Sequence[float], k: int = 1, scope: str = "") -> List[Tuple[float, str, str]]:
+        """Returns the (similarity, question, answer) of the `k` most similar live questions of the scope"""
+        query = _normalize(vector)
+        with self._lock:
+            scores = self._scores(query, scope)
+            if scores is None:
+                return []
+            k = min(k, len(scores))
+            top = np.argpartition(-scores, k - 1)[:k]
+            top = top[np.argsort(-scores[top])]
+            return [
+                (float(scores[i]), self._entries[i][0], self._entries[i][1])
+                for i in top if np.isfinite(scores[i])
+            ]
+
+    def get(self, vector: Sequence[float], scope: str = "") -> Optional[Tuple[str, float]]:
+        """
+        Returns the cached answer of the most similar question of the scope and its
+        similarity if it passes the threshold (otherwise None), and records the hit or miss.
+        """
+        start = time.perf_counter()
+        query = _normalize(vector)
+        result = None
+        with self._lock:
+            scores = self._scores(query, scope)
+            if scores is not None:
+                best = int(np.argmax(scores))
+                if scores[best] >= self.threshold:
+                    self._last_used[best] = time.time()
+                    self.seconds_saved += self._entries[best][3]
+                    result = (self._entries[best][1], float(scores[best]))
+            if result is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            self.lookup_seconds += time.perf_counter() - start
+        return result
+
+    def put(self, vector: Sequence[float], question: str, answer: str, scope: str = "", seconds: float = 0.0):
+        """
+        Caches the answer of the question. `seconds` is what generating the answer
+        took (i.e. what each hit saves).
+        """
+        row = _normalize(vector)
+        with self._lock:
+            if self._vectors is None:
+                self._create_vectors(row.shape[0])
+            elif row.shape[0] != self.dim:
+                raise ValueError(f"Expected an embedding of {self.dim} dimensions, got {row.shape[0]}")
+            # the same question (e.g. cached by two concurrent misses) replaces its answer
+            scores = self._scores(row, scope)
+            if scores is not None and scores.max() >= max(self.threshold, 0.99):
+                slot = int(np.argmax(scores))
+            else:
+                slot = self._free_slot()
+            self._vectors[slot] = row
+            self._valid[slot] = True
+            self._expires_at[slot] = time.time() + self.ttl if self.ttl is not None else np.inf
+            self._last_used[slot] = time.time()
+            self._scopes[slot] = self._scope_id(scope)
+            self._entries[slot] = (question, answer, scope, seconds)
+            self._unsaved += 1
+            save = self.path is not None and self._unsaved >= self.save_every
+        if save:
+            self.save()
+
+    def _free_slot(self) -> int:
+        if self._size < self.max_entries:
+            self._size += 1
+            return self._size - 1
+        expired = np.flatnonzero(~self._valid | (self._expires_at <= time.time()))
+        if expired.size:
+            return int(expired[0])
+        # the least recently used answer
+        return int(np.argmin(self._last_used))
+
+    def save(self):
+        """Writes the questions and answers (and flushes the matrix) to the files of the cache"""
+        if self.path is None:
+            return
+        with self._lock:
+            if self._vectors is None:
+                return
+            self._vectors.flush()
+            entries = [
+                dict(
+                    slot=i, question=entry[0], answer=entry[1], scope=entry[2], seconds=entry[3],
+                    expires_at=None if np.isinf(self._expires_at[i]) else float(self._expires_at[i]),
+                    last_used=float(self._last_used[i]),
+                )
+                for i, entry in enumerate(self._entries[:self._size])
+                if entry is not None and self._valid[i]
+            ]
+            state = dict(dim=self.dim, max_entries=self.max_entries, size=self._size, entries=entries)
+            self._unsaved = 0
+        tmp_path = f"{self.path}.json.tmp"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(state, f)
+            os.replace(tmp_path, f"{self.path}.json")
+        except OSError as e:
+            logger.warning(f"Could not save the semantic cache: {e}")
+
+    def _load(self):
+        try:
+            with open(f"{self.path}.json", "r", encoding="utf-8") as f:
+                state = json.load(f)
+            vectors = np.load(f"{self.path}.npy", mmap_mode="r+")
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            logger.warning(f"Could not load the semantic cache, starting empty: {e}")
+            return
+        if vectors.shape != (self.max_entries, state["dim"]) or vectors.dtype != np.float32:
+            logger.warning(
+                f"The semantic cache in {self.path} has a different size {vectors.shape}, starting empty")
+            return
+        self._vectors = vectors
+        self._size = state["size"]
+        now = time.time()
+        for entry in state["entries"]:
+            i = entry["slot"]
+            expires_at = np.inf if entry["expires_at"] is None else entry["expires_at"]
+            if expires_at <= now:
+                continue
+            self._valid[i] = True
+            self._expires_at[i] = expires_at
+            self._last_used[i] = entry["last_used"]
+            self._scopes[i] = self._scope_id(entry["scope"])
+            self._entries[i] = (entry["question"], entry["answer"], entry["scope"], entry["seconds"])
+        logger.info(f"Loaded {int(self._valid.sum())} answers of the semantic cache")
+
+    def __len__(self) -> int:
+        with self._lock:
+            n = self._size
+            return int((self._valid[:n] & (self._expires_at[:n] > time.time())).sum())
+
+    def stats(self) -> dict:
+        entries = len(self)
+        with self._lock:
+            lookups = self.hits + self.misses
+            return dict(
+                entries=entries,
+                max_entries=self.max_entries,
+                hits=self.hits,
+                misses=self.misses,
+                hit_rate=self.hits / lookups if lookups else 0.0,
+                seconds_saved=round(self.seconds_saved, 3),
+                mean_lookup_ms=round(1000 * self.lookup_seconds / lookups, 3) if lookups else 0.0,
+            )
@@ -0,0 +1,142 @@
+"""
+Content-addressed cache of audio transcriptions.
+
+Transcriptions are keyed by the SHA-256 digest of the audio plus the language
+and model used, so forwarded voice notes and retried webhooks are only
+transcribed once. Recent entries are kept in an in-memory LRU and, if a
+directory is given, every entry is also written to disk, where the oldest
+files are removed once the directory grows over its maximum size.
+"""
+import hashlib
+import logging
+import os
+import threading
+from collections import OrderedDict
+from typing import Optional
+
+__all__ = [
+    "TranscriptionCache",
+]
+
+logger = logging.getLogger(__name__)
+
+
+class TranscriptionCache:
+    """
+    Two-tier (memory and disk) cache of transcriptions.
+
+    Parameters
+    ----------
+    max_memory_items : int, optional
+        Number of transcriptions kept in memory, by default 1024
+    directory : str, optional
+        Directory of the on-disk tier, by default there's no disk tier.
+    max_disk_bytes : int, optional
+        Maximum size of the on-disk tier, by default 100MB
+    """
+
+    def __init__(self, max_memory_items: int = 1024, directory: str = None, max_disk_bytes: int = 100 * 1024 * 1024):
+        self.max_memory_items = max_memory_items
+        self.directory = directory
+        self.max_disk_bytes = max_disk_bytes
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.bytes_saved = 0
+        self.disk_bytes = 0
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+            self.disk_bytes = sum(entry.stat().st_size for entry in os.scandir(directory) if entry.is_file())
+
+    @staticmethod
+    def make_key(audio_digest: str, language: str = None, model: str = None) -> str:
+        """Returns the key of the transcription of the audio with the given digest, language and model"""
+        return hashlib.sha256(f"{audio_digest}:{language or 'auto'}:{model or ''}".encode()).hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key + ".txt")
+
+    def get(self, key: str, audio_size: int = 0) -> Optional[str]:
+        """Returns the cached transcription (or None) and records the hit or miss"""
+        with self._lock:
+            text = self._memory.get(key)
+            if text is not None:
+                self._memory.move_to_end(key)
+        if text is None and self.directory is not None:
+            try:
+                with open(self._path(key), "r", encoding="utf-8") as f:
+                    text = f.read()
+                os.utime(self._path(key))  # keep recently used files from being evicted
+                self._remember(key, text)
+            except FileNotFoundError:
+                pass
+        with self._lock:
+            if text is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.bytes_saved += audio_size
+        return text
+
+    def put(self, key: str, text: str):
+        """Caches the transcription of the key"""
+        if text is None:
+            return
+        self._remember(key, text)
+        if self.directory is None:
+            return
+        data = text.encode("utf-8")
+        path = self._path(key)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        try:
+            with open(tmp_path, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logger.warning(f"Could not write transcription to the disk cache: {e}")
+            return
+        with self._lock:
+            self.disk_bytes += len(data)
+            over_limit = self.disk_bytes > self.max_disk_bytes
+        if over_limit:
+            self._evict_disk()
+
+    def _remember(self, key: str, text: str):
+        with self._lock:
+            self._memory[key] = text
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.max_memory_items:
+                self._memory.popitem(last=False)
+
+    def _evict_disk(self):
+        """Removes the least recently used files until the disk tier is under 90% of its maximum size"""
+        entries = sorted(
+            ((entry.stat(), entry.path) for entry in os.scandir(self.directory)
+             if entry.is_file() and entry.name.endswith(".txt")),
+            key=lambda e: e[0].st_mtime,
+        )
+        total = sum(stat.st_size for stat, _ in entries)
+        target = self.max_disk_bytes * 0.9
+        for stat, path in entries:
+            if total <= target:
+                break
+            try:
+                os.remove(path)
+                total -= stat.st_size
+            except FileNotFoundError:
+                pass
+        with self._lock:
+            self.disk_bytes = total
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return dict(
+                hits=self.hits,
+                misses=self.misses,
+                hit_rate=self.hits / lookups if lookups else 0.0,
+                bytes_saved=self.bytes_saved,
+                memory_items=len(self._memory),
+                disk_bytes=self.disk_bytes,
+            )
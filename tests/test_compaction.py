@@ -0,0 +1,171 @@
+import asyncio
+import json
+import threading
+import time
+
+import pytest
+
+from app.compaction import ConversationCompactor
+from app.whatsapp.chat import OpenAIChatManager, Sender
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.005)
+
+
+class Summarizer:
+    """Returns the summaries of the prompts, each of them after `release` is set"""
+
+    def __init__(self, fail: bool = False):
+        self.prompts = []
+        self.release = threading.Event()
+        self.fail = fail
+
+    async def __call__(self, messages):
+        self.prompts.append(messages)
+        while not self.release.is_set():
+            await asyncio.sleep(0.005)
+        if self.fail:
+            raise RuntimeError("completion failed")
+        return f" summary {len(self.prompts)} "
+
+
+@pytest.fixture
+def make_compactor():
+    compactors = []
+
+    def make(complete, **kwargs):
+        kwargs.setdefault("threshold_tokens", 100)
+        kwargs.setdefault("keep_tokens", 40)
+        kwargs.setdefault("keep_last", 2)
+        compactor = ConversationCompactor(complete, **kwargs)
+        compactors.append(compactor)
+        return compactor
+
+    yield make
+    for compactor in compactors:
+        compactor.stop(5)
+
+
+def make_chat(turns=6):
+    chat = OpenAIChatManager(Sender("+1", "Ana"), start_system_message="You are a helpful assistant")
+    for i in range(turns):
+        chat.add_message(f"Question {i} about the trip to Lisbon that we are planning together", role="user")
+        chat.add_message(f"Answer {i} with the hotels, the flights and the places worth visiting", role="assistant")
+    return chat
+
+
+def contents(messages):
+    return [msg["content"] for msg in messages]
+
+
+def test_oldest_messages_are_replaced_by_the_summary_on_the_next_turn(make_compactor):
+    summarize = Summarizer()
+    compactor = make_compactor(summarize)
+    chat = make_chat()
+    old = list(chat.messages)
+    span_length = len(chat.compaction_span(compactor.keep_tokens, keep_last=compactor.keep_last))
+    assert compactor.maybe_compact(chat)
+    wait_for(lambda: len(summarize.prompts) == 1)
+    # only one compaction of a chat at a time
+    assert not compactor.maybe_compact(chat)
+    # a turn in flight while the summary is generated
+    chat.add_message("What about the weather in May?", role="user")
+    assert chat.get_context_messages()[-1]["content"] == "What about the weather in May?"
+    summarize.release.set()
+    wait_for(lambda: chat._pending_summary is not None)
+    chat.add_message("Usually sunny and warm", role="assistant")
+
+    messages = chat.get_context_messages()
+    assert messages[0] == old[0]
+    assert messages[1] == {"role": "system", "content": OpenAIChatManager.SUMMARY_PREFIX + "summary 1"}
+    assert contents(messages[2:]) == contents(old[1 + span_length:]) + [
+        "What about the weather in May?", "Usually sunny and warm"]
+    assert chat.summary == "summary 1"
+    assert len(chat.message_tokens) == len(chat.messages)
+    assert chat.context_tokens == sum(chat.message_tokens)
+    # every message stays in the message info
+    assert chat.message_info[-1]["compacted_messages"] == span_length
+    assert len(chat.message_info) == 13 + 2 + 1
+    assert compactor.stats()["compacted"] == 1
+
+
+def test_the_summary_is_rolling(make_compactor):
+    summarize = Summarizer()
+    summarize.release.set()
+    compactor = make_compactor(summarize)
+    chat = make_chat()
+    compactor.maybe_compact(chat)
+    wait_for(lambda: chat._pending_summary is not None)
+    chat.get_context_messages()
+    for i in range(6, 12):
+        chat.add_message(f"Question {i} about the trip to Lisbon that we are planning together", role="user")
+        chat.add_message(f"Answer {i} with the hotels, the flights and the places worth visiting", role="assistant")
+    assert compactor.maybe_compact(chat)
+    wait_for(lambda: chat._pending_summary is not None)
+    prompt = summarize.prompts[1][1]["content"]
+    # the previous summary is updated with the messages after it, not summarized again
+    assert prompt.startswith("Current summary:\nsummary 1\n\nNew messages:\n")
+    assert "Question 0" not in prompt
+    chat.get_context_messages()
+    assert chat.messages[1]["content"] == OpenAIChatManager.SUMMARY_PREFIX + "summary 2"
+    assert chat.get_messages_from("system")[2:] == []
+
+
+def test_the_summary_is_applied_to_a_reloaded_conversation(make_compactor):
+    summarize = Summarizer()
+    compactor = make_compactor(summarize)
+    chat = make_chat()
+    compactor.maybe_compact(chat)
+    wait_for(lambda: len(summarize.prompts) == 1)
+    # another process saved the conversation meanwhile, so it's replaced by the stored one
+    chat.add_message("What about the weather in May?", role="user")
+    chat._merge_stored(json.loads(json.dumps(make_chat().to_dict())))
+    summarize.release.set()
+    wait_for(lambda: chat._pending_summary is not None)
+    messages = chat.get_context_messages()
+    assert chat.summary == "summary 1"
+    assert messages[1]["content"] == OpenAIChatManager.SUMMARY_PREFIX + "summary 1"
+    assert messages[-1]["content"] == "What about the weather in May?"
+
+
+def test_the_summary_of_a_restarted_conversation_is_dropped(make_compactor):
+    summarize = Summarizer()
+    compactor = make_compactor(summarize)
+    chat = make_chat()
+    compactor.maybe_compact(chat)
+    wait_for(lambda: len(summarize.prompts) == 1)
+    chat.restart_conversation()
+    chat.add_message("Hi again", role="user")
+    summarize.release.set()
+    wait_for(lambda: not chat._compacting)
+    assert contents(chat.get_context_messages()[1:]) == ["Hi again"]
+    assert chat.summary is None
+
+
+def test_failed_summaries_leave_the_conversation_as_it_is(make_compactor):
+    summarize = Summarizer(fail=True)
+    summarize.release.set()
+    compactor = make_compactor(summarize)
+    chat = make_chat()
+    old = list(chat.messages)
+    compactor.maybe_compact(chat)
+    wait_for(lambda: compactor.stats()["failed"] == 1 and not chat._compacting)
+    assert chat.get_context_messages() == old
+    # and it's tried again on the next turn
+    assert compactor.maybe_compact(chat)
+    wait_for(lambda: compactor.stats()["pending"] == 0)
+
+
+def test_short_conversations_and_full_compactors_are_not_compacted(make_compactor):
+    summarize = Summarizer()
+    compactor = make_compactor(summarize, max_pending=1)
+    assert not compactor.maybe_compact(make_chat(turns=1))
+    assert compactor.maybe_compact(make_chat())
+    assert not compactor.maybe_compact(make_chat())
+    assert compactor.stats()["rejected"] == 1
+    summarize.release.set()
+    wait_for(lambda: compactor.stats()["pending"] == 0)
@@ -0,0 +1,175 @@
+import json
+import os
+import time
+
+import pytest
+
+from app.whatsapp.contactbook import ContactBook
+from app.whatsapp.contacts import ContactAllowlist, normalize_phone_number
+
+
+def write_contacts(path, phone_numbers, mtime=None):
+    with open(path, "w") as f:
+        json.dump([dict(phone_number=number, name=f"Contact {number}") for number in phone_numbers], f)
+    if mtime is not None:
+        os.utime(path, (mtime, mtime))
+
+
+def test_phone_numbers_are_normalized():
+    assert normalize_phone_number("whatsapp:+351 912-345 (678)") == "+351912345678"
+    assert normalize_phone_number(" WhatsApp:+1.555.0100 ") == "+15550100"
+
+
+def test_only_contacts_of_the_file_are_allowed(tmp_path):
+    path = tmp_path / "contacts.json"
+    write_contacts(path, ["+351 912 345 678", "+15550100"])
+    allowlist = ContactAllowlist(str(path))
+    assert allowlist.enabled
+    assert allowlist.lookup("whatsapp:+351912345678")["name"] == "Contact +351 912 345 678"
+    assert "whatsapp:+15550100" in allowlist
+    assert allowlist.lookup("whatsapp:+15550101") is None
+    assert len(allowlist) == 2
+    # without a file every number is allowed
+    assert ContactAllowlist().is_allowed("whatsapp:+15550101")
+
+
+def test_the_file_is_reloaded_when_it_changes(tmp_path):
+    path = tmp_path / "contacts.json"
+    write_contacts(path, ["+15550100"], mtime=1000)
+    allowlist = ContactAllowlist(str(path), check_interval=0)
+    assert "+15550101" not in allowlist
+    assert allowlist.reloads == 1
+    # unchanged files aren't read again
+    assert "+15550100" in allowlist
+    assert allowlist.reloads == 1
+    # another modification time
+    write_contacts(path, ["+15550101"], mtime=2000)
+    assert "+15550101" in allowlist
+    assert "+15550100" not in allowlist
+    assert allowlist.reloads == 2
+    # the same modification time (e.g. its resolution is too coarse) but another size
+    write_contacts(path, ["+15550101", "+15550102"], mtime=2000)
+    assert "+15550102" in allowlist
+    assert allowlist.reloads == 3
+
+
+def test_the_file_is_checked_at_most_once_per_interval(tmp_path):
+    path = tmp_path / "contacts.json"
+    write_contacts(path, ["+15550100"], mtime=1000)
+    allowlist = ContactAllowlist(str(path), check_interval=60)
+    assert "+15550100" in allowlist
+    write_contacts(path, ["+15550101"], mtime=2000)
+    assert "+15550101" not in allowlist
+    allowlist._next_check = 0
+    assert "+15550101" in allowlist
+
+
+def test_the_contacts_are_kept_if_the_file_is_broken(tmp_path):
+    path = tmp_path / "contacts.json"
+    write_contacts(path, ["+15550100"], mtime=1000)
+    allowlist = ContactAllowlist(str(path), check_interval=0)
+    assert "+15550100" in allowlist
+    # e.g. while it's being written
+    path.write_text('[{"phone_number": "+1555')
+    assert "+15550100" in allowlist
+    os.remove(path)
+    assert "+15550100" in allowlist
+    write_contacts(path, ["+15550101"], mtime=3000)
+    assert "+15550101" in allowlist
+
+
+@pytest.fixture
+def make_book(tmp_path):
+    books = []
+
+    def make(**kwargs):
+        kwargs.setdefault("flush_interval", 60)
+        book = ContactBook(str(tmp_path / "contactbook.json"), **kwargs)
+        books.append(book)
+        return book
+
+    yield make
+    for book in books:
+        book.close()
+
+
+def read_journal(book):
+    with open(book.journal_path) as f:
+        return [json.loads(line) for line in f]
+
+
+def test_updates_are_flushed_to_the_journal_in_batches(make_book):
+    book = make_book()
+    book.update("+1", "Ana")
+    book.update("+2", "Rui")
+    book.update("+1", "Ana Silva")
+    assert book.get("+1")["name"] == "Ana Silva"
+    assert not os.path.exists(book.journal_path)
+    book.flush()
+    # the updates of the same contact are coalesced
+    assert [(entry["phone_number"], entry["name"]) for entry in read_journal(book)] == [
+        ("+1", "Ana Silva"), ("+2", "Rui")]
+    book.flush()
+    assert book.flushes == 1
+
+
+def test_the_journal_is_replayed_over_the_snapshot(make_book):
+    book = make_book()
+    book.update("+1", "Ana")
+    book.update("+2", "Rui")
+    book.flush()
+    book.compact()
+    book.update("+2", "Rui Costa")
+    book.update("+3", "Eva")
+    book.close()
+    with open(book.path) as f:
+        assert set(json.load(f)) == {"+1", "+2"}
+    assert len(read_journal(book)) == 2
+
+    loaded = make_book()
+    assert len(loaded) == 3
+    assert loaded.get("+1")["name"] == "Ana"
+    assert loaded.get("+2")["name"] == "Rui Costa"
+    assert loaded.get("+3")["name"] == "Eva"
+
+
+def test_a_line_cut_by_a_crash_is_skipped_and_compacted(make_book):
+    book = make_book()
+    book.update("+1", "Ana")
+    book.close()
+    with open(book.journal_path, "a") as f:
+        f.write('{"phone_number": "+2", "na')
+    loaded = make_book()
+    assert len(loaded) == 1
+    # the journal was compacted into the snapshot, so new lines aren't appended after the cut one
+    assert loaded.compactions == 1
+    assert os.path.getsize(loaded.journal_path) == 0
+    loaded.update("+3", "Eva")
+    loaded.flush()
+    assert [entry["phone_number"] for entry in read_journal(loaded)] == ["+3"]
+    loaded.close()
+    assert set(make_book()._contacts) == {"+1", "+3"}
+
+
+def test_the_journal_is_compacted_when_it_outgrows_the_book(make_book):
+    book = make_book(min_compaction_entries=3)
+    for name in ("Ana", "Ana S.", "Ana Silva"):
+        book.update("+1", name)
+        book.flush()
+    assert book.compactions == 0
+    book.update("+1", "Ana M. Silva")
+    book.flush()
+    assert book.compactions == 1
+    assert os.path.getsize(book.journal_path) == 0
+    with open(book.path) as f:
+        assert json.load(f)["+1"]["name"] == "Ana M. Silva"
+
+
+def test_pending_updates_are_flushed_in_the_background(make_book):
+    book = make_book(flush_interval=0.01)
+    book.update("+1", "Ana")
+    deadline = time.monotonic() + 5
+    while book.flushes == 0:
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.005)
+    assert [entry["phone_number"] for entry in read_journal(book)] == ["+1"]
@@ -0,0 +1,134 @@
+import asyncio
+import threading
+import time
+from types import SimpleNamespace
+
+import pytest
+
+from app.image_jobs import ACCEPTED, QUEUE_FULL, QUOTA_EXCEEDED, ImageJob, ImageJobService
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.005)
+
+
+class Generator:
+    """Generates the images of the prompts, each of them after `release` is set"""
+
+    def __init__(self, fail: bool = False):
+        self.prompts = []
+        self.release = threading.Event()
+        self.fail = fail
+
+    async def __call__(self, prompt):
+        self.prompts.append(prompt)
+        while not self.release.is_set():
+            await asyncio.sleep(0.005)
+        if self.fail:
+            raise RuntimeError("generation failed")
+        return f"https://images/{len(self.prompts)}.png"
+
+
+@pytest.fixture
+def make_service():
+    services = []
+
+    def make(generate, **kwargs):
+        service = ImageJobService(generate, **kwargs).start()
+        services.append(service)
+        return service
+
+    yield make
+    for service in services:
+        service.stop(5)
+
+
+def job(prompt, sender, delivered, on_failure=None):
+    async def deliver(url):
+        delivered.append((sender, prompt, url))
+    return ImageJob(prompt, sender, deliver, on_failure=on_failure)
+
+
+def test_senders_are_served_in_round_robin(make_service):
+    generate = Generator()
+    service = make_service(generate, max_concurrency=1)
+    delivered = []
+    service.submit(job("a1", "a", delivered))
+    # the only worker is busy with a1 while the rest is queued
+    wait_for(lambda: generate.prompts == ["a1"])
+    for prompt, sender in [("a2", "a"), ("a3", "a"), ("b1", "b"), ("b2", "b")]:
+        assert service.submit(job(prompt, sender, delivered)) == ACCEPTED
+    generate.release.set()
+    wait_for(lambda: len(delivered) == 5)
+    assert [prompt for _, prompt, _ in delivered] == ["a1", "a2", "b1", "a3", "b2"]
+
+
+def test_identical_prompts_are_generated_once(make_service):
+    generate = Generator()
+    service = make_service(generate, max_concurrency=2)
+    delivered = []
+    # the second one waits for the generation in flight
+    service.submit(job("A cat.", "a", delivered))
+    service.submit(job("a   cat", "b", delivered))
+    wait_for(lambda: service.stats()["in_flight"] == 1 and service.stats()["queue_depth"] == 0)
+    generate.release.set()
+    wait_for(lambda: len(delivered) == 2)
+    # and later ones reuse the cached url
+    service.submit(job("a cat!", "c", delivered))
+    wait_for(lambda: len(delivered) == 3)
+    assert generate.prompts == ["A cat."]
+    assert {url for _, _, url in delivered} == {"https://images/1.png"}
+    assert service.stats()["cache_hits"] == 2
+
+
+def test_quota_is_checked_and_charged_atomically(make_service):
+    generate = Generator()
+    service = make_service(generate, max_concurrency=1)
+    chat = SimpleNamespace(num_images_generated=0, max_image_generations=5)
+    results = []
+    lock = threading.Lock()
+
+    def submit(i):
+        status = service.submit(job(f"prompt {i}", "a", []), chat=chat)
+        with lock:
+            results.append(status)
+
+    threads = [threading.Thread(target=submit, args=(i,)) for i in range(20)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert results.count(ACCEPTED) == 5
+    assert results.count(QUOTA_EXCEEDED) == 15
+    assert chat.num_images_generated == 5
+    generate.release.set()
+
+
+def test_quota_is_refunded_when_the_image_fails(make_service):
+    generate = Generator(fail=True)
+    generate.release.set()
+    service = make_service(generate)
+    chat = SimpleNamespace(num_images_generated=0, max_image_generations=1)
+    failures = []
+    assert service.submit(job("a cat", "a", [], on_failure=failures.append), chat=chat) == ACCEPTED
+    wait_for(lambda: failures)
+    assert isinstance(failures[0], RuntimeError)
+    assert chat.num_images_generated == 0
+    assert service.stats()["failed"] == 1
+    # the image can be asked for again
+    assert service.submit(job("a dog", "a", []), chat=chat) == ACCEPTED
+
+
+def test_jobs_are_rejected_when_the_queue_is_full(make_service):
+    generate = Generator()
+    service = make_service(generate, max_concurrency=1, max_queue_size=2)
+    service.submit(job("first", "a", []))
+    wait_for(lambda: generate.prompts == ["first"])
+    assert service.submit(job("second", "a", [])) == ACCEPTED
+    assert service.submit(job("third", "b", [])) == ACCEPTED
+    assert service.submit(job("fourth", "c", [])) == QUEUE_FULL
+    assert service.stats()["rejected"] == 1
+    generate.release.set()
@@ -0,0 +1,50 @@
+import pytest
+
+from chat.handlers.langid import identify_language
+
+MIN_CONFIDENCE = 0.8  # default of app.handlers.detect_language
+
+
+@pytest.mark.parametrize("text, language", [
+    ("Can you send me the invoice for last month? I think there was a mistake in the amount", "english"),
+    ("¿Puedes enviarme la factura del mes pasado? Creo que hubo un error en el importe", "spanish"),
+    ("Kannst du mir die Rechnung vom letzten Monat schicken? Ich glaube der Betrag ist falsch", "german"),
+    ("Peux-tu m'envoyer la facture du mois dernier ? Je pense qu'il y a une erreur dans le montant", "french"),
+    ("Puoi mandarmi la fattura del mese scorso? Penso che ci sia un errore nell'importo", "italian"),
+    ("Você pode me enviar a fatura do mês passado? Acho que houve um erro no valor", "portuguese"),
+    ("Kun je me de factuur van vorige maand sturen? Ik denk dat er een fout in het bedrag zit", "dutch"),
+])
+def test_supported_languages_are_identified(text, language):
+    assert identify_language(text) == (language, pytest.approx(1.0, abs=0.05))
+
+
+@pytest.mark.parametrize("text", [
+    "Czy możesz wysłać mi fakturę za zeszły miesiąc? Myślę, że kwota jest błędna",  # polish
+    "Poți să-mi trimiți factura de luna trecută? Cred că suma este greșită",  # romanian
+    "Geçen ayın faturasını bana gönderebilir misin? Bence tutar yanlış",  # turkish
+    "Em pots enviar la factura del mes passat? Crec que hi ha un error en l'import",  # catalan
+    "Bisakah kamu mengirimkan faktur bulan lalu? Saya rasa jumlahnya salah",  # indonesian
+    "Kan du sende mig fakturaen for sidste måned? Jeg tror beløbet er forkert",  # danish
+])
+def test_unsupported_languages_have_low_confidence(text):
+    _, confidence = identify_language(text)
+    assert confidence < MIN_CONFIDENCE
+
+
+def test_short_texts_have_low_confidence():
+    assert identify_language("hola")[1] < MIN_CONFIDENCE
+    assert identify_language("1234 !!")[1] == 0.0
+
+
+def test_unsupported_language_falls_back_to_the_language_model(monkeypatch):
+    import asyncio
+    from app import handlers
+
+    async def language_detection(text, examples=None):
+        return "polish"
+
+    monkeypatch.setattr(handlers, "alanguage_detection", language_detection)
+    monkeypatch.setattr(handlers, "_sender_languages", handlers.OrderedDict())
+    text = "Czy możesz wysłać mi fakturę za zeszły miesiąc? Myślę, że kwota jest błędna"
+    assert asyncio.run(handlers.detect_language(text, sender="+48123")) == "polish"
+    assert handlers._sender_languages["+48123"] == "polish"
@@ -0,0 +1,46 @@
+import logging
+import queue
+import threading
+
+from app.logutils import LazyQueueHandler, SamplingFilter, lazy
+
+
+def make_logger(name, sample_rates=None, max_chars=None):
+    records = queue.SimpleQueue()
+    handler = LazyQueueHandler(records, max_chars=max_chars)
+    handler.addFilter(SamplingFilter(sample_rates))
+    logger = logging.getLogger(name)
+    logger.handlers = [handler]
+    logger.propagate = False
+    logger.setLevel(logging.INFO)
+    return logger, records
+
+
+def test_arguments_are_rendered_when_logged():
+    logger, records = make_logger("test_logutils.render")
+    messages = [{"role": "user", "content": "hello"}]
+    logger.info("Conversation: %s", messages)
+    # the chat changes right after logging, before the listener formats the record
+    messages.append({"role": "assistant", "content": "hi"})
+    messages[0]["content"] = "changed"
+    record = records.get_nowait()
+    assert record.args is None
+    assert record.getMessage() == "Conversation: [{'role': 'user', 'content': 'hello'}]"
+
+
+def test_lazy_arguments_are_only_called_for_kept_records_on_the_calling_thread():
+    logger, records = make_logger("test_logutils.lazy", sample_rates={"sampled": 0.0})
+    threads = []
+    get_thread = lazy(lambda: threads.append(threading.current_thread()) or "value")
+    logger.debug("below the level %s", get_thread)
+    logger.info("sampled out %s", get_thread, extra={"event": "sampled"})
+    assert threads == [] and records.empty()
+    logger.info("kept %s", get_thread)
+    assert threads == [threading.current_thread()]
+    assert records.get_nowait().getMessage() == "kept value"
+
+
+def test_messages_are_truncated_before_they_are_queued():
+    logger, records = make_logger("test_logutils.truncate", max_chars=10)
+    logger.info("Conversation: %s", lazy(lambda: "x" * 1000))
+    assert records.get_nowait().msg == "Conversati... [1004 more characters]"
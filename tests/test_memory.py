@@ -0,0 +1,140 @@
+import os
+
+import numpy as np
+import pytest
+
+from app.memory import MemoryStore
+
+DIM = 4
+
+# the embedding of every text of the tests, other texts get a random one
+VECTORS = {
+    "My daughter is called Ana": [1, 0, 0, 0],
+    "Ana starts school next week": [0.9, 0.1, 0, 0],
+    "I live in Lisbon since 2019": [0, 1, 0, 0],
+    "The weather is nice today": [0, 0, 1, 0],
+    "I work as a nurse at night": [0, 0, 0, 1],
+}
+
+
+async def embed(texts):
+    rng = np.random.default_rng(len(texts))
+    return [VECTORS.get(text, rng.normal(size=DIM)) for text in texts]
+
+
+@pytest.fixture
+def make_store(tmp_path):
+    stores = []
+
+    def make(**kwargs):
+        kwargs.setdefault("num_shards", 2)
+        kwargs.setdefault("flush_interval", 60)
+        store = MemoryStore(str(tmp_path / "memory"), embed, **kwargs)
+        stores.append(store)
+        return store
+
+    yield make
+    for store in stores:
+        store.stop(5)
+
+
+def remember(store, sender, *texts, role="user"):
+    store.remember(sender, [dict(role=role, content=text) for text in texts])
+    store.background.submit(store.flush()).result(5)
+
+
+def contents(results):
+    return [snippet["content"] for _, snippet in results]
+
+
+def test_remembered_snippets_are_found_by_similarity(make_store):
+    store = make_store()
+    remember(store, "+1", "My daughter is called Ana", "I live in Lisbon since 2019", "The weather is nice today")
+    remember(store, "+2", "Ana starts school next week")
+    results = store.search("+1", [1, 0.05, 0, 0], k=2)
+    assert contents(results) == ["My daughter is called Ana", "I live in Lisbon since 2019"]
+    assert results[0][0] == pytest.approx(1, abs=0.01)
+    # only the snippets of the sender are searched
+    assert contents(store.search("+2", [0, 1, 0, 0], k=3)) == ["Ana starts school next week"]
+    assert store.search("+3", [1, 0, 0, 0]) == []
+    assert contents(store.search("+1", [1, 0, 0, 0], k=3, min_similarity=0.5)) == ["My daughter is called Ana"]
+    # short and non user/assistant messages aren't remembered
+    assert store.remember("+1", [dict(role="user", content="ok thanks"), dict(role="system", content="x" * 50)]) == 0
+    assert store.stats()["snippets"] == 4
+
+
+def test_snippets_are_loaded_again(make_store):
+    store = make_store()
+    remember(store, "+1", "My daughter is called Ana", "I live in Lisbon since 2019")
+    store.stop(5)
+    store = make_store(num_shards=8)
+    # the number of shards of the files wins, or the senders would be looked up elsewhere
+    assert store.num_shards == 2
+    assert len(store) == 2
+    assert contents(store.search("+1", [0, 1, 0, 0], k=1)) == ["I live in Lisbon since 2019"]
+
+
+def test_rows_half_written_by_a_crash_are_dropped(make_store):
+    store = make_store(num_shards=1)
+    remember(store, "+1", "My daughter is called Ana", "I live in Lisbon since 2019")
+    store.stop(5)
+    vectors_path = os.path.join(store.directory, "shard-000.f32")
+    snippets_path = os.path.join(store.directory, "shard-000.jsonl")
+    sizes = os.path.getsize(vectors_path), os.path.getsize(snippets_path)
+    # a crash while appending a third row, in the middle of its vector
+    with open(vectors_path, "ab") as f:
+        f.write(np.ones(DIM, dtype=np.float32).tobytes()[:7])
+    with open(snippets_path, "a") as f:
+        f.write('{"sender": "+1", "role": "user", "content": "I work as')
+    store = make_store(num_shards=1)
+    assert len(store) == 2
+    assert (os.path.getsize(vectors_path), os.path.getsize(snippets_path)) == sizes
+    # the next rows are appended aligned with the old ones
+    remember(store, "+1", "I work as a nurse at night")
+    assert contents(store.search("+1", [0, 0, 0, 1], k=1)) == ["I work as a nurse at night"]
+    assert contents(store.search("+1", [1, 0, 0, 0], k=1)) == ["My daughter is called Ana"]
+    assert os.path.getsize(vectors_path) == 3 * DIM * 4
+
+
+def test_snippets_without_vectors_are_dropped(make_store):
+    store = make_store(num_shards=1)
+    remember(store, "+1", "My daughter is called Ana", "I live in Lisbon since 2019")
+    store.stop(5)
+    vectors_path = os.path.join(store.directory, "shard-000.f32")
+    os.truncate(vectors_path, DIM * 4 + 3)
+    store = make_store(num_shards=1)
+    assert contents(store.search("+1", [1, 1, 0, 0], k=3)) == ["My daughter is called Ana"]
+    assert os.path.getsize(vectors_path) == DIM * 4
+
+
+def test_the_vectors_are_remapped_when_the_file_grows(make_store):
+    store = make_store(num_shards=1)
+    remember(store, "+1", "My daughter is called Ana")
+    assert contents(store.search("+1", [0, 0, 0, 1], k=1)) == ["My daughter is called Ana"]
+    shard = store._shards[0]
+    assert shard._mapped_rows == 1
+    remember(store, "+1", "I work as a nurse at night", "I live in Lisbon since 2019")
+    assert contents(store.search("+1", [0, 0, 0, 1], k=1)) == ["I work as a nurse at night"]
+    assert shard._mapped_rows == 3
+    # searches that only need mapped rows don't remap
+    mapped = shard._map
+    remember(store, "+2", "The weather is nice today")
+    store.search("+1", [1, 0, 0, 0])
+    assert shard._map is mapped
+
+
+def test_excluded_and_repeated_snippets_are_skipped(make_store):
+    store = make_store()
+    remember(store, "+1", "My daughter is called Ana", "Ana starts school next week", "I live in Lisbon since 2019")
+    # the same message remembered again, e.g. from another conversation
+    remember(store, "+1", "My daughter is called Ana")
+    assert contents(store.search("+1", [1, 0, 0, 0], k=3)) == [
+        "My daughter is called Ana", "Ana starts school next week", "I live in Lisbon since 2019",
+    ]
+    # e.g. the messages already in the prompt
+    exclude = {"My daughter is called Ana"}
+    assert contents(store.search("+1", [1, 0, 0, 0], k=2, exclude=exclude)) == [
+        "Ana starts school next week", "I live in Lisbon since 2019",
+    ]
+    assert exclude == {"My daughter is called Ana"}
+    assert store.search("+1", [1, 0, 0, 0], k=1, exclude=set(VECTORS)) == []
@@ -0,0 +1,95 @@
+import asyncio
+import threading
+
+import openai
+import pytest
+
+from chat.handlers.openai import moderation
+from chat.handlers.openai.moderation import ModerationBatcher
+
+
+class ModerationAPI:
+    """Stands in for `openai.Moderation.acreate`, flagging the texts with "hurt" """
+
+    def __init__(self, error: Exception = None):
+        self.requests = []
+        self.error = error
+
+    async def acreate(self, input, model):
+        self.requests.append(list(input))
+        await asyncio.sleep(0.01)
+        if self.error is not None:
+            raise self.error
+        return dict(results=[dict(flagged="hurt" in text, text=text) for text in input])
+
+
+@pytest.fixture
+def api(monkeypatch):
+    api = ModerationAPI()
+    monkeypatch.setattr(openai.Moderation, "acreate", api.acreate)
+    monkeypatch.setattr(moderation, "use_session", lambda: None)
+    return api
+
+
+def test_concurrent_texts_are_moderated_in_one_request(api):
+    moderator = ModerationBatcher(model="test-moderation-batch", max_delay=0.05)
+
+    async def main():
+        return await asyncio.gather(
+            moderator.moderate("Hello there"),
+            moderator.moderate("I want to hurt them", return_flagged=True),
+            moderator.moderate("Hello there", return_flagged=True),
+        )
+
+    first, second, third = asyncio.run(main())
+    # identical texts are only sent once
+    assert api.requests == [["Hello there", "I want to hurt them"]]
+    assert first == dict(flagged=False, text="Hello there")
+    assert (second, third) == (True, False)
+    assert moderator.stats() == dict(batches=1, items=3, mean_batch_size=3.0)
+
+
+def test_texts_of_other_event_loops_share_the_batch(api):
+    moderator = ModerationBatcher(model="test-moderation-loops", max_delay=0.2)
+    texts = [f"Message {i} of another thread" for i in range(4)] + ["I want to hurt them"]
+    results = {}
+    ready = threading.Barrier(len(texts))
+
+    def worker(text):
+        # every thread runs its own event loop, like the workers of the app
+        ready.wait()
+        results[text] = asyncio.run(moderator.moderate(text, return_flagged=True))
+
+    threads = [threading.Thread(target=worker, args=(text,)) for text in texts]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(5)
+    assert len(api.requests) == 1
+    assert sorted(api.requests[0]) == sorted(texts)
+    assert results == {text: "hurt" in text for text in texts}
+
+
+def test_full_batches_are_sent_without_waiting(api):
+    moderator = ModerationBatcher(model="test-moderation-full", max_batch_size=2, max_delay=10)
+
+    async def main():
+        return await asyncio.wait_for(asyncio.gather(*(
+            moderator.moderate(f"Text {i}", return_flagged=True) for i in range(4)
+        )), 2)
+
+    assert asyncio.run(main()) == [False] * 4
+    assert api.requests == [["Text 0", "Text 1"], ["Text 2", "Text 3"]]
+
+
+def test_errors_are_raised_to_every_caller(api):
+    api.error = openai.error.InvalidRequestError("Invalid input", None)
+    moderator = ModerationBatcher(model="test-moderation-error", max_delay=0.05)
+
+    async def main():
+        return await asyncio.gather(
+            moderator.moderate("Hello"), moderator.moderate("Bye"), return_exceptions=True)
+
+    results = asyncio.run(main())
+    assert [type(result) for result in results] == [openai.error.InvalidRequestError] * 2
+    assert moderator.stats()["batches"] == 0
@@ -0,0 +1,22 @@
+from app.routing import ModelRouter
+from chat.handlers.openai.tokens import context_window
+
+MODEL = "gpt-3.5-turbo"
+
+
+def test_short_messages_get_full_replies_by_default():
+    decision = ModelRouter(max_tokens=1000).route(MODEL, prompt_tokens=200, message_tokens=4)
+    assert (decision.max_tokens, decision.reason) == (1000, "primary")
+
+
+def test_short_message_cap_is_opt_in():
+    router = ModelRouter(max_tokens=1000, short_message_tokens=12, short_max_tokens=300)
+    decision = router.route(MODEL, prompt_tokens=200, message_tokens=4)
+    assert (decision.max_tokens, decision.reason) == (300, "short_message")
+    assert router.route(MODEL, prompt_tokens=200, message_tokens=40).max_tokens == 1000
+
+
+def test_replies_are_capped_by_the_room_left_in_the_context():
+    prompt_tokens = context_window(MODEL) - 150
+    decision = ModelRouter(max_tokens=1000).route(MODEL, prompt_tokens=prompt_tokens, message_tokens=4)
+    assert decision.max_tokens == 150
@@ -0,0 +1,156 @@
+import json
+import time
+
+import numpy as np
+import pytest
+
+from chat.handlers import semantic_cache
+from chat.handlers.semantic_cache import SemanticCache
+
+
+class Clock:
+    """Stands in for the time module of the cache so entries can expire without waiting"""
+
+    def __init__(self):
+        self.now = time.time()
+
+    def time(self):
+        return self.now
+
+    def perf_counter(self):
+        return time.perf_counter()
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(semantic_cache, "time", clock)
+    return clock
+
+
+def similar(vector, similarity):
+    """Returns a vector with the given cosine similarity to the (unit, axis-aligned) vector"""
+    vector = np.asarray(vector, dtype=np.float32)
+    other = np.roll(vector, 1)
+    return similarity * vector + np.sqrt(1 - similarity ** 2) * other
+
+
+def test_answers_are_reused_above_the_threshold():
+    cache = SemanticCache(threshold=0.9)
+    assert cache.get([1, 0, 0]) is None
+    cache.put([2, 0, 0], "What time is it?", "It's late", seconds=1.5)
+    answer, similarity = cache.get(similar([1, 0, 0], 0.95))
+    assert answer == "It's late"
+    assert similarity == pytest.approx(0.95, abs=1e-4)
+    assert cache.get(similar([1, 0, 0], 0.85)) is None
+    assert cache.get([0, 1, 0]) is None
+    stats = cache.stats()
+    assert (stats["hits"], stats["misses"], stats["seconds_saved"]) == (1, 3, 1.5)
+    assert stats["hit_rate"] == 0.25
+
+
+def test_the_same_question_replaces_its_answer():
+    cache = SemanticCache(threshold=0.9)
+    cache.put([1, 0, 0], "What time is it?", "It's late")
+    cache.put([1, 0, 0], "What time is it?", "It's early")
+    assert len(cache) == 1
+    assert cache.get([1, 0, 0])[0] == "It's early"
+    with pytest.raises(ValueError):
+        cache.put([1, 0], "Hi", "Hello")
+
+
+def test_answers_are_only_reused_in_their_scope():
+    cache = SemanticCache(threshold=0.9)
+    cache.put([1, 0, 0], "Who are you?", "A bot", scope="en")
+    cache.put([1, 0, 0], "Who are you?", "Um bot", scope="pt")
+    assert len(cache) == 2
+    assert cache.get([1, 0, 0], scope="en")[0] == "A bot"
+    assert cache.get([1, 0, 0], scope="pt")[0] == "Um bot"
+    assert cache.get([1, 0, 0], scope="es") is None
+    assert cache.get([1, 0, 0]) is None
+    assert [answer for _, _, answer in cache.search([1, 0, 0], k=5, scope="pt")] == ["Um bot"]
+
+
+def test_answers_expire(clock):
+    cache = SemanticCache(threshold=0.9, ttl=60)
+    cache.put([1, 0, 0], "What time is it?", "It's late")
+    clock.now += 59
+    assert cache.get([1, 0, 0]) is not None
+    clock.now += 2
+    assert cache.get([1, 0, 0]) is None
+    assert len(cache) == 0
+
+
+def test_the_least_recently_used_answer_is_replaced(clock):
+    cache = SemanticCache(threshold=0.9, max_entries=2)
+    cache.put([1, 0, 0], "a", "A")
+    clock.now += 1
+    cache.put([0, 1, 0], "b", "B")
+    clock.now += 1
+    # "a" is used after "b"
+    assert cache.get([1, 0, 0])[0] == "A"
+    clock.now += 1
+    cache.put([0, 0, 1], "c", "C")
+    assert cache.get([0, 1, 0]) is None
+    assert cache.get([1, 0, 0])[0] == "A"
+    assert cache.get([0, 0, 1])[0] == "C"
+    assert len(cache) == 2
+
+
+def test_expired_answers_are_replaced_before_the_least_recently_used(clock):
+    cache = SemanticCache(threshold=0.9, max_entries=2, ttl=60)
+    cache.put([1, 0, 0], "a", "A")
+    clock.now += 10
+    cache.put([0, 1, 0], "b", "B")
+    clock.now += 10
+    assert cache.get([1, 0, 0])[0] == "A"
+    clock.now += 45
+    # "a" expired, although "b" was used less recently
+    cache.put([0, 0, 1], "c", "C")
+    assert cache.get([0, 1, 0])[0] == "B"
+    assert cache.get([0, 0, 1])[0] == "C"
+
+
+def test_answers_survive_a_restart(tmp_path, clock):
+    path = str(tmp_path / "cache" / "answers")
+    cache = SemanticCache(threshold=0.9, max_entries=4, ttl=60, path=path, save_every=100)
+    cache.put([1, 0, 0], "Who are you?", "A bot", scope="en", seconds=2)
+    cache.put([0, 1, 0], "Quem és tu?", "Um bot", scope="pt")
+    clock.now += 30
+    cache.put([0, 0, 1], "What time is it?", "It's late", scope="en")
+    # only the matrix is written until the metadata is saved
+    assert not (tmp_path / "cache" / "answers.json").exists()
+    cache.save()
+    state = json.loads((tmp_path / "cache" / "answers.json").read_text())
+    assert (state["dim"], state["max_entries"], state["size"]) == (3, 4, 3)
+    assert np.load(f"{path}.npy", mmap_mode="r").shape == (4, 3)
+
+    clock.now += 40
+    loaded = SemanticCache(threshold=0.9, max_entries=4, ttl=60, path=path)
+    # the first two answers expired while the cache was down
+    assert len(loaded) == 1
+    assert loaded.get([1, 0, 0], scope="en") is None
+    assert loaded.get([0, 0, 1], scope="en")[0] == "It's late"
+    assert loaded.get([0, 0, 1], scope="pt") is None
+    # the rows keep being used after the ones loaded
+    loaded.put([0.6, 0.8, 0], "Hello", "Hi", scope="en")
+    assert loaded._size == 4
+    assert loaded.get([0.6, 0.8, 0], scope="en")[0] == "Hi"
+
+
+def test_metadata_is_saved_every_few_answers(tmp_path):
+    path = str(tmp_path / "answers")
+    cache = SemanticCache(threshold=0.9, max_entries=4, path=path, save_every=2)
+    cache.put([1, 0, 0], "a", "A")
+    assert not (tmp_path / "answers.json").exists()
+    cache.put([0, 1, 0], "b", "B")
+    assert len(json.loads((tmp_path / "answers.json").read_text())["entries"]) == 2
+
+
+def test_a_cache_of_another_size_starts_empty(tmp_path):
+    path = str(tmp_path / "answers")
+    cache = SemanticCache(max_entries=4, path=path)
+    cache.put([1, 0, 0], "a", "A")
+    cache.save()
+    assert len(SemanticCache(max_entries=8, path=path)) == 0
+    assert len(SemanticCache(max_entries=4, path=path)) == 1
@@ -0,0 +1,284 @@
+import json
+import time
+
+import pytest
+
+from app.whatsapp.sessions import (
+    InMemorySessionStore,
+    RedisSessionStore,
+    SessionConflictError,
+    SQLiteSessionStore,
+    decode_session,
+    encode_session,
+)
+
+
+class Session:
+    def __init__(self, messages=None):
+        self.messages = messages or []
+
+    def to_dict(self):
+        return dict(messages=self.messages, message_info=[])
+
+    @classmethod
+    def from_dict(cls, state):
+        return cls(state["messages"])
+
+
+def user(content):
+    return {"role": "user", "content": content}
+
+
+@pytest.fixture
+def stores(tmp_path):
+    """Two stores on the same database, like two processes of the app"""
+    path = str(tmp_path / "sessions.db")
+    return SQLiteSessionStore(path, Session), SQLiteSessionStore(path, Session)
+
+
+def test_cached_session_is_reloaded_after_another_process_saves_it(stores):
+    a, b = stores
+    a.save("+1", Session([user("hi")]))
+    assert b.get("+1").messages == [user("hi")]  # now cached in b
+    session = a.get("+1")
+    session.messages.append(user("second turn"))
+    a.save("+1", session)
+    assert b.get("+1").messages == [user("hi"), user("second turn")]
+
+
+def test_saving_a_stale_session_raises_instead_of_overwriting(stores):
+    a, b = stores
+    a.save("+1", Session([user("hi")]))
+    stale = b.get("+1")
+    fresh = a.get("+1")
+    fresh.messages.append(user("from a"))
+    a.save("+1", fresh)
+    stale.messages.append(user("from b"))
+    with pytest.raises(SessionConflictError):
+        b.save("+1", stale)
+    assert b.get("+1").messages == [user("hi"), user("from a")]
+
+
+def test_deleted_session_can_be_saved_again(stores):
+    a, _ = stores
+    session = Session([user("hi")])
+    a.save("+1", session)
+    a.delete("+1")
+    a.save("+1", session)
+    assert a.get("+1").messages == [user("hi")]
+
+
+def test_databases_without_versions_are_migrated(tmp_path):
+    import sqlite3
+
+    path = str(tmp_path / "old.db")
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE TABLE sessions (key TEXT PRIMARY KEY, data BLOB NOT NULL, updated_at REAL NOT NULL)")
+    conn.execute("INSERT INTO sessions VALUES ('+1', ?, 0)", (b'j{"messages":[["u","hi"]],"message_info":[]}',))
+    conn.commit()
+    conn.close()
+    store = SQLiteSessionStore(path, Session)
+    session = store.get("+1")
+    assert session.messages == [user("hi")]
+    session.messages.append(user("again"))
+    store.save("+1", session)
+    assert SQLiteSessionStore(path, Session).get("+1").messages == [user("hi"), user("again")]
+
+
+@pytest.mark.parametrize("padding", [0, 5000])  # plain and compressed
+def test_message_info_keeps_every_key(padding):
+    state = dict(
+        messages=[{"role": "system", "content": "You are a bot" + " " * padding}, user("hi")],
+        message_info=[
+            {"role": "user", "content": "hi", "timestamp": "2023-05-01T10:00:00",
+             "routing": {"model": "gpt-3.5-turbo", "max_tokens": 256, "reason": "default"},
+             "memory_tokens": 12},
+            {"role": "user", "content": "bad words", "timestamp": "2023-05-01T10:01:00", "flagged": True},
+            {"role": "system", "content": "summary", "timestamp": "2023-05-01T10:02:00", "compacted_messages": 8},
+            {"role": "assistant", "content": "hello", "timestamp": None},
+        ],
+        language="english",
+    )
+    assert decode_session(encode_session(state)) == state
+
+
+def test_sessions_saved_without_extra_keys_are_decoded():
+    data = b"j" + json.dumps(dict(
+        messages=[["u", "hi"]], message_info=[["u", "hi", "2023-05-01T10:00:00"]],
+    )).encode()
+    state = decode_session(data)
+    assert state["messages"] == [user("hi")]
+    assert state["message_info"] == [{"role": "user", "content": "hi", "timestamp": "2023-05-01T10:00:00"}]
+
+
+def test_turn_of_the_losing_writer_is_kept(tmp_path, monkeypatch):
+    from app.whatsapp import chat as chat_module
+    from app.whatsapp.chat import OpenAIChatManager, Sender
+
+    path = str(tmp_path / "sessions.db")
+    # two processes handling messages of the same sender at the same time
+    store_a = SQLiteSessionStore(path, OpenAIChatManager)
+    store_b = SQLiteSessionStore(path, OpenAIChatManager)
+    sender = Sender("+1", "Ann")
+    monkeypatch.setattr(chat_module, "session_store", store_a)
+    chat_a = OpenAIChatManager.get_or_create(sender)
+    monkeypatch.setattr(chat_module, "session_store", store_b)
+    chat_b = OpenAIChatManager.get_or_create(sender)
+
+    chat_a.add_message("first")
+    chat_b.add_message("second")
+    chat_b.add_message("reply to second", role="assistant")
+    assert chat_b.save()
+    monkeypatch.setattr(chat_module, "session_store", store_a)
+    chat_a.add_message("reply to first", role="assistant")
+    chat_a.message_info[-1]["routing"] = {"model": "gpt-3.5-turbo"}
+    assert chat_a.save()
+
+    expected = [None, "second", "reply to second", "first", "reply to first"]
+    assert [m["content"] for m in chat_a.messages] == expected
+    stored = SQLiteSessionStore(path, OpenAIChatManager).get("+1")
+    assert [m["content"] for m in stored.messages] == expected
+    assert len(stored.message_tokens) == len(expected)
+    assert [m["content"] for m in stored.message_info] == expected
+    assert stored.message_info[-1]["routing"] == {"model": "gpt-3.5-turbo"}
+    # the next turn of the process that lost is saved without conflicts
+    chat_a.add_message("third")
+    assert chat_a.save()
+    assert len(SQLiteSessionStore(path, OpenAIChatManager).get("+1").messages) == 6
+
+
+@pytest.fixture
+def redis_stores():
+    """Two stores on the same (stand-in) Redis server"""
+    fakeredis = pytest.importorskip("fakeredis")
+    server = fakeredis.FakeServer()
+    return tuple(
+        RedisSessionStore(client=fakeredis.FakeRedis(server=server), session_class=Session, session_ttl=60)
+        for _ in range(2)
+    )
+
+
+def test_redis_stale_save_raises(redis_stores):
+    a, b = redis_stores
+    a.save("+1", Session([user("hi")]))
+    b.get("+1").messages.append(user("from b"))
+    session = a.get("+1")
+    b.save("+1", b.get("+1"))
+    session.messages.append(user("from a"))
+    with pytest.raises(SessionConflictError):
+        a.save("+1", session)
+    assert a.get("+1").messages == [user("hi"), user("from b")]
+
+
+def test_redis_save_fails_if_the_version_changes_while_writing(redis_stores):
+    a, b = redis_stores
+    a.save("+1", Session([user("hi")]))
+    session = a.get("+1")
+    pipeline = a.client.pipeline
+
+    class RacingPipeline:
+        """Another process saves the session between the check of the version and the write"""
+
+        def __init__(self):
+            self.pipe = pipeline()
+
+        def __getattr__(self, name):
+            return getattr(self.pipe, name)
+
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *exc):
+            return self.pipe.__exit__(*exc)
+
+        def get(self, key):
+            value = self.pipe.get(key)
+            b.save("+1", b.get("+1"))
+            return value
+
+    a.client.pipeline = RacingPipeline
+    with pytest.raises(SessionConflictError):
+        a.save("+1", session)
+
+
+def test_redis_keys_expire_even_if_nobody_purges_them(redis_stores):
+    a, _ = redis_stores
+    a.save("+1", Session([user("hi")]))
+    for key in ("chat:session:+1", "chat:session:+1:version"):
+        assert 60 < a.client.ttl(key) <= 120
+
+
+def test_redis_deleted_session_can_be_saved_again(redis_stores):
+    a, b = redis_stores
+    session = Session([user("hi")])
+    a.save("+1", session)
+    a.delete("+1")
+    assert b.get("+1") is None
+    session.messages = [user("again")]
+    a.save("+1", session)
+    assert b.get("+1").messages == [user("again")]
+
+
+class Expired:
+    """Records the sessions handed to `on_expire`"""
+
+    def __init__(self):
+        self.sessions = []
+
+    def __call__(self, key, session):
+        self.sessions.append((key, session.messages))
+
+
+def age(store, key, seconds):
+    """Makes the stored session look like it was last saved `seconds` ago"""
+    if isinstance(store, SQLiteSessionStore):
+        store._connection().execute("UPDATE sessions SET updated_at = updated_at - ? WHERE key = ?", (seconds, key))
+    else:
+        store.client.zincrby(store.updated_key, -seconds, key)
+
+
+@pytest.fixture(params=["sqlite", "redis"])
+def expiring_store(request, tmp_path):
+    expired = Expired()
+    if request.param == "sqlite":
+        store = SQLiteSessionStore(str(tmp_path / "sessions.db"), Session, session_ttl=60, on_expire=expired)
+    else:
+        fakeredis = pytest.importorskip("fakeredis")
+        store = RedisSessionStore(client=fakeredis.FakeRedis(), session_class=Session, session_ttl=60, on_expire=expired)
+    return store, expired
+
+
+def test_expired_sessions_are_purged_through_on_expire(expiring_store):
+    store, expired = expiring_store
+    store.save("+1", Session([user("old")]))
+    store.save("+2", Session([user("new")]))
+    age(store, "+1", 120)
+    assert store.purge_expired() == 1
+    assert expired.sessions == [("+1", [user("old")])]
+    store.cache.pop("+1")
+    assert store.get("+1") is None
+    assert store.get("+2") is not None
+    assert store.purge_expired() == 0
+
+
+def test_expired_session_read_goes_through_on_expire(expiring_store):
+    store, expired = expiring_store
+    store.save("+1", Session([user("old")]))
+    age(store, "+1", 120)
+    store.cache.pop("+1")
+    assert store.get("+1") is None
+    assert expired.sessions == [("+1", [user("old")])]
+
+
+def test_sessions_are_expired_in_the_background():
+    expired = Expired()
+    store = InMemorySessionStore(Session, ttl=0.05, on_expire=expired, expiry_interval=0.02)
+    try:
+        store.save("+1", Session([user("hi")]))
+        # nothing reads or writes the store meanwhile
+        deadline = time.monotonic() + 2
+        while not expired.sessions and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert expired.sessions == [("+1", [user("hi")])]
+    finally:
+        store.close()
@@ -0,0 +1,29 @@
+from chat.handlers.openai import tokens
+
+
+class FailingTiktoken:
+    """A tiktoken that can't download its encodings"""
+
+    calls = 0
+
+    @classmethod
+    def encoding_for_model(cls, model):
+        cls.calls += 1
+        raise KeyError(model)
+
+    @classmethod
+    def get_encoding(cls, name):
+        raise ConnectionError("no network")
+
+
+def test_tokens_are_estimated_when_the_encoding_cannot_be_downloaded(monkeypatch):
+    monkeypatch.setattr(tokens, "tiktoken", FailingTiktoken)
+    tokens._get_encoding.cache_clear()
+    try:
+        assert tokens.preload_encodings("some-new-model") == {"some-new-model": False}
+        assert tokens.count_tokens("x" * 40, "some-new-model") == 11
+        assert tokens.count_message_tokens({"role": "user", "content": "hi"}, "some-new-model") > 0
+        # the failure is cached, not retried on every message
+        assert FailingTiktoken.calls == 1
+    finally:
+        tokens._get_encoding.cache_clear()
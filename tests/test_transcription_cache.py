@@ -0,0 +1,147 @@
+import asyncio
+import hashlib
+import io
+import logging
+import os
+from contextlib import asynccontextmanager
+from types import SimpleNamespace
+
+import pytest
+
+from app import handlers
+from chat.handlers.media import FetchedMedia
+from chat.handlers.transcription_cache import TranscriptionCache
+
+
+def test_recently_used_transcriptions_are_kept_in_memory():
+    cache = TranscriptionCache(max_memory_items=2)
+    cache.put("a", "text a")
+    cache.put("b", "text b")
+    assert cache.get("a") == "text a"
+    cache.put("c", "text c")
+    # "b" was the least recently used
+    assert cache.get("b") is None
+    assert cache.get("a") == "text a"
+    assert cache.get("c") == "text c"
+    assert cache.stats()["memory_items"] == 2
+
+
+def test_keys_depend_on_the_audio_language_and_model():
+    key = TranscriptionCache.make_key("digest", "en", "assemblyai")
+    assert key == TranscriptionCache.make_key("digest", "en", "assemblyai")
+    assert key != TranscriptionCache.make_key("digest", "pt", "assemblyai")
+    assert key != TranscriptionCache.make_key("digest", "en", "whisper")
+    assert key != TranscriptionCache.make_key("other", "en", "assemblyai")
+    assert TranscriptionCache.make_key("digest") == TranscriptionCache.make_key("digest", None, "")
+
+
+def test_transcriptions_are_read_back_from_disk(tmp_path):
+    cache = TranscriptionCache(directory=str(tmp_path))
+    cache.put("a", "Olá, tudo bem?")
+    assert cache.stats()["disk_bytes"] == len("Olá, tudo bem?".encode("utf-8"))
+
+    restarted = TranscriptionCache(directory=str(tmp_path))
+    assert restarted.stats()["disk_bytes"] == cache.stats()["disk_bytes"]
+    assert restarted.stats()["memory_items"] == 0
+    assert restarted.get("a") == "Olá, tudo bem?"
+    # and it's kept in memory after
+    assert restarted.stats()["memory_items"] == 1
+    os.remove(tmp_path / "a.txt")
+    assert restarted.get("a") == "Olá, tudo bem?"
+    assert restarted.get("b") is None
+
+
+def test_least_recently_used_files_are_evicted_under_90_percent(tmp_path):
+    cache = TranscriptionCache(max_memory_items=1, directory=str(tmp_path), max_disk_bytes=100)
+    for i, key in enumerate("abc"):
+        cache.put(key, key * 30)
+        # distinct modification times, older first
+        os.utime(tmp_path / f"{key}.txt", (1000 + i, 1000 + i))
+    # reading "a" from disk marks it as recently used
+    assert cache.get("a") == "a" * 30
+    cache.put("d", "d" * 30)
+    assert sorted(os.listdir(tmp_path)) == ["a.txt", "c.txt", "d.txt"]
+    assert cache.stats()["disk_bytes"] == 90
+    cache.put("e", "e" * 25)
+    # 115 bytes, down to 85 (under 90) after removing the oldest file
+    assert sorted(os.listdir(tmp_path)) == ["a.txt", "d.txt", "e.txt"]
+    assert cache.stats()["disk_bytes"] == 85
+
+
+def test_hits_misses_and_bytes_saved_are_counted():
+    cache = TranscriptionCache()
+    assert cache.get("a", audio_size=1000) is None
+    cache.put("a", "text a")
+    cache.put("b", None)
+    assert cache.get("a", audio_size=1000) == "text a"
+    assert cache.get("a", audio_size=500) == "text a"
+    assert cache.get("b", audio_size=500) is None
+    stats = cache.stats()
+    assert (stats["hits"], stats["misses"], stats["bytes_saved"]) == (2, 2, 1500)
+    assert stats["hit_rate"] == 0.5
+
+
+class AssemblyAI:
+    """Stands in for the upload and transcription requests to AssemblyAI"""
+
+    def __init__(self):
+        self.uploads = []
+        self.transcribed = []
+
+    async def aupload_audio(self, file):
+        self.uploads.append(file.read())
+        return f"https://cdn.assemblyai/{len(self.uploads)}"
+
+    async def atranscribe_audio(self, audio_url, language_code=None, chat=None, as_json=False, **kwargs):
+        self.transcribed.append(audio_url)
+        return dict(text=f"transcription {len(self.transcribed)}")
+
+
+@pytest.fixture
+def assemblyai(monkeypatch):
+    assemblyai = AssemblyAI()
+    fetched = []
+
+    @asynccontextmanager
+    async def afetch_media(url, session=None):
+        data = url.encode("utf-8")
+        fetched.append(url)
+        yield FetchedMedia(io.BytesIO(data), "audio/ogg", len(data), sha256=hashlib.sha256(data).hexdigest())
+
+    monkeypatch.setattr(handlers, "afetch_media", afetch_media)
+    monkeypatch.setattr(handlers, "get_assemblyai_session", lambda: None)
+    monkeypatch.setattr(handlers, "aupload_audio", assemblyai.aupload_audio)
+    monkeypatch.setattr(handlers, "atranscribe_audio", assemblyai.atranscribe_audio)
+    assemblyai.fetched = fetched
+    return assemblyai
+
+
+def test_cached_voice_notes_are_not_uploaded_again(assemblyai):
+    cache = TranscriptionCache()
+    chat = SimpleNamespace(transcription_language="pt", logger=logging.getLogger(__name__))
+
+    def transcribe(url):
+        return asyncio.run(handlers.transcribe_voice_note(url, chat, cache=cache))
+
+    assert transcribe("https://media/1") == "transcription 1"
+    # the downloaded audio is uploaded instead of fetched again by AssemblyAI
+    assert assemblyai.uploads == [b"https://media/1"]
+    assert assemblyai.transcribed == ["https://cdn.assemblyai/1"]
+    # e.g. a retried webhook
+    assert transcribe("https://media/1") == "transcription 1"
+    assert len(assemblyai.uploads) == 1
+    assert len(assemblyai.transcribed) == 1
+    assert cache.stats()["bytes_saved"] == len(b"https://media/1")
+    # the same audio in another language is transcribed again
+    chat.transcription_language = "en"
+    assert transcribe("https://media/1") == "transcription 2"
+    assert len(assemblyai.uploads) == 2
+    assert assemblyai.fetched == ["https://media/1"] * 3
+
+
+def test_voice_notes_are_not_downloaded_without_a_cache(assemblyai):
+    chat = SimpleNamespace(transcription_language="pt", logger=logging.getLogger(__name__))
+    text = asyncio.run(handlers.transcribe_voice_note("https://media/1", chat))
+    assert text == "transcription 1"
+    assert assemblyai.transcribed == ["https://media/1"]
+    assert assemblyai.fetched == assemblyai.uploads == []
@@ -0,0 +1,77 @@
+import asyncio
+import time
+from contextlib import asynccontextmanager
+
+import pytest
+
+from chat.handlers.assemblyai import audio_transcription
+from chat.handlers.assemblyai.audio_transcription import _await_transcription_webhook, notify_transcription_status
+
+
+class Session:
+    """Stands in for the aiohttp session, returning the transcription with the given status"""
+
+    def __init__(self, status="processing"):
+        self.status = status
+        self.polls = []
+
+    @asynccontextmanager
+    async def get(self, url, headers=None):
+        self.polls.append(time.monotonic())
+        yield Response(dict(id=url.rsplit("/", 1)[-1], status=self.status, text="Olá"))
+
+
+class Response:
+    def __init__(self, data):
+        self.data = data
+
+    def raise_for_status(self):
+        pass
+
+    async def json(self):
+        return self.data
+
+
+@pytest.fixture(autouse=True)
+def poll_seconds(monkeypatch):
+    monkeypatch.setattr(audio_transcription, "WEBHOOK_POLL_SECONDS", 0.05)
+
+
+def test_the_status_is_not_polled_if_the_webhook_arrives_in_time():
+    session = Session(status="completed")
+
+    async def main():
+        loop = asyncio.get_event_loop()
+        loop.call_later(0.02, notify_transcription_status, "t-1", "completed")
+        return await _await_transcription_webhook(session, "t-1", {}, timeout=5)
+
+    assert asyncio.run(main())["text"] == "Olá"
+    # only the request of the completed transcription
+    assert len(session.polls) == 1
+
+
+def test_a_late_webhook_is_polled_at_doubling_intervals():
+    session = Session()
+    start = time.monotonic()
+    with pytest.raises(ValueError, match="Timed out"):
+        asyncio.run(_await_transcription_webhook(session, "t-2", {}, timeout=0.6))
+    # after 0.05, 0.15, 0.35 and at the deadline instead of every 0.05 seconds
+    assert len(session.polls) == 4
+    first, *_, last = (poll - start for poll in session.polls)
+    assert 0.04 < first < 0.1
+    assert last > 0.55
+
+
+def test_a_transcription_completed_without_its_webhook_is_returned():
+    # e.g. the webhook reached another process
+    session = Session(status="completed")
+    transcription = asyncio.run(_await_transcription_webhook(session, "t-3", {}, timeout=5))
+    assert transcription["id"] == "t-3"
+    assert len(session.polls) == 1
+
+
+def test_notifications_received_before_waiting_are_kept():
+    session = Session(status="completed")
+    assert not notify_transcription_status("t-4", "completed")
+    asyncio.run(asyncio.wait_for(_await_transcription_webhook(session, "t-4", {}, timeout=5), 0.04))
+    assert len(session.polls) == 1
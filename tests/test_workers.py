@@ -0,0 +1,112 @@
+import asyncio
+import threading
+import time
+
+from app.workers import WorkerPool
+
+
+def run_pool(handler, items, num_workers=4, timeout=10):
+    """Submits the (key, item) pairs and waits until all of them are processed"""
+    done = threading.Event()
+    remaining = [len(items)]
+    lock = threading.Lock()
+
+    async def wrapped(item):
+        try:
+            await handler(item)
+        finally:
+            with lock:
+                remaining[0] -= 1
+                if remaining[0] == 0:
+                    done.set()
+
+    pool = WorkerPool(wrapped, num_workers=num_workers).start()
+    try:
+        start = time.monotonic()
+        for key, item in items:
+            assert pool.submit(item, key=key)
+        assert done.wait(timeout), "the items weren't processed in time"
+        return time.monotonic() - start, pool.stats()
+    finally:
+        pool.stop(timeout)
+
+
+def test_items_of_a_sender_are_processed_in_order():
+    processed = []
+    in_process = set()
+
+    async def handler(item):
+        sender, i = item
+        assert sender not in in_process, "two items of a sender processed at the same time"
+        in_process.add(sender)
+        # later items are faster, they'd overtake the earlier ones if not ordered
+        await asyncio.sleep(0.002 * (20 - i))
+        in_process.discard(sender)
+        processed.append(item)
+
+    items = [(sender, (sender, i)) for i in range(20) for sender in ("a", "b", "c")]
+    run_pool(handler, items, num_workers=8)
+    for sender in ("a", "b", "c"):
+        assert [i for s, i in processed if s == sender] == list(range(20))
+
+
+def test_senders_are_processed_in_parallel():
+    async def handler(item):
+        await asyncio.sleep(0.2)
+
+    # every sender has its own queue, so with a worker each all of them are processed at the same time
+    elapsed, stats = run_pool(handler, [(f"sender-{i}", i) for i in range(32)], num_workers=32)
+    assert elapsed < 1.0
+    assert stats["processed"] == 32
+
+
+def test_concurrency_is_capped_by_num_workers():
+    active, peak = [0], [0]
+
+    async def handler(item):
+        active[0] += 1
+        peak[0] = max(peak[0], active[0])
+        await asyncio.sleep(0.02)
+        active[0] -= 1
+
+    run_pool(handler, [(f"sender-{i}", i) for i in range(20)], num_workers=3)
+    assert peak[0] == 3
+
+
+def test_slow_sender_does_not_block_other_senders():
+    finished = {}
+
+    async def handler(item):
+        sender, delay = item
+        await asyncio.sleep(delay)
+        finished.setdefault(sender, time.monotonic())
+
+    start = time.monotonic()
+    # "slow" only holds its own queue and one worker, the queues of the other senders are drained by the rest
+    items = [("slow", ("slow", 1.0))] + [(f"fast-{i}", (f"fast-{i}", 0.01)) for i in range(10)]
+    run_pool(handler, items, num_workers=4)
+    assert all(finished[f"fast-{i}"] - start < 0.5 for i in range(10))
+
+
+def test_full_pool_rejects_items():
+    max_queue_size = 5
+    release = threading.Event()
+
+    async def handler(item):
+        while not release.is_set():
+            await asyncio.sleep(0.01)
+
+    pool = WorkerPool(handler, num_workers=1, max_queue_size=max_queue_size).start()
+    try:
+        # the item being processed doesn't count, wait for it to leave the queue
+        assert pool.submit(-1, key="a")
+        deadline = time.monotonic() + 5
+        while pool.stats()["busy_workers"] == 0:
+            assert time.monotonic() < deadline, "timed out"
+            time.sleep(0.005)
+        accepted = [pool.submit(i, key="a") for i in range(max_queue_size + 3)]
+        assert accepted.count(False) == 3
+        assert pool.stats()["rejected"] == 3
+    finally:
+        release.set()
+        pool.stop(5)